@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Day x location x measure cube of the cleaning output with prefix sums over time.
+
+Measures are lineage groups (sums of lineage columns, i.e. the WHO greek
+groups, 'All lineages', 'Other lineages') and OWID daily counts (new cases,
+new people vaccinated). Locations are the countries and every
+aggregate_location (continents, WHO regions, Global). Each measure and
+location holds the running total over a dense day axis, so the sum over any
+date range is the difference of two entries, whatever the range length:
+
+    cube = AggregateCube.load(CUBE_PATH)
+    cube.sum('who_omicron', '2022-01-01', '2022-01-31', 'Global')
+    cube.ratio('All lineages', 'owid_new_cases', *cube.last_days(30))  # share of cases sequenced, per location
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from date_country_grid import DateCountryGrid
+from lineage_index import LineageGroups
+
+# OWID columns of the cleaning output added to the cube as they are
+OWID_MEASURES = ['owid_new_cases', 'owid_new_people_vaccinated', 'owid_new_people_fully_vaccinated']
+
+
+class AggregateCube:
+    """Prefix sums per measure, day and location.
+
+    Parameters
+    ----------
+    prefix : numpy.ndarray
+        (measures, days + 1, locations) running totals, prefix[:, 0] is 0.
+    measures : list
+        Measure names.
+    locations : list
+        Location names.
+    first_day : numpy.datetime64
+        Date of the first day.
+    """
+
+    def __init__(self, prefix, measures, locations, first_day):
+        self.prefix = prefix
+        self.measures = list(measures)
+        self.locations = list(locations)
+        self.first_day = np.datetime64(first_day, 'D')
+        self._measure_index = {m: i for i, m in enumerate(self.measures)}
+        self._location_index = {loc: i for i, loc in enumerate(self.locations)}
+
+    @property
+    def n_days(self):
+        return self.prefix.shape[1] - 1
+
+    @property
+    def last_day(self):
+        return self.first_day + max(self.n_days - 1, 0)
+
+    @classmethod
+    def from_frame(cls, df, lineage_groups, value_cols=OWID_MEASURES, date_col='gisaid_collect_date',
+                   location_cols=('aggregate_location', 'gisaid_country')):
+        """Cube of a cleaning output frame.
+
+        Parameters
+        ----------
+        df : pandas.core.frame.DataFrame
+            Rows per date and country or aggregate location, with one column
+            per key lineage label.
+        lineage_groups : dict
+            Measure name -> lineage names and wildcard patterns, resolved
+            against the lineage columns of df as add_greek_cols does, and
+            totalled with one LineageGroups product. A group matching no
+            column is all zeros.
+        value_cols : list
+            Other numeric columns added as measures, missing ones skipped.
+        date_col : str
+            Date of each row.
+        location_cols : tuple
+            Location of each row, the first non-missing of these columns.
+        """
+        locations = df[location_cols[0]]
+        for col in location_cols[1:]:
+            locations = locations.where(locations.notna(), df[col])
+        dates = df[date_col]
+
+        grid = DateCountryGrid([dates], [locations])
+        cells = grid.cells(dates, locations)
+        placed = cells >= 0
+
+        groups = LineageGroups(lineage_groups, set(df.columns), verbose=False)
+        measures_df = pd.concat([groups.groups(df)[groups.names], df[[c for c in value_cols if c in df.columns]]], axis=1)
+        values = np.nan_to_num(measures_df.to_numpy(dtype='float64'), nan=0.0)
+
+        prefix = np.zeros((measures_df.shape[1], grid.n_days + 1, grid.n_countries))
+        for i in range(measures_df.shape[1]):
+            daily = np.bincount(cells[placed], weights=values[placed, i], minlength=grid.n_cells)
+            np.cumsum(daily.reshape(grid.n_days, grid.n_countries), axis=0, out=prefix[i, 1:])
+        first_day = np.datetime64(int(grid.first_day), 'D')
+        return cls(prefix, list(measures_df.columns), list(grid.countries), first_day)
+
+    def _day(self, value, default):
+        if value is None:
+            return default
+        return int((np.datetime64(pd.Timestamp(value).date(), 'D') - self.first_day).astype('int64'))
+
+    def _measure_rows(self, measure):
+        names = [measure] if isinstance(measure, str) else list(measure)
+        return [self._measure_index[name] for name in names]
+
+    def sum(self, measure, start=None, end=None, locations=None):
+        """Total of measure over start..end, both included.
+
+        Parameters
+        ----------
+        measure : str or list
+            Measure name, or names to add up.
+        start, end : date-like, optional
+            First and last day. Default to the first and last day of the
+            cube; days outside it count as 0.
+        locations : str or list, optional
+            One location, or several. Defaults to every location.
+
+        Returns
+        -------
+        float or pandas.core.series.Series
+            A float for one location, otherwise totals indexed by location.
+        """
+        first = max(self._day(start, 0), 0)
+        last = min(self._day(end, self.n_days - 1), self.n_days - 1)
+        if isinstance(locations, str):
+            columns = [self._location_index[locations]]
+        elif locations is None:
+            columns = list(range(len(self.locations)))
+        else:
+            columns = [self._location_index[loc] for loc in locations]
+
+        rows = self._measure_rows(measure)
+        if last < first:
+            totals = np.zeros(len(columns))
+        else:
+            totals = (self.prefix[rows, last + 1][:, columns] - self.prefix[rows, first][:, columns]).sum(axis=0)
+        if isinstance(locations, str):
+            return float(totals[0])
+        return pd.Series(totals, index=[self.locations[c] for c in columns], name='total')
+
+    def ratio(self, numerator, denominator, start=None, end=None, locations=None):
+        """sum(numerator) / sum(denominator) over the same days and locations, NaN where the denominator is 0."""
+        num = self.sum(numerator, start, end, locations)
+        den = self.sum(denominator, start, end, locations)
+        if isinstance(locations, str):
+            return num / den if den else np.nan
+        return (num / den.where(den != 0)).rename('ratio')
+
+    def last_days(self, n_days, end=None):
+        """(start, end) of the n_days ending at end, by default the cube's last day."""
+        end = np.datetime64(pd.Timestamp(end).date(), 'D') if end is not None else self.last_day
+        return pd.Timestamp(end - (n_days - 1)), pd.Timestamp(end)
+
+    def save(self, path):
+        """Write the cube as an .npz file, see load."""
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, prefix=self.prefix, measures=np.array(self.measures, dtype=str),
+                     locations=np.array(self.locations, dtype=str), first_day=self.first_day)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a cube written by save."""
+        with np.load(path) as stored:
+            return cls(stored['prefix'], stored['measures'].tolist(), stored['locations'].tolist(),
+                       stored['first_day'][()])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmark for process_raw_metadata_parallel.
+
+Times filtering and annotation of the same metadata sample at 1, 2, 4 and 8
+worker processes and prints wall time and speedup over one worker.
+
+    python benchmark_parallel_filter.py --metadata-path ../data/raw/metadata.tsv --nrows 1000000
+
+Without --metadata-path the sample is synthetic (see synthetic_data) and no
+network access is needed.
+"""
+
+import argparse
+import os
+import time
+
+import pandas as pd
+
+import filter_gisaid_metadata
+import process_nextstrain_exclude
+import synthetic_data
+from benchmark_pipeline import STATIC_DIR
+from filter_gisaid_metadata import METADATA_DTYPES, METADATA_USECOLS, metadata_worker_pool, \
+    process_raw_metadata_parallel
+
+
+def benchmark_workers(gisaid_df, worker_counts=(1, 2, 4, 8), repeat=3, exclude_sequences=None):
+    """Best-of-repeat wall time of process_raw_metadata_parallel per worker count.
+
+    Pools are started before timing so the numbers are the steady-state cost
+    of a chunk, as in a streamed run.
+
+    Parameters
+    ----------
+    gisaid_df : pandas.core.frame.DataFrame
+        Raw metadata sample.
+    worker_counts : tuple
+        Worker counts to time.
+    repeat : int
+        Timed runs per worker count.
+    exclude_sequences : set, optional
+        Nextstrain exclude set. Fetched when not given.
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        workers, rows, seconds and speedup columns.
+    """
+    if exclude_sequences is None:
+        exclude_sequences = process_nextstrain_exclude.load_exclude_index()
+
+    results = []
+    for n_workers in worker_counts:
+        pool = metadata_worker_pool(n_workers, exclude_sequences) if n_workers > 1 else None
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            process_raw_metadata_parallel(gisaid_df.copy(), n_workers, exclude_sequences, pool=pool)
+            times.append(time.perf_counter() - start)
+        if pool is not None: pool.shutdown()
+        results.append({'workers': n_workers, 'rows': gisaid_df.shape[0], 'seconds': min(times)})
+        print('  %d workers: %.2fs' % (n_workers, min(times)))
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results['seconds'].iloc[0] / results['seconds']
+    return results
+
+
+def main(args_list=None):
+    parser = argparse.ArgumentParser(description='Time process_raw_metadata_parallel at several worker counts.')
+    parser.add_argument('--metadata-path', help='GISAID metadata.tsv export, synthetic data if not given')
+    parser.add_argument('--nrows', type=int, default=1000000, help='rows of the export to use, or to generate')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(args_list)
+
+    exclude_sequences = None
+    if args.metadata_path:
+        gisaid_df = pd.read_csv(args.metadata_path, sep='\t', nrows=args.nrows,
+                                usecols=METADATA_USECOLS, dtype=METADATA_DTYPES)
+    else:
+        # set before the pools start so the worker processes inherit the local rules files
+        filter_gisaid_metadata.COUNTRY_NAME_CORRECTIONS_PATH = os.path.join(
+            STATIC_DIR, 'gisaid_country_name_corrections.csv')
+        filter_gisaid_metadata.KNOWN_COUNTRIES_PATH = os.path.join(STATIC_DIR, 'country_lat_long_names.csv')
+        gisaid_df = synthetic_data.generate_metadata(args.nrows)
+        exclude_sequences = synthetic_data.generate_exclude_sequences(gisaid_df)
+    print('Timing %d rows...' % gisaid_df.shape[0])
+    print(benchmark_workers(gisaid_df, args.workers, args.repeat, exclude_sequences).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
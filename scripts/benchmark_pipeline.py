@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the GISAID/OWID pipeline stages.
+
+Generates synthetic metadata.tsv and OWID frames (see synthetic_data) at each
+requested scale, then runs the stages of gisaid_metadata_processing.main one
+at a time, recording wall time, peak traced memory and rows in/out for each.
+Results are printed and written as JSON so runs can be compared.
+
+    python benchmark_pipeline.py --rows 10000 100000 1000000 --output benchmark_results.json
+
+No network access or real exports are needed; the country name rules are read
+from the repo's data/static folder, and suspect dates go to a temporary table.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import filter_gisaid_metadata
+import gisaid_metadata_processing as gmp
+import synthetic_data
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'static')
+
+
+def n_rows(result):
+    """Rows in a stage result, or None for results that aren't frames."""
+    return result.shape[0] if isinstance(result, (pd.DataFrame, pd.Series)) else None
+
+
+def run_stage(name, func, args, profile_memory=True):
+    """Time one stage and measure its peak memory.
+
+    Parameters
+    ----------
+    name : str
+        Stage name for the results.
+    func : callable
+        The stage.
+    args : tuple
+        Positional arguments for func. The first one is the stage input
+        whose rows are reported as rows_in.
+    profile_memory : bool
+        Trace allocations while the stage runs. This slows the stage down, so
+        memory is measured in a second, untimed run.
+
+    Returns
+    -------
+    result : object
+        Return value of func from the timed run.
+    record : dict
+        stage, seconds, peak_mb, rows_in and rows_out.
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if profile_memory:
+        tracemalloc.start()
+        func(*args)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+
+    record = {'stage': name, 'seconds': seconds, 'peak_mb': peak_mb,
+              'rows_in': n_rows(args[0]), 'rows_out': n_rows(result)}
+    print('  %-36s %9.2fs %10s MB %10s -> %s rows' % (
+        name, seconds, '-' if peak_mb is None else '%.1f' % peak_mb, record['rows_in'], record['rows_out']))
+    return result, record
+
+
+def copying(func):
+    """Wrap a stage that modifies its first argument so every run gets a fresh copy."""
+    def wrapped(df, *args):
+        return func(df.copy(), *args)
+    return wrapped
+
+
+def benchmark_pipeline(n_sequences, n_countries=200, n_lineages=1500, seed=0, profile_memory=True):
+    """Run every stage on synthetic data of one size.
+
+    Parameters
+    ----------
+    n_sequences : int
+        Rows of synthetic metadata.
+    n_countries, n_lineages : int
+        Cardinality of the synthetic data.
+    seed : int
+        Random seed.
+    profile_memory : bool
+        Measure peak memory per stage, see run_stage.
+
+    Returns
+    -------
+    list
+        One record per stage, see run_stage.
+    """
+    print('Generating %d sequences...' % n_sequences)
+    gisaid_df = synthetic_data.generate_metadata(n_sequences, n_countries, n_lineages, seed)
+    exclude_sequences = synthetic_data.generate_exclude_sequences(gisaid_df, seed=seed)
+    owid_raw_df = synthetic_data.generate_owid(n_countries, seed)
+    region_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+    synthetic_data.generate_who_regions(n_countries, seed).to_csv(region_file, index=False)
+    region_file.close()
+
+    records = []
+    try:
+        gisaid_df, record = run_stage('process_raw_metadata', copying(filter_gisaid_metadata.process_raw_metadata),
+                                      (gisaid_df, exclude_sequences), profile_memory)
+        records.append(record)
+        gisaid_counts_df, record = run_stage('count_sequences', gmp.count_sequences, (gisaid_df,), profile_memory)
+        records.append(record)
+        country_variants_df, record = run_stage('aggregate_with_lineage', gmp.aggregate_with_lineage,
+                                                (gisaid_df,), profile_memory)
+        records.append(record)
+        _, record = run_stage('aggregate_with_lineage_from_counts', gmp.aggregate_with_lineage_from_counts,
+                              (gisaid_counts_df,), profile_memory)
+        records.append(record)
+        owid_df, record = run_stage('prepare_owid_df', copying(gmp.prepare_owid_df), (owid_raw_df,), profile_memory)
+        records.append(record)
+        # the reference outer-merge join, timed as the baseline for pivot_gisaid_owid below
+        merged_df, record = run_stage('merge_gisaid_owid', gmp.merge_gisaid_owid,
+                                      (country_variants_df, owid_df), profile_memory)
+        records.append(record)
+        merged_pivoted_df, record = run_stage('pivot_merged_df', copying(gmp.pivot_merged_df),
+                                              (merged_df,), profile_memory)
+        records.append(record)
+        merged_pivoted_df, record = run_stage('pivot_gisaid_owid', gmp.pivot_gisaid_owid,
+                                              (country_variants_df, owid_df), profile_memory)
+        records.append(record)
+        merged_pivoted_df, record = run_stage('add_regions', gmp.add_regions,
+                                              (merged_pivoted_df, region_file.name), profile_memory)
+        records.append(record)
+        _, record = run_stage('concat_agglocations', gmp.concat_agglocations, (merged_pivoted_df,), profile_memory)
+        records.append(record)
+        _, record = run_stage('calc_lagstats', gmp.calc_lagstats, (gisaid_df,), profile_memory)
+        records.append(record)
+        _, record = run_stage('calc_lagstats_from_counts', gmp.calc_lagstats_from_counts,
+                              (gisaid_counts_df,), profile_memory)
+        records.append(record)
+    finally:
+        os.remove(region_file.name)
+
+    for record in records:
+        record['sequences'] = n_sequences
+    return records
+
+
+def main(args_list=None):
+    parser = argparse.ArgumentParser(description='Time and memory-profile each pipeline stage on synthetic data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='synthetic metadata sizes to run, i.e. 10000 up to 10000000')
+    parser.add_argument('--countries', type=int, default=200)
+    parser.add_argument('--lineages', type=int, default=1500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced-memory runs')
+    parser.add_argument('--static-dir', default=STATIC_DIR, help='folder with the country name rules')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    args = parser.parse_args(args_list)
+
+    filter_gisaid_metadata.COUNTRY_NAME_CORRECTIONS_PATH = os.path.join(
+        args.static_dir, 'gisaid_country_name_corrections.csv')
+    filter_gisaid_metadata.KNOWN_COUNTRIES_PATH = os.path.join(args.static_dir, 'country_lat_long_names.csv')
+
+    records = []
+    # suspect dates are recorded in a throwaway table, never the pipeline's suspect_date.csv
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filter_gisaid_metadata.SUSPECT_DATE_PATH = os.path.join(tmp_dir, 'suspect_date.csv')
+        for n_sequences in args.rows:
+            records += benchmark_pipeline(n_sequences, args.countries, args.lineages, args.seed, not args.no_memory)
+
+    results = {
+        'run_date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'countries': args.countries,
+        'lineages': args.lineages,
+        'seed': args.seed,
+        'stages': records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Wrote %s' % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned Parquet hand-off files between the Python and R stages.
+
+The processed GISAID outputs can be written as hive-partitioned Parquet
+datasets (one directory per collection week or per location) with typed
+dates, booleans and categorical lineage/location columns, so downstream
+readers only touch the partitions and columns they need. Needs pyarrow; CSV
+output does not.
+"""
+
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from filter_gisaid_metadata import get_weekstartdates
+
+# string columns written as dictionary-encoded (categorical) columns
+CATEGORICAL_COLS = ['Pango lineage', 'gisaid_Pango lineage', 'key_lineages', 'country',
+                    'gisaid_country', 'owid_location', 'owid_continent', 'who_region',
+                    'aggregate_location', 'collect_yearweek', 'gisaid_collect_yearweek']
+
+PARTITION_COLS = {'week': 'collect_week', 'country': 'location'}
+
+# schema metadata key holding the location_cols a dataset was written with, see read_parquet_subset
+LOCATION_COLS_KEY = b'ppi_location_cols'
+
+
+def add_partition_col(df: pd.core.frame.DataFrame, partition_by: str,
+                      date_col: str, location_cols: list) -> pd.core.frame.DataFrame:
+    """Add the column the dataset is partitioned on.
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Frame to be written.
+    partition_by : str
+        'week' for collect_week, the Monday of date_col as YYYY-MM-DD, or
+        'country' for location, the first non-null of location_cols.
+    date_col : str
+        Collection date column.
+    location_cols : list
+        Location columns in order of preference, e.g. country then
+        aggregate_location for rows that are regional rollups.
+
+    Returns
+    -------
+    df : pandas.core.frame.DataFrame
+        Copy of df with the partition column added.
+    """
+    df = df.copy()
+    if partition_by == 'week':
+        df['collect_week'] = get_weekstartdates(df[date_col]).dt.strftime('%Y-%m-%d')
+    elif partition_by == 'country':
+        location = df[location_cols[0]]
+        for col in location_cols[1:]:
+            if col in df.columns:
+                location = location.fillna(df[col])
+        df['location'] = location.fillna('Unknown')
+    else:
+        raise ValueError('Unknown partition_by %s, expected week or country' % partition_by)
+    return df
+
+
+def write_partitioned_parquet(df: pd.core.frame.DataFrame, path: str, partition_by: str = 'week',
+                              date_col: str = 'collect_date', location_cols: list = ['country'],
+                              append: bool = False) -> None:
+    """Write df as a hive-partitioned Parquet dataset.
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Frame to be written. Its index is not kept.
+    path : str
+        Dataset directory.
+    partition_by : str
+        'week' or 'country', see add_partition_col.
+    date_col : str
+        Collection date column.
+    location_cols : list
+        Location columns in order of preference.
+    append : bool
+        Add files to an existing dataset, for chunked writers. Otherwise any
+        existing dataset at path is replaced.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not append and os.path.exists(path):
+        shutil.rmtree(path)
+
+    df = add_partition_col(df, partition_by, date_col, location_cols)
+    for col in CATEGORICAL_COLS:
+        # object columns, or the str dtype newer pandas gives string columns
+        if col in df.columns and (pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])):
+            df[col] = df[col].astype('category')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # the location columns are kept with the schema so readers can filter on them whatever the partitioning
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           LOCATION_COLS_KEY: json.dumps(list(location_cols)).encode()})
+    pq.write_to_dataset(table, path, partition_cols=[PARTITION_COLS[partition_by]])
+
+
+def location_filter(location_cols: list, locations: list):
+    """Dataset filter for rows whose location, the first non-null of location_cols, is in locations.
+
+    Rows with no location at all are 'Unknown', as add_partition_col labels them.
+    """
+    import pyarrow.dataset as ds
+
+    locations = list(locations)
+    row_filter = None
+    all_null = None
+    for col in location_cols:
+        # this column decides the location when every column before it is null
+        match = ds.field(col).isin(locations)
+        if all_null is not None:
+            match = all_null & match
+        row_filter = match if row_filter is None else row_filter | match
+        all_null = ds.field(col).is_null() if all_null is None else all_null & ds.field(col).is_null()
+    if 'Unknown' in locations:
+        row_filter = row_filter | all_null
+    return row_filter
+
+
+def read_parquet_subset(path: str, columns: list = None, start=None, end=None,
+                        date_col: str = 'collect_date', locations: list = None,
+                        location_cols: list = None) -> pd.core.frame.DataFrame:
+    """Load a column and date-range subset of a partitioned dataset.
+
+    Only the partitions that can hold matching rows are opened, and only the
+    requested columns are read from them.
+
+    Parameters
+    ----------
+    path : str
+        Dataset directory written by write_partitioned_parquet.
+    columns : list, optional
+        Columns to load. All columns if not given.
+    start, end : str or datetime-like, optional
+        Inclusive collection date range on date_col.
+    date_col : str
+        Collection date column the range applies to.
+    locations : list, optional
+        Only rows for these locations. Uses the partitions when the dataset
+        is partitioned by country, otherwise filters on location_cols.
+    location_cols : list, optional
+        Location columns in order of preference, as passed to
+        write_partitioned_parquet. Defaults to the ones stored with the
+        dataset, or country for datasets written without them.
+
+    Returns
+    -------
+    df : pandas.core.frame.DataFrame
+        The matching rows, with partition columns dropped unless asked for.
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    names = set(dataset.schema.names)
+
+    filters = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        if 'collect_week' in names:
+            week = start - pd.Timedelta(days=start.weekday())
+            filters.append(ds.field('collect_week') >= week.strftime('%Y-%m-%d'))
+        filters.append(ds.field(date_col) >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        if 'collect_week' in names:
+            filters.append(ds.field('collect_week') <= end.strftime('%Y-%m-%d'))
+        filters.append(ds.field(date_col) <= end)
+    if locations is not None:
+        if 'location' in names:
+            filters.append(ds.field('location').isin(list(locations)))
+        else:
+            if location_cols is None:
+                stored = (dataset.schema.metadata or {}).get(LOCATION_COLS_KEY)
+                location_cols = json.loads(stored) if stored else ['country']
+            filters.append(location_filter([c for c in location_cols if c in names], locations))
+
+    row_filter = None
+    for f in filters:
+        row_filter = f if row_filter is None else row_filter & f
+
+    if columns is None:
+        columns = [c for c in dataset.schema.names if c not in PARTITION_COLS.values()]
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Dense (day x country) grid for joining GISAID counts with OWID series.
+
+Dates are encoded as day offsets from the first date and countries as codes
+into one sorted dictionary shared by every source, so each (date, country)
+key is a single integer cell, day * n_countries + country. Rows of either
+source are placed on the grid by their cell, and joining them is indexing a
+per-cell row lookup instead of a hash join on datetime and string keys.
+Cells are numbered in (date, country) order, so occupied cells come out in
+the order groupby or pivot_table would sort those keys.
+
+The grid is a few hundred thousand cells (days since Dec 2019 times ~250
+countries), so the per-cell arrays are small next to the GISAID rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def take_or_nan(values, rows):
+    """values[rows], with NaN (NaT for dates) where rows is -1.
+
+    Unlike take_by_codes, float and datetime columns keep their dtype.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        values = values.astype('float64')
+    # datetime columns are filled with NaT
+    missing = np.array(['NaT'], dtype=values.dtype) if values.dtype.kind == 'M' else np.array([np.nan], dtype=values.dtype)
+    return np.append(values, missing)[rows]
+
+
+class DateCountryGrid:
+    """Cell encoding of the (date, country) keys of one or more sources.
+
+    Parameters
+    ----------
+    dates : list
+        datetime64 Series, one per source.
+    countries : list
+        Country Series aligned with dates.
+    """
+
+    def __init__(self, dates, countries):
+        days = np.concatenate([self._days(d) for d in dates])
+        days = days[days != np.iinfo('int64').min]
+        self.first_day = days.min() if len(days) else 0
+        self.n_days = days.max() - self.first_day + 1 if len(days) else 0
+        self.countries = np.asarray(sorted(pd.unique(pd.concat([pd.Series(c, dtype=object) for c in countries]).dropna())),
+                                    dtype=object)
+        self.n_countries = len(self.countries)
+        self.n_cells = self.n_days * self.n_countries
+        # cell dates come out in the resolution of the first source, as a merge on its dates would return them
+        first_dtype = np.asarray(dates[0]).dtype if len(dates) else None
+        self.date_dtype = first_dtype if first_dtype is not None and first_dtype.kind == 'M' else np.dtype('datetime64[ns]')
+
+    @staticmethod
+    def _days(dates):
+        # days since the epoch, int64 min for NaT
+        return np.asarray(dates, dtype='datetime64[D]').astype('int64')
+
+    def country_codes(self, countries):
+        """Code of each country in the shared dictionary, -1 if missing."""
+        codes, uniques = pd.factorize(pd.Series(countries, dtype=object))
+        # the lookup runs over the distinct countries only
+        unique_codes = pd.Index(self.countries).get_indexer(uniques)
+        return np.append(unique_codes, -1)[codes]
+
+    def cells(self, dates, countries):
+        """Cell of each (date, country), -1 where either is missing or off the grid."""
+        days = self._days(dates) - self.first_day
+        codes = self.country_codes(countries)
+        valid = (days >= 0) & (days < self.n_days) & (codes >= 0)
+        return np.where(valid, days * self.n_countries + codes, -1)
+
+    def cell_dates(self, cells):
+        """datetime64 date of each cell, see date_dtype."""
+        return (cells // self.n_countries + self.first_day).astype('datetime64[D]').astype(self.date_dtype)
+
+    def cell_country_codes(self, cells):
+        return cells % self.n_countries
+
+    def cell_countries(self, cells):
+        """Country of each cell."""
+        return self.countries[self.cell_country_codes(cells)]
+
+    def row_lookup(self, cells):
+        """Per-cell position in cells (the last one for repeated cells), -1 for cells not in it."""
+        lookup = np.full(self.n_cells, -1, dtype='int64')
+        placed = np.flatnonzero(cells >= 0)
+        lookup[cells[placed]] = placed
+        return lookup
+
+    def occupied(self, *cell_arrays):
+        """Sorted cells present in any of cell_arrays."""
+        mask = np.zeros(self.n_cells, dtype=bool)
+        for cells in cell_arrays:
+            mask[cells[cells >= 0]] = True
+        return np.flatnonzero(mask)
+
+    def sum_by_cell(self, key_cells, cells, labels, values, n_labels):
+        """(key cell x label) matrix of summed values, NaN where no row falls.
+
+        Parameters
+        ----------
+        key_cells : numpy.ndarray
+            Sorted cells, one per output row, see occupied.
+        cells : numpy.ndarray
+            Cell of each value, -1 to skip it.
+        labels : numpy.ndarray
+            Column code of each value, -1 to skip it.
+        values : numpy.ndarray
+            Values to add up.
+        n_labels : int
+            Number of output columns.
+        """
+        rows = self.row_lookup(key_cells)[np.maximum(cells, 0)]
+        keep = (cells >= 0) & (rows >= 0) & (labels >= 0)
+        flat = rows[keep] * n_labels + labels[keep]
+        size = len(key_cells) * n_labels
+        sums = np.bincount(flat, weights=np.asarray(values, dtype='float64')[keep], minlength=size)
+        present = np.bincount(flat, minlength=size) > 0
+        return np.where(present, sums, np.nan).reshape(len(key_cells), n_labels)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Cached, conditional-fetch client for the external data the pipeline pulls
+(OWID case/vaccination data, Nextstrain exclude list).
+
+Downloads are stored content-addressed (by sha256) under CACHE_DIR with an
+index of url -> object, ETag and Last-Modified. Each url is revalidated at
+most once per process with If-None-Match/If-Modified-Since, so a run downloads
+a file at most once and not at all when the server says it is unchanged. In
+offline mode, or when the server can't be reached, the last good copy is
+served instead. Failed requests are retried with backoff before falling back.
+
+prefetch starts several fetches concurrently on a background asyncio loop, so
+downloads overlap with local work such as parsing metadata.tsv. A later
+fetch of the same url waits for that download instead of starting another,
+so each caller blocks only on the file it needs.
+
+The url is all that identifies a source, so everything here can be pointed at
+a local HTTP server for testing.
+"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# local path
+# CACHE_DIR = '../data/cache'
+
+# domino path
+CACHE_DIR = '/mnt/data/cache'
+
+OWID_URL = 'https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.csv'
+NEXTSTRAIN_EXCLUDE_URL = 'https://raw.githubusercontent.com/nextstrain/ncov/master/defaults/exclude.txt'
+
+# serve only from the cache, never touch the network
+OFFLINE = os.environ.get('PPI_FETCH_OFFLINE', '') not in ('', '0')
+
+TIMEOUT = 60
+# attempts after the first on connection errors, timeouts and 5xx responses, waiting RETRY_BACKOFF * 2**attempt seconds
+RETRIES = 3
+RETRY_BACKOFF = 2
+
+_session = None
+_fetched = {}
+_url_locks = {}
+_lock = threading.Lock()
+_index_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Shared pooled session so repeated fetches reuse connections."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        # no adapter-level retries, failed requests are retried by fetch alone (see RETRIES)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def _load_index(cache_dir):
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def _save_index(cache_dir, index):
+    index_path = os.path.join(cache_dir, 'index.json')
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(index_path + '.tmp', index_path)
+
+    # drop objects no url points at any more
+    referenced = {entry['sha256'] for entry in index.values()}
+    objects_dir = os.path.join(cache_dir, 'objects')
+    for name in os.listdir(objects_dir):
+        if name not in referenced and not name.endswith('.tmp'):
+            os.remove(os.path.join(objects_dir, name))
+
+
+def _object_path(cache_dir, sha256):
+    return os.path.join(cache_dir, 'objects', sha256)
+
+
+def fetch(url: str, cache_dir: str = None, offline: bool = None) -> str:
+    """Return a local path holding the current contents of url.
+
+    Parameters
+    ----------
+    url : str
+        The file to fetch.
+    cache_dir : str, optional
+        Cache root holding index.json and objects/. Defaults to CACHE_DIR.
+    offline : bool, optional
+        Serve the cached copy without contacting the server. Defaults to the
+        module-level OFFLINE setting.
+
+    Returns
+    -------
+    path : str
+        Path of the cached object. Treat it as read-only.
+
+    Raises
+    ------
+    RuntimeError
+        If the url can't be fetched and there is no cached copy.
+    """
+    # module settings are read at call time, so they can be pointed elsewhere (i.e. local runs)
+    cache_dir = cache_dir or CACHE_DIR
+    offline = OFFLINE if offline is None else offline
+    key = (cache_dir, url)
+    with _lock:
+        url_lock = _url_locks.setdefault(key, threading.Lock())
+
+    # different urls can be fetched concurrently, the same url only once
+    with url_lock:
+        if key in _fetched:
+            return _fetched[key]
+
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        with _index_lock:
+            entry = _load_index(cache_dir).get(url)
+        if entry is not None and not os.path.exists(_object_path(cache_dir, entry['sha256'])):
+            entry = None
+
+        if offline:
+            if entry is None:
+                raise RuntimeError('Offline and no cached copy of %s' % url)
+            print('  Offline, using cached %s' % url)
+            path = _object_path(cache_dir, entry['sha256'])
+        else:
+            try:
+                path = _download_with_retries(url, cache_dir, entry)
+            except requests.RequestException as e:
+                if entry is None:
+                    raise RuntimeError('Could not fetch %s and no cached copy: %s' % (url, e))
+                print('  Could not fetch %s (%s), using last good copy' % (url, e))
+                path = _object_path(cache_dir, entry['sha256'])
+
+        _fetched[key] = path
+        return path
+
+
+def _download_with_retries(url, cache_dir, entry):
+    for attempt in range(RETRIES + 1):
+        try:
+            return _download(url, cache_dir, entry)
+        except requests.RequestException as e:
+            # a 4xx won't change on retry
+            client_error = e.response is not None and e.response.status_code < 500
+            if client_error or attempt == RETRIES:
+                raise
+            print('  Fetching %s failed (%s), retrying' % (url, e))
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+def _download(url, cache_dir, entry):
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    with get_session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 304 and entry is not None:
+            print('  %s unchanged, using cached copy' % url)
+            return _object_path(cache_dir, entry['sha256'])
+        response.raise_for_status()
+
+        tmp_path = os.path.join(cache_dir, 'objects', '%d.tmp' % threading.get_ident())
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for block in response.iter_content(chunk_size=1 << 20):
+                sha256.update(block)
+                f.write(block)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+
+    # move into place and register under the index lock so no other save sees it unreferenced
+    path = _object_path(cache_dir, sha256.hexdigest())
+    with _index_lock:
+        os.replace(tmp_path, path)
+        index = _load_index(cache_dir)
+        index[url] = {'sha256': sha256.hexdigest(), 'etag': etag, 'last_modified': last_modified}
+        _save_index(cache_dir, index)
+    print('  Downloaded %s' % url)
+    return path
+
+
+def cache_entry(url: str, cache_dir: str = None) -> dict:
+    """Index entry (sha256, etag, last_modified) of the cached copy of url, or None."""
+    with _index_lock:
+        return _load_index(cache_dir or CACHE_DIR).get(url)
+
+
+def fetch_text(url: str, cache_dir: str = None, offline: bool = None) -> str:
+    """Contents of url as text, see fetch."""
+    with open(fetch(url, cache_dir, offline), encoding='utf-8') as f:
+        return f.read()
+
+
+async def fetch_async(url: str, cache_dir: str = None, offline: bool = None) -> str:
+    """fetch on the loop's default executor, for awaiting alongside other work."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, fetch, url, cache_dir, offline)
+
+
+async def fetch_all(urls: list, cache_dir: str = None, offline: bool = None) -> dict:
+    """Fetch urls concurrently.
+
+    Returns
+    -------
+    dict
+        url -> path, or the exception raised fetching it.
+    """
+    paths = await asyncio.gather(*[fetch_async(url, cache_dir, offline) for url in urls], return_exceptions=True)
+    return dict(zip(urls, paths))
+
+
+def prefetch(urls: list, cache_dir: str = None, offline: bool = None) -> concurrent.futures.Future:
+    """Start fetching urls in the background and return right away.
+
+    The fetches run on an asyncio loop in a daemon thread. Callers don't need
+    the returned future: fetch of a url that is being prefetched waits for
+    that download and returns its path, and a failed prefetch is retried
+    (and its error raised) by the first fetch that needs the url.
+
+    Returns
+    -------
+    concurrent.futures.Future
+        Resolves to the fetch_all result.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    offline = OFFLINE if offline is None else offline
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(asyncio.run(fetch_all(urls, cache_dir, offline)))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name='prefetch', daemon=True).start()
+    return future
@@ -6,30 +6,72 @@ Created on Wed Nov 17 16:55:21 2021
 """
 
 from datetime import date
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import process_nextstrain_exclude
 from datetime import date, timedelta, datetime
-
-
-def check_col_names(gisaid_df: pd.core.frame.DataFrame) -> bool:
+from functools import lru_cache
+
+# local paths
+# COUNTRY_NAME_CORRECTIONS_PATH = '../data/static/gisaid_country_name_corrections.csv'
+# KNOWN_COUNTRIES_PATH = '../data/static/country_lat_long_names.csv'
+# SUSPECT_DATE_PATH = '../data/suspect_date.csv'
+
+# domino paths
+COUNTRY_NAME_CORRECTIONS_PATH = '/mnt/data/static/gisaid_country_name_corrections.csv'
+KNOWN_COUNTRIES_PATH = '/mnt/data/static/country_lat_long_names.csv'
+SUSPECT_DATE_PATH = '/mnt/data/suspect_date.csv'
+
+# annotated columns stored as categoricals by compact_gisaid_df
+COMPACT_CATEGORICAL_COLS = ['Pango lineage', 'region', 'country', 'division',
+                            'collect_yearweek', 'submit_yearweek', 'Location']
+
+# raw country names already reported as unmatched in this run
+UNMATCHED_COUNTRY_NAMES = set()
+
+# raw metadata.tsv columns actually read by flag_suspect_sequences,
+# annotate_sequences and subset_gisaid_df; everything else in the export is
+# skipped when streaming
+METADATA_USECOLS = ['Virus name', 'Accession ID', 'Collection date',
+                    'Location', 'Sequence length', 'Host', 'Pango lineage',
+                    'Submission date', 'N-Content', 'GC-Content']
+
+# N-Content and GC-Content stay float64 so the threshold comparisons in
+# is_suspect_sequence/is_abnormal_gc_content are bit-for-bit unchanged
+METADATA_DTYPES = {'Virus name': 'object',
+                   'Accession ID': 'object',
+                   'Collection date': 'object',
+                   'Location': 'object',
+                   'Sequence length': 'float32',
+                   'Host': 'category',
+                   'Pango lineage': 'object',
+                   'Submission date': 'object',
+                   'N-Content': 'float64',
+                   'GC-Content': 'float64'}
+
+
+def check_col_names(gisaid_df: pd.core.frame.DataFrame, expected_cols=None) -> bool:
     
-    expected_cols = {'Virus name', 'Type', 'Accession ID', 'Collection date',
-                     'Location','Additional location information', 
-                     'Sequence length', 'Host',
-       'Patient age', 'Gender', 'Clade', 'Pango lineage', 'Pangolin version',
-       'Variant', 'AA Substitutions', 'Submission date', 'Is reference?',
-       'Is complete?', 'Is high coverage?', 'Is low coverage?', 'N-Content',
-       'GC-Content'}
+    # the full export header by default; frames read with usecols are checked against METADATA_USECOLS
+    if expected_cols is None:
+        expected_cols = {'Virus name', 'Type', 'Accession ID', 'Collection date',
+                         'Location','Additional location information', 
+                         'Sequence length', 'Host',
+           'Patient age', 'Gender', 'Clade', 'Pango lineage', 'Pangolin version',
+           'Variant', 'AA Substitutions', 'Submission date', 'Is reference?',
+           'Is complete?', 'Is high coverage?', 'Is low coverage?', 'N-Content',
+           'GC-Content'}
     
     observed_cols = set(gisaid_df.columns)
     
-    difference = expected_cols - observed_cols
+    difference = set(expected_cols) - observed_cols
     
-    try:
-        len(difference) == 0
+    if difference:
+        raise RuntimeError('Missing column(s): %s' % sorted(difference))
 
-    except:
-        raise RuntimeError('Missing column(s): %s' % difference)
+    return True
 
 
 def is_suspect_date(collection_date: str) -> bool:
@@ -38,9 +80,8 @@ def is_suspect_date(collection_date: str) -> bool:
     This function checks that the date is at earliest Dec. 1, 2019, at latest
     today, and formatted in the expected way (at least year-month).
     
-    TODO: read in prior metadata with this flag and pull it forward because
-    suspect dates that were once identifiable as in the future will no longer
-    be so at some later date
+    Checks one value; suspect_dates checks a whole column, and
+    SuspectDateTable carries flags forward once a future date has passed
 
     Parameters
     ----------
@@ -60,6 +101,117 @@ def is_suspect_date(collection_date: str) -> bool:
     return not legit_date
 
 
+def suspect_dates(collection_dates: pd.core.series.Series, today: date = None) -> np.ndarray:
+    """Vectorized is_suspect_date over a column.
+
+    Each distinct date string is checked once, with today computed once, and
+    the result is mapped back to the rows through the factorized codes.
+    Missing dates are suspect.
+
+    Parameters
+    ----------
+    collection_dates : pandas.core.series.Series
+        Collection date strings.
+    today : datetime.date, optional
+        Latest feasible date. Defaults to today.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array, True where is_suspect_date would be True.
+    """
+    today_str = (today or date.today()).strftime('%Y-%m-%d')
+    codes, uniques = pd.factorize(collection_dates)
+    uniques = np.asarray(uniques).astype(str)
+    legit = (np.char.str_len(uniques) == 10) & (uniques > '2019-12-01') & (uniques <= today_str)
+    return np.append(~legit, True)[codes]
+
+
+class SuspectDateTable:
+    """Accessions whose collection date was ever flagged, and when first.
+
+    Dates in the future stop looking suspect once that day has passed, so
+    every accession flagged by suspect_dates is recorded here and flagged
+    again on later runs by a bulk lookup. Kept as a csv of accession_id and
+    first_flagged, the file the R pipeline reads as suspect_date.csv.
+
+    Parameters
+    ----------
+    path : str
+        The csv. An empty table if it doesn't exist yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        table = pd.read_csv(path, dtype=str) if os.path.exists(path) else pd.DataFrame(columns=['accession_id'])
+        if 'first_flagged' not in table.columns:
+            table['first_flagged'] = np.nan
+        self.table = table[['accession_id', 'first_flagged']]
+        self.accessions = pd.Index(self.table['accession_id'])
+        self.new_rows = []
+
+    def carried_forward(self, accession_ids) -> np.ndarray:
+        """Which accessions were flagged before, as a boolean array."""
+        return self.accessions.get_indexer(accession_ids) >= 0
+
+    def record(self, accession_ids, today: date = None) -> None:
+        """Add flagged accessions not in the table yet, first flagged today."""
+        new_ids = pd.unique(np.asarray(accession_ids, dtype=object))
+        new_ids = new_ids[self.accessions.get_indexer(new_ids) < 0]
+        if len(new_ids) > 0:
+            self.new_rows.append(pd.DataFrame({'accession_id': new_ids,
+                                               'first_flagged': (today or date.today()).strftime('%Y-%m-%d')}))
+            self.accessions = self.accessions.append(pd.Index(new_ids))
+
+    def save(self) -> None:
+        """Write the table back if accessions were recorded."""
+        if len(self.new_rows) == 0:
+            return
+        self.table = pd.concat([self.table] + self.new_rows, ignore_index=True)
+        self.new_rows = []
+        self.table.to_csv(self.path + '.tmp', index=False)
+        os.replace(self.path + '.tmp', self.path)
+
+
+# tables loaded this run, by path, so every chunk records into the same one
+_suspect_date_tables = {}
+
+def load_suspect_date_table(path: str = None) -> SuspectDateTable:
+    """SuspectDateTable at path (SUSPECT_DATE_PATH by default), loaded once per run."""
+    path = path or SUSPECT_DATE_PATH
+    if path not in _suspect_date_tables:
+        _suspect_date_tables[path] = SuspectDateTable(path)
+    return _suspect_date_tables[path]
+
+def flag_abnormal_dates(gisaid_df, suspect_date_table=None, today=None):
+    """
+    Add the abnormal_date flag for a whole frame.
+
+    A row is flagged when its collection date is suspect now or its accession
+    was flagged on an earlier run. Accessions flagged now are recorded in the
+    table; call its save() once the run is done.
+
+    Parameters
+    ----------
+    gisaid_df : pd.core.frame.DataFrame
+        The dataframe containing GISAID metadata.
+    suspect_date_table : SuspectDateTable, optional
+        Defaults to load_suspect_date_table().
+    today : datetime.date, optional
+        Latest feasible date. Defaults to today.
+
+    Returns
+    -------
+    gisaid_df : pd.core.frame.DataFrame
+        The dataframe with abnormal_date added.
+
+    """
+    suspect_date_table = suspect_date_table or load_suspect_date_table()
+    suspect_now = suspect_dates(gisaid_df['Collection date'], today)
+    suspect_date_table.record(gisaid_df['Accession ID'].to_numpy()[suspect_now], today)
+    gisaid_df['abnormal_date'] = suspect_now | suspect_date_table.carried_forward(gisaid_df['Accession ID'])
+    return gisaid_df
+
 def is_suspect_sequence(gisaid_df: pd.core.frame.DataFrame) -> bool:
     """Check that sequence meets minimum quality standards.
 
@@ -106,7 +258,7 @@ def is_abnormal_gc_content(gisaid_df: pd.core.frame.DataFrame) -> bool:
     
     return ~normal
 
-def flag_suspect_sequences(gisaid_df):
+def flag_suspect_sequences(gisaid_df, exclude_sequences=None):
     """
     Generate columns with boolean flags for suspect sequences
 
@@ -114,6 +266,11 @@ def flag_suspect_sequences(gisaid_df):
     ----------
     gisaid_df : pd.core.frame.DataFrame
         The dataframe containing GISAID metadata.
+    exclude_sequences : ExcludeIndex or set, optional
+        Pre-loaded Nextstrain exclude list, so chunked callers fetch it once.
+        Loaded with load_exclude_index if not given. Not used when the
+        nextstrain_excluded column is already there, see
+        flag_nextstrain_excluded.
 
     Returns
     -------
@@ -123,68 +280,245 @@ def flag_suspect_sequences(gisaid_df):
     """
     
     # load and filter sequences on Nextstrain exclude list
-    exclude_sequences_response = process_nextstrain_exclude.load_nextstrain_exclude_sequences()
-    exclude_sequences = process_nextstrain_exclude.process_nextstrain_exclude_sequences(exclude_sequences_response)
-
-    gisaid_df['nextstrain_excluded'] = process_nextstrain_exclude.is_nextstrain_exclude_sequence(gisaid_df, exclude_sequences)
-    gisaid_df['abnormal_date'] = gisaid_df['Collection date'].apply(is_suspect_date)
+    if 'nextstrain_excluded' not in gisaid_df.columns:
+        gisaid_df = flag_nextstrain_excluded(gisaid_df, exclude_sequences)
+    if 'abnormal_date' not in gisaid_df.columns:
+        gisaid_df = flag_abnormal_dates(gisaid_df)
     gisaid_df['suspect_sequence'] = is_suspect_sequence(gisaid_df)
     gisaid_df['abnormal_GC_content'] = is_abnormal_gc_content(gisaid_df)
     
-    gisaid_df['any_abnormal'] = (gisaid_df['nextstrain_excluded'] +  \
-        gisaid_df['abnormal_date'] + gisaid_df['suspect_sequence'] +  \
-        gisaid_df['abnormal_GC_content']) > 0
+    gisaid_df['any_abnormal'] = any_abnormal(gisaid_df)
 
     return gisaid_df
 
+def flag_nextstrain_excluded(gisaid_df, exclude_sequences=None):
+    """
+    Add the nextstrain_excluded flag and drop the Virus name column.
+
+    Virus name is only read for this check, so flagging each chunk as it is
+    read means the column is never kept or sent to worker processes, and
+    matches are recorded on the index in this process.
+
+    Parameters
+    ----------
+    gisaid_df : pd.core.frame.DataFrame
+        The dataframe containing GISAID metadata.
+    exclude_sequences : ExcludeIndex or set, optional
+        Nextstrain exclude list. Loaded with load_exclude_index if not given.
+
+    Returns
+    -------
+    gisaid_df : pd.core.frame.DataFrame
+        The dataframe with nextstrain_excluded instead of Virus name.
+
+    """
+    if exclude_sequences is None:
+        exclude_sequences = process_nextstrain_exclude.load_exclude_index()
+    gisaid_df['nextstrain_excluded'] = process_nextstrain_exclude.is_nextstrain_exclude_sequence(gisaid_df, exclude_sequences)
+    return gisaid_df.drop('Virus name', axis=1)
+
+def any_abnormal(gisaid_df):
+    """
+    Combine the individual suspect sequence flags into one.
+
+    Parameters
+    ----------
+    gisaid_df : pd.core.frame.DataFrame
+        The dataframe containing GISAID metadata with flag cols added.
+
+    Returns
+    -------
+    pd.core.series.Series
+        A boolean flag, True if any of the flags is set.
+
+    """
+    return (gisaid_df['nextstrain_excluded'] +  \
+        gisaid_df['abnormal_date'] + gisaid_df['suspect_sequence'] +  \
+        gisaid_df['abnormal_GC_content']) > 0
+
 def get_weekstartdate(dt_value):
     start = dt_value - timedelta(days=dt_value.weekday())
     return start
 
+def get_weekstartdates(dt_series):
+    """
+    Monday of the week of each date, as whole-column date arithmetic.
+
+    Parameters
+    ----------
+    dt_series : pd.core.series.Series
+        datetime64 column.
+
+    Returns
+    -------
+    pd.core.series.Series
+        Same values as dt_series.apply(get_weekstartdate).
+
+    """
+    return dt_series - pd.to_timedelta(dt_series.dt.weekday, unit='D')
+
+def get_yearweeks(dt_series):
+    """
+    ISO 8601 year and week ("%G-W%V") of each date.
+
+    The string is formatted once per unique date and mapped back through the
+    factorized codes, so cost scales with the number of distinct dates rather
+    than the number of rows.
+
+    Parameters
+    ----------
+    dt_series : pd.core.series.Series
+        datetime64 column.
+
+    Returns
+    -------
+    pd.core.series.Series
+        Same values as dt_series.apply(lambda x: datetime.strftime(x, "%G-W%V")).
+
+    """
+    codes, uniques = pd.factorize(dt_series)
+    return pd.Series(take_by_codes(uniques.strftime("%G-W%V"), codes), index=dt_series.index)
+
+def split_locations(location_series):
+    """
+    Split GISAID "region / country / division / ..." locations.
+
+    Each distinct location string is split once and the parts are mapped back
+    through the factorized codes.
+
+    Parameters
+    ----------
+    location_series : pd.core.series.Series
+        The GISAID Location column.
+
+    Returns
+    -------
+    pd.core.frame.DataFrame
+        region, country and division columns, whitespace stripped. division
+        is '' when the location has no third part.
+
+    """
+    codes, uniques = pd.factorize(location_series)
+    parts = pd.Series(uniques).str.split('/', n=3, expand=True).reindex(columns=range(3)).astype(object)
+    parts = parts.apply(lambda col: col.str.strip())
+    parts[2] = parts[2].fillna('')
+
+    return pd.DataFrame({'region': take_by_codes(parts[0], codes),
+                         'country': take_by_codes(parts[1], codes),
+                         'division': take_by_codes(parts[2], codes)},
+                        index=location_series.index)
+
+def take_by_codes(values, codes):
+    # look up per-unique values by factorize codes; missing (-1) codes pick the NaN appended at the end
+    return np.append(np.asarray(values, dtype=object), np.nan)[codes]
+
 def titlecase_location(location_name, exceptions=['and', 'or', 'the', 'a', 'of', 'in', "d'Ivoire"]):
     word_list = [word if word in exceptions else word.capitalize() for word in location_name.split(' ')]
     return ' '.join(word_list)
 
-def correct_location_names(gisaid_df):
-    gisaid_df.loc[:,'country'] = gisaid_df['country'].apply(titlecase_location)
-    gisaid_df.loc[gisaid_df['country'].fillna('').str.contains('USA', case=False), 'country'] = 'United States'
-    gisaid_df.loc[gisaid_df['country'] == 'Puerto Rico', 'country'] = 'United States'
-    gisaid_df.loc[gisaid_df['country'] == 'Guam', 'country'] = 'United States'
-    gisaid_df.loc[gisaid_df['country'] == 'Northern Mariana Islands', 'country'] = 'United States'
-    gisaid_df.loc[gisaid_df['country'] == 'U.s. Virgin Islands', 'country'] = 'United States'
-    gisaid_df.loc[gisaid_df['country'] == 'Czech Republic', 'country'] = 'Czechia'
-    gisaid_df.loc[gisaid_df['country'] == 'Antigua', 'country'] = 'Antigua and Barbuda'
-    gisaid_df.loc[gisaid_df['country'] == 'Democratic Republic of the Congo', 'country'] = 'Democratic Republic of Congo'
-    gisaid_df.loc[gisaid_df['country'] == 'Republic of the Congo', 'country'] = 'Congo'
-    gisaid_df.loc[gisaid_df['country'] == 'Faroe Islands', 'country'] = 'Faeroe Islands'
-    gisaid_df.loc[gisaid_df['country'] == 'Guinea Bissau', 'country'] = 'Guinea-Bissau'
-    gisaid_df.loc[gisaid_df['country'] == 'Niogeria', 'country'] = 'Nigeria'
-    gisaid_df.loc[gisaid_df['country'] == 'Bosni and Herzegovina', 'country'] = 'Bosnia and Herzegovina'
-    gisaid_df.loc[gisaid_df['country'] == 'England', 'country'] = 'United Kingdom'
-    gisaid_df.loc[gisaid_df['country'] == 'The Bahamas', 'country'] = 'Bahamas'
+@lru_cache(maxsize=None)
+def load_country_name_corrections(corrections_path=COUNTRY_NAME_CORRECTIONS_PATH):
+    """
+    Load the GISAID -> OWID country name rules.
+
+    Parameters
+    ----------
+    corrections_path : str
+        csv with gisaid_country, country and match columns. match is 'exact'
+        for a whole-name replacement or 'contains' for a case-insensitive
+        substring match, which is checked first.
+
+    Returns
+    -------
+    tuple
+        (exact, contains): a dict of exact replacements and a tuple of
+        (lowercased substring, country) pairs.
+
+    """
+    rules = pd.read_csv(corrections_path)
+    exact_rules = rules[rules['match'] == 'exact']
+    contains_rules = rules[rules['match'] == 'contains']
+    exact = dict(zip(exact_rules['gisaid_country'], exact_rules['country']))
+    contains = tuple(zip(contains_rules['gisaid_country'].str.lower(), contains_rules['country']))
+    return exact, contains
+
+@lru_cache(maxsize=None)
+def load_known_countries(known_countries_path=KNOWN_COUNTRIES_PATH):
+    # country names that need no correction, used only to report unmatched names
+    return frozenset(pd.read_csv(known_countries_path, encoding='utf-8-sig')['Country'])
+
+@lru_cache(maxsize=None)
+def canonical_country_name(raw_name, corrections_path=COUNTRY_NAME_CORRECTIONS_PATH):
+    """
+    Canonical (OWID) name for a raw GISAID country string.
+
+    Cached per raw string, so each distinct name is resolved once per run no
+    matter how many rows or chunks it appears in.
+
+    Parameters
+    ----------
+    raw_name : str
+        Country as split from the GISAID Location.
+    corrections_path : str
+        Rules file, see load_country_name_corrections.
+
+    Returns
+    -------
+    tuple
+        (country, matched): the canonical name and whether a rule applied.
+
+    """
+    name = titlecase_location(raw_name)
+    exact, contains = load_country_name_corrections(corrections_path)
+    for pattern, country in contains:
+        if pattern in name.lower():
+            return country, True
+    if name in exact:
+        return exact[name], True
+    return name, False
+
+def correct_location_names(gisaid_df, corrections_path=None, known_countries_path=None):
+    # canonicalize the distinct country strings only and map the result back through the factorized codes.
+    # paths default to the module settings at call time, so they can be pointed elsewhere (i.e. local runs)
+    corrections_path = corrections_path or COUNTRY_NAME_CORRECTIONS_PATH
+    known_countries_path = known_countries_path or KNOWN_COUNTRIES_PATH
+    codes, uniques = pd.factorize(gisaid_df['country'])
+    canonical = [canonical_country_name(c, corrections_path) for c in uniques]
+    # plain column assignment: .loc[:, col] reads a one-row object array as a single list value
+    gisaid_df['country'] = take_by_codes([country for country, _ in canonical], codes)
+
+    # report raw names that no rule matched and that are not known country names, once per run
+    known_countries = load_known_countries(known_countries_path) | \
+        set(load_country_name_corrections(corrections_path)[0].values())
+    unmatched = sorted({raw for raw, (country, matched) in zip(uniques, canonical)
+                        if not matched and country not in known_countries} - UNMATCHED_COUNTRY_NAMES)
+    if len(unmatched) > 0:
+        print('  Unmatched country names:', unmatched)
+        UNMATCHED_COUNTRY_NAMES.update(unmatched)
     return gisaid_df
 
 def annotate_sequences(gisaid_df):
-    gisaid_df['region'] = gisaid_df.Location.apply(lambda x: x.split('/')[0].strip())
-    gisaid_df['country'] = gisaid_df.Location.apply(lambda x: x.split('/')[1].strip())
-    gisaid_df['division'] = gisaid_df.Location.apply(
-        lambda x: x.split('/')[2].strip() if len(x.split('/'))>2 else '')
+    location_parts = split_locations(gisaid_df['Location'])
+    gisaid_df['region'] = location_parts['region']
+    gisaid_df['country'] = location_parts['country']
+    gisaid_df['division'] = location_parts['division']
 
     # replace 'USA' string with 'United States' etc in location, to match OWID location name
     gisaid_df = correct_location_names(gisaid_df)
 
-    gisaid_df['collect_date'] = pd.to_datetime(gisaid_df['Collection date'])
-    gisaid_df['submit_date'] = pd.to_datetime(gisaid_df['Submission date'])
+    # partial dates (i.e. '2021-06') parse as the first of the month or year
+    gisaid_df['collect_date'] = pd.to_datetime(gisaid_df['Collection date'], format='ISO8601')
+    gisaid_df['submit_date'] = pd.to_datetime(gisaid_df['Submission date'], format='ISO8601')
 
     gisaid_df['lag_days'] = gisaid_df['submit_date'] - gisaid_df['collect_date']
     gisaid_df['lag_days'] = gisaid_df['lag_days'].dt.days.astype('int')
 
     # using ISO 8601 year and week (Monday as the first day of the week. Week 01 is the week containing Jan 4)
-    gisaid_df['collect_yearweek'] = gisaid_df['collect_date'].apply(lambda x: datetime.strftime(x, "%G-W%V"))
-    gisaid_df['submit_yearweek'] = gisaid_df['submit_date'].apply(lambda x: datetime.strftime(x, "%G-W%V"))
+    gisaid_df['collect_yearweek'] = get_yearweeks(gisaid_df['collect_date'])
+    gisaid_df['submit_yearweek'] = get_yearweeks(gisaid_df['submit_date'])
 
-    gisaid_df['collect_weekstartdate'] = gisaid_df['collect_date'].apply(get_weekstartdate)
-    gisaid_df['submit_weekstartdate'] = gisaid_df['submit_date'].apply(get_weekstartdate)
+    gisaid_df['collect_weekstartdate'] = get_weekstartdates(gisaid_df['collect_date'])
+    gisaid_df['submit_weekstartdate'] = get_weekstartdates(gisaid_df['submit_date'])
 
     return gisaid_df
 
@@ -199,14 +533,190 @@ def subset_gisaid_df(gisaid_df):
     return gisaid_df[cols]
 
 
-def process_raw_metadata(gisaid_df):
+def compact_gisaid_df(gisaid_df, report=True):
+    """
+    Convert the annotated frame to a compact schema.
+
+    Repeated strings become categoricals and lag_days the narrowest integer
+    type that holds it. The flag columns are already one byte per row and
+    are left as bool.
+
+    Parameters
+    ----------
+    gisaid_df : pd.core.frame.DataFrame
+        Output of subset_gisaid_df.
+    report : bool
+        Print bytes per column before and after.
+
+    Returns
+    -------
+    gisaid_df : pd.core.frame.DataFrame
+        The same data in the compact schema.
+
+    """
+    if report: before = gisaid_df.memory_usage(deep=True, index=False)
+
+    for col in COMPACT_CATEGORICAL_COLS:
+        gisaid_df[col] = gisaid_df[col].astype('category')
+    for int_type in ['int16', 'int32', 'int64']:
+        if gisaid_df['lag_days'].empty or (gisaid_df['lag_days'].min() >= np.iinfo(int_type).min and
+                                           gisaid_df['lag_days'].max() <= np.iinfo(int_type).max):
+            gisaid_df['lag_days'] = gisaid_df['lag_days'].astype(int_type)
+            break
+
+    if report:
+        after = gisaid_df.memory_usage(deep=True, index=False)
+        print('  Memory by column (MB, before -> after):')
+        for col in gisaid_df.columns:
+            print('    %-24s %10.1f -> %10.1f' % (col, before[col] / 1e6, after[col] / 1e6))
+        print('    %-24s %10.1f -> %10.1f' % ('total', before.sum() / 1e6, after.sum() / 1e6))
+
+    return gisaid_df
+
+def raw_cols_needed(gisaid_df):
+    # METADATA_USECOLS, less Virus name once flag_nextstrain_excluded has checked and dropped it
+    if 'nextstrain_excluded' in gisaid_df.columns:
+        return [c for c in METADATA_USECOLS if c != 'Virus name']
+    return METADATA_USECOLS
+
+def process_raw_metadata(gisaid_df, exclude_sequences=None, compact=False):
     
-    check_col_names(gisaid_df)
+    check_col_names(gisaid_df, raw_cols_needed(gisaid_df))
     
-    gisaid_df = flag_suspect_sequences(gisaid_df)
+    gisaid_df = flag_suspect_sequences(gisaid_df, exclude_sequences)
     gisaid_df = annotate_sequences(gisaid_df)
     gisaid_df = subset_gisaid_df(gisaid_df)
+    if compact: gisaid_df = compact_gisaid_df(gisaid_df)
     
     return gisaid_df
 
 
+
+
+# Nextstrain exclude set held by each worker process, set once by the pool initializer
+_worker_exclude_sequences = None
+
+def _init_worker(exclude_sequences):
+    global _worker_exclude_sequences
+    _worker_exclude_sequences = exclude_sequences
+
+def _process_partition(gisaid_df):
+    return process_raw_metadata(gisaid_df, _worker_exclude_sequences)
+
+def metadata_worker_pool(n_workers, exclude_sequences):
+    """
+    Process pool for process_raw_metadata_parallel.
+
+    The exclude set is sent to each worker once, when it starts, rather than
+    with every partition. Reuse the pool across chunks of a streamed read.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker processes.
+    exclude_sequences : set
+        Nextstrain exclude set, see process_nextstrain_exclude.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+
+    """
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                               initargs=(exclude_sequences,))
+
+def process_raw_metadata_parallel(gisaid_df, n_workers=None, exclude_sequences=None,
+                                  compact=False, pool=None, partitions_per_worker=4):
+    """
+    process_raw_metadata over row partitions in a process pool.
+
+    Every step of process_raw_metadata works row by row, so the rows are split
+    into contiguous partitions, processed independently and concatenated back
+    in input order. The result is the same as process_raw_metadata.
+
+    Parameters
+    ----------
+    gisaid_df : pd.core.frame.DataFrame
+        The dataframe containing GISAID metadata.
+    n_workers : int, optional
+        Worker processes. Defaults to the number of CPUs; 1 runs in process.
+    exclude_sequences : ExcludeIndex or set, optional
+        Nextstrain exclude list. Loaded once here if not given, and checked
+        here before the rows are split so workers never see Virus name.
+    compact : bool
+        Apply compact_gisaid_df to the combined result.
+    pool : concurrent.futures.ProcessPoolExecutor, optional
+        Pool from metadata_worker_pool to reuse. A pool is started and shut
+        down here if not given.
+    partitions_per_worker : int
+        Partitions per worker, so uneven partitions still balance.
+
+    Returns
+    -------
+    gisaid_df : pd.core.frame.DataFrame
+        The filtered and annotated metadata.
+
+    """
+    check_col_names(gisaid_df, raw_cols_needed(gisaid_df))
+    if exclude_sequences is None:
+        exclude_sequences = process_nextstrain_exclude.load_exclude_index()
+    if 'nextstrain_excluded' not in gisaid_df.columns:
+        gisaid_df = flag_nextstrain_excluded(gisaid_df, exclude_sequences)
+    # dates are checked here too, so suspect accessions are recorded in this process's table
+    if 'abnormal_date' not in gisaid_df.columns:
+        gisaid_df = flag_abnormal_dates(gisaid_df)
+    n_workers = n_workers or os.cpu_count()
+    if n_workers == 1 and pool is None:
+        return process_raw_metadata(gisaid_df, exclude_sequences, compact=compact)
+
+    bounds = np.linspace(0, gisaid_df.shape[0], n_workers * partitions_per_worker + 1).astype(int)
+    partitions = [gisaid_df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+    if len(partitions) == 0:
+        return process_raw_metadata(gisaid_df, exclude_sequences, compact=compact)
+
+    if pool is None:
+        with metadata_worker_pool(n_workers, exclude_sequences) as own_pool:
+            results = list(own_pool.map(_process_partition, partitions))
+    else:
+        results = list(pool.map(_process_partition, partitions))
+
+    gisaid_df = pd.concat(results)
+    if compact: gisaid_df = compact_gisaid_df(gisaid_df)
+    return gisaid_df
+
+def read_metadata_chunks(metadata_path, chunksize=500000):
+    """
+    Stream the GISAID metadata export in bounded row chunks.
+
+    The header is checked once against the full expected column set, then
+    only METADATA_USECOLS are parsed with the compact METADATA_DTYPES so that
+    peak memory is set by chunksize rather than by the size of the export.
+
+    Parameters
+    ----------
+    metadata_path : str
+        Path to the tab-separated GISAID metadata.tsv.
+    chunksize : int
+        Number of rows per chunk.
+
+    Returns
+    -------
+    reader : pandas.io.parsers.TextFileReader
+        Iterator of raw metadata chunks. The row index runs on across chunks
+        so concatenated output matches a single full read.
+
+    Raises
+    ------
+    RuntimeError
+        If the header is missing any expected column.
+
+    """
+    header_df = pd.read_csv(metadata_path, sep='\t', nrows=0)
+    check_col_names(header_df)
+
+    reader = pd.read_csv(metadata_path, sep='\t',
+                         usecols=METADATA_USECOLS,
+                         dtype=METADATA_DTYPES,
+                         chunksize=chunksize)
+
+    return reader
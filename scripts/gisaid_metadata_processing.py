@@ -22,13 +22,76 @@ Filters for future consideration (not doing these yet):
     
 """
 
+import argparse
 import datetime
+import hashlib
+import os
+import tempfile
+from contextlib import ExitStack, nullcontext
 from datetime import date, timedelta
 import sys
 import numpy as np
 import pandas as pd
 import requests
-from filter_gisaid_metadata import process_raw_metadata, get_weekstartdate
+import columnar_io
+from aggregate_cube import AggregateCube
+import fetch_cache
+import filter_gisaid_metadata
+import metadata_state_store
+import parse_cache
+import process_nextstrain_exclude
+import stage_cache
+from snapshot_store import SnapshotBuilder, SnapshotStore
+from spill_partitions import SpillPartitions, partitions_for_budget
+from run_metrics import RunMetrics, PROFILERS
+from filter_gisaid_metadata import process_raw_metadata, process_raw_metadata_parallel, metadata_worker_pool, \
+    get_weekstartdates, get_yearweeks, \
+    read_metadata_chunks, flag_abnormal_dates, load_suspect_date_table, any_abnormal, compact_gisaid_df, \
+    take_by_codes
+from lineage_index import LineageIndex, LineageGroups, map_labels
+from lag_histograms import LagHistogram
+from location_rollup import LocationRollup, CONTINENT_LEVEL, WHO_REGION_LEVEL, GLOBAL_LEVEL
+from date_country_grid import DateCountryGrid, take_or_nan
+
+##############################################################################################
+######################################   Paths    ############################################
+##############################################################################################
+
+# local paths
+# METADATA_PATH = '../data/raw/metadata.tsv'
+# PROCESSED_DIR = '../data/processed'
+
+# domino paths
+METADATA_PATH = '/domino/datasets/local/metadata/metadata.tsv'
+PROCESSED_DIR = '/mnt/data/processed'
+
+CLEAN_METADATA_PATH = PROCESSED_DIR + '/inital_clean_metadata.csv'
+CLEANING_OUTPUT_PATH = PROCESSED_DIR + '/gisaid_cleaning_output.csv'
+STATE_DIR = PROCESSED_DIR + '/incremental_state'
+LINEAGE_COUNTS_PATH = PROCESSED_DIR + '/gisaid_lineage_counts.csv'
+# Nextstrain exclude entries matched by this run's sequences, and one line per run with the list version
+EXCLUDE_MATCHES_PATH = PROCESSED_DIR + '/nextstrain_exclude_matches.csv'
+EXCLUDE_HISTORY_PATH = PROCESSED_DIR + '/nextstrain_exclude_history.jsonl'
+# per-stage timings of every run, as JSON lines
+METRICS_PATH = PROCESSED_DIR + '/run_metrics.jsonl'
+# temporary partition files of --out-of-core runs
+SPILL_DIR = PROCESSED_DIR + '/spill'
+# per-accession snapshots of --snapshot runs and the count changes since the previous run
+SNAPSHOT_DIR = PROCESSED_DIR + '/snapshots'
+SEQUENCE_CHANGES_PATH = PROCESSED_DIR + '/sequence_count_changes.csv'
+# day x location x lineage group prefix sums of the cleaning output, see aggregate_cube.py
+CUBE_PATH = PROCESSED_DIR + '/gisaid_cube.npz'
+
+CLEAN_METADATA_COLS = ['collect_date', 'submit_date', 'any_abnormal', 'country', 'Pango lineage']
+
+# 'csv', 'parquet' or 'both'; parquet outputs are written next to the csv paths as partitioned datasets
+OUTPUT_FORMAT = 'csv'
+# partition parquet outputs by collection 'week' or by 'country'
+PARTITION_BY = 'week'
+# read metadata.tsv through the memory-mapped parse cache in parse_cache.PARSE_CACHE_DIR
+PARSE_CACHE = False
+# 'wide' pivots lineage counts into columns; 'long' keeps them as rows, also written to LINEAGE_COUNTS_PATH
+LINEAGE_LAYOUT = 'wide'
 
 ##############################################################################################
 ####################   Designate variants for breakout columns    ############################
@@ -75,37 +138,49 @@ lineage_replace_dict = {
     'B.1.429':'B.1.427/429',   
 }
 
+# measures of the aggregate cube: the greek groups plus total and other sequences
+CUBE_LINEAGE_GROUPS = dict(greek_dict, **{'All lineages': ['All lineages'], 'Other lineages': ['Other lineages']})
+
 ##############################################################################################
 ######################################   GISAID data load    #################################
 ##############################################################################################
 
 def find_lineages(input_pango, search_pango):
     # retrieve the pango lineages that exist in the latest gisaid set including sublineages wildcarded with *, i.e. "AY.*"
-    match_list = sorted(set(search_pango) & set(input_pango))
-    print('  Matched these lineages:', match_list)
-    wildcards = [c for c in input_pango if '*' in c]
-    wildcard_res = []
-    for w in wildcards:
-        res = [c for c in set(search_pango) if w.replace('*','') == str(c)[:len(w)-1]]
-        print(f'  Found {w}:',sorted(res))
-        wildcard_res += res
-    not_found = set(input_pango)-set(wildcards)-set(match_list)
-    if len(not_found)>0: print('  Not found:', not_found)
-    return sorted(match_list+wildcard_res)
+    return LineageIndex(search_pango).find(input_pango)
 
 def aggregate_with_lineage(gisaid_df):
+    # observed=True keeps compact (categorical) columns from expanding into every category combination
     country_variants_df = gisaid_df.groupby(
-        ['collect_date','collect_yearweek','collect_weekstartdate','country','Pango lineage']).count()[['Accession ID']].reset_index()
-    # find pango lineages that are actually present in gisaid metadata, including wildcards
-    key_variants = find_lineages(vocs + vois + other_important, gisaid_df['Pango lineage'].unique())
+        ['collect_date','collect_yearweek','collect_weekstartdate','country','Pango lineage'], observed=True).count()[['Accession ID']].reset_index()
+    all_sequences = gisaid_df.groupby(
+        ['collect_date','collect_yearweek','collect_weekstartdate','country'], observed=True).count()[['Accession ID']].reset_index()
+    return label_key_lineages(decategorize(country_variants_df), decategorize(all_sequences), gisaid_df['Pango lineage'].unique())
+
+VARIANT_KEYS = ['collect_date','collect_yearweek','collect_weekstartdate','country','Pango lineage']
+
+def lineage_count_parts(gisaid_counts_df):
+    # sequences per (date, country, lineage) and per (date, country), from partial counts
+    country_variants_df = decategorize(gisaid_counts_df.groupby(
+        VARIANT_KEYS, observed=True)[['accession_count']].sum().reset_index())
+    all_sequences = decategorize(gisaid_counts_df.groupby(
+        VARIANT_KEYS[:-1], observed=True)[['accession_count']].sum().reset_index())
+    country_variants_df.rename(columns={'accession_count':'Accession ID'}, inplace=True)
+    all_sequences.rename(columns={'accession_count':'Accession ID'}, inplace=True)
+    return country_variants_df, all_sequences
+
+def aggregate_with_lineage_from_counts(gisaid_counts_df):
+    # same output as aggregate_with_lineage, but built from the partial counts accumulated by stream_process_metadata
+    country_variants_df, all_sequences = lineage_count_parts(gisaid_counts_df)
+    return label_key_lineages(country_variants_df, all_sequences, gisaid_counts_df['Pango lineage'].unique())
+
+def label_key_lineages(country_variants_df, all_sequences, lineages):
+    # find pango lineages that are actually present in gisaid metadata, including wildcards, and compile them
+    # to their column labels, manually combining lineages, i.e. B.1.427 and B.1.429 under B.1.427/429
+    key_labels = LineageIndex(lineages).compile_labels(vocs + vois + other_important, lineage_replace_dict)
     # label these lineages of interest for breaking out into cols
-    country_variants_df['key_lineages'] = country_variants_df['Pango lineage'].apply(
-        lambda x: x if x in key_variants else 'Other lineages')
-    # manually combine lineages, i.e. B.1.427 and B.1.429 under B.1.427/429
-    country_variants_df['key_lineages'].replace(lineage_replace_dict, inplace=True)
+    country_variants_df['key_lineages'] = map_labels(country_variants_df['Pango lineage'], key_labels, 'Other lineages')
     
-    all_sequences = gisaid_df.groupby(
-        ['collect_date','collect_yearweek','collect_weekstartdate','country']).count()[['Accession ID']].reset_index()
     all_sequences['key_lineages'] = 'All lineages'
     country_variants_df = pd.concat([country_variants_df, all_sequences], sort=True)
  
@@ -113,29 +188,271 @@ def aggregate_with_lineage(gisaid_df):
     country_variants_df.columns = ['_'.join(c.lower().split()) for c in country_variants_df.columns]
     return country_variants_df
 
-def calc_lagstats(gisaid_df, group_cols=['collect_date','country']):
-    # precalculate summary stats about lag time from date_collect to date_submit for all filtered sequences per day and country
-    def q1(x): return x.quantile(0.25)
-    def q3(x): return x.quantile(0.75)
-    sumstats_df = gisaid_df.groupby(group_cols).agg({'lag_days':['count','median','min','max',q1,q3]}).reset_index()
-    sumstats_df.rename(columns={'count':'seq_count',
-                       'median':'gisaid_lagdays_median',
-                       'q1':'gisaid_lagdays_q1',
-                       'q3':'gisaid_lagdays_q3',
-                       'min':'gisaid_lagdays_min',
-                       'max':'gisaid_lagdays_max',
-                       'lag_days':'',
-                       }, inplace=True)
-    sumstats_df.columns = sumstats_df.columns.map(''.join)
+# keys of the lag stats merged into the country rows, and of the lag histogram kept by incremental runs
+LAG_GROUP_COLS = ['collect_date','country']
+
+def calc_lagstats(gisaid_df, group_cols=LAG_GROUP_COLS):
+    # precalculate summary stats about lag time from date_collect to date_submit for all filtered sequences per day and country.
+    # counts per (group, lag_days) are enough for exact quantiles, so no python function runs per group
+    return lagstats_from_histogram(LagHistogram.from_sequences(gisaid_df, group_cols))
+
+def calc_lagstats_from_counts(gisaid_counts_df, group_cols=LAG_GROUP_COLS, count_col='row_count'):
+    # same output as calc_lagstats, computed from (group, lag_days) -> count rows instead of one row per sequence
+    return lagstats_from_histogram(LagHistogram(gisaid_counts_df, group_cols, count_col))
+
+def lagstats_from_histogram(lag_histogram):
+    return widen_lagstats(decategorize(lag_histogram.stats()))
+
+def decategorize(df):
+    # aggregate outputs go back to the plain dtype of their values (object, or str with newer pandas) so merges
+    # and csv output don't depend on the compact schema
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+def widen_lagstats(sumstats_df):
+    # min/max keep lag_days' dtype, which is narrower than int64 in the compact schema
+    for col in ['gisaid_lagdays_min', 'gisaid_lagdays_max']:
+        sumstats_df[col] = sumstats_df[col].astype('int64')
     return sumstats_df
 
+def parquet_path(csv_path):
+    return csv_path[:-len('.csv')] + '.parquet' if csv_path.endswith('.csv') else csv_path + '.parquet'
+
+def write_clean_metadata(gisaid_df, clean_path=CLEAN_METADATA_PATH, append=False):
+    # the filtered per-sequence subset read by the R scripts, as csv and/or partitioned parquet
+    gisaid_df_subset = gisaid_df[CLEAN_METADATA_COLS]
+    if OUTPUT_FORMAT in ('csv', 'both'):
+        gisaid_df_subset.to_csv(clean_path, mode='a' if append else 'w', header=not append)
+    if OUTPUT_FORMAT in ('parquet', 'both'):
+        columnar_io.write_partitioned_parquet(gisaid_df_subset, parquet_path(clean_path), PARTITION_BY,
+                                              date_col='collect_date', location_cols=['country'], append=append)
+
+def write_cleaning_output(merged_pivoted_df, output_path=CLEANING_OUTPUT_PATH):
+    # csv stays available for Flourish
+    if OUTPUT_FORMAT in ('csv', 'both'):
+        merged_pivoted_df.to_csv(output_path)
+    if OUTPUT_FORMAT in ('parquet', 'both'):
+        columnar_io.write_partitioned_parquet(merged_pivoted_df, parquet_path(output_path), PARTITION_BY,
+                                              date_col='gisaid_collect_date',
+                                              location_cols=['gisaid_country', 'aggregate_location'])
+
+def write_aggregate_cube(merged_pivoted_df, cube_path=CUBE_PATH):
+    # prefix sums per day, location and lineage group, so consumers can total any date range from two lookups
+    AggregateCube.from_frame(merged_pivoted_df, CUBE_LINEAGE_GROUPS).save(cube_path)
+
+def worker_pool(n_workers, exclude_sequences):
+    # process pool shared by all chunks of a streamed read, or nothing when running in process
+    return metadata_worker_pool(n_workers, exclude_sequences) if n_workers > 1 else nullcontext()
+
+COUNT_COLS = ['collect_date','collect_yearweek','collect_weekstartdate','country','Pango lineage','lag_days']
+
+def count_sequences(gisaid_df):
+    # reduce annotated sequences to counts per (collect date, week, country, lineage, lag days),
+    # which is all aggregate_with_lineage and calc_lagstats need. NaN keys are kept so no rows are lost
+    return gisaid_df.groupby(COUNT_COLS, dropna=False, observed=True).agg(
+        accession_count=('Accession ID', 'count'), row_count=('Accession ID', 'size')).reset_index()
+
+def combine_sequence_counts(counts_list):
+    # add up partial counts; groups whose rows have all been subtracted away are dropped
+    gisaid_counts_df = pd.concat(counts_list).groupby(
+        COUNT_COLS, dropna=False, observed=True)[['accession_count','row_count']].sum().reset_index()
+    return gisaid_counts_df[gisaid_counts_df['row_count'] != 0].reset_index(drop=True)
+
+def metadata_chunks(metadata_path, chunksize):
+    # raw chunks of the export, sliced from the parse cache snapshot when it is enabled
+    if PARSE_CACHE:
+        return parse_cache.read_cached_metadata_chunks(metadata_path, parse_cache.PARSE_CACHE_DIR, chunksize)
+    return read_metadata_chunks(metadata_path, chunksize=chunksize)
+
+def metadata_chunks_with_exclude_index(metadata_path, chunksize, n_workers):
+    # (chunk, exclude index, worker pool) for each raw chunk. The exclude index is loaded, and the pool started with it,
+    # only once the first chunk has been read, so with --async-fetch the exclude list download overlaps that read
+    exclude_sequences = None
+    with ExitStack() as stack:
+        for chunk in metadata_chunks(metadata_path, chunksize):
+            if exclude_sequences is None:
+                exclude_sequences = process_nextstrain_exclude.load_exclude_index()
+                pool = stack.enter_context(worker_pool(n_workers, exclude_sequences))
+            yield chunk, exclude_sequences, pool
+
+def stream_process_metadata(metadata_path=METADATA_PATH, clean_path=CLEAN_METADATA_PATH, chunksize=500000, compact=False,
+                            n_workers=1, spill=None, snapshot=None):
+    # read, filter and annotate metadata.tsv chunk by chunk so peak memory depends on chunksize rather than export size.
+    # each processed chunk is appended to the clean metadata csv and reduced to sequence counts, which are either
+    # combined in memory or, given a SpillPartitions, written to its partitions (and None returned for the counts).
+    # a SnapshotBuilder, if given, collects each chunk's per-accession key columns
+    gisaid_counts_df = None
+    gisaid_cols = None
+    submit_date_maxes = []
+    n_sequences = 0
+    # one worker pool for all chunks when running in parallel
+    for i, (chunk, exclude_sequences, pool) in enumerate(metadata_chunks_with_exclude_index(metadata_path, chunksize, n_workers)):
+        chunk = process_raw_metadata_parallel(chunk, n_workers, exclude_sequences, pool=pool)
+        # memory report for the first chunk only
+        if compact: chunk = compact_gisaid_df(chunk, report=(i == 0))
+        if gisaid_cols is None: gisaid_cols = list(chunk.columns)
+        write_clean_metadata(chunk, clean_path, append=(i > 0))
+        if snapshot is not None: snapshot.add(chunk)
+
+        chunk_counts = count_sequences(chunk)
+        if spill is not None:
+            spill.add(chunk_counts)
+        else:
+            if gisaid_counts_df is not None:
+                chunk_counts = combine_sequence_counts([gisaid_counts_df, chunk_counts])
+            gisaid_counts_df = chunk_counts
+
+        submit_date_maxes.append(chunk['submit_date'].max())
+        n_sequences += chunk.shape[0]
+        if spill is not None:
+            print('  chunk %d: %d sequences so far, %.1f MB spilled' % (i, n_sequences, sum(spill.bytes) / 1e6))
+        else:
+            print('  chunk %d: %d sequences so far, %d count rows' % (i, n_sequences, gisaid_counts_df.shape[0]))
+
+    return gisaid_counts_df, gisaid_cols, pd.Series(submit_date_maxes).max()
+
+def out_of_core_process_metadata(metadata_path=METADATA_PATH, clean_path=CLEAN_METADATA_PATH, chunksize=500000,
+                                 compact=False, n_workers=1, spill_dir=SPILL_DIR, memory_budget_mb=4000, snapshot=None):
+    # stream_process_metadata with each chunk's counts hash-partitioned by (country, week) into spill files, then
+    # the lineage counts and lag stats computed one partition at a time. Every (date, country) group lies in a single
+    # partition, so concatenating the partition results in key order gives exactly the in-memory outputs
+    n_partitions = partitions_for_budget(os.path.getsize(metadata_path), memory_budget_mb * 1e6)
+    print('  Spilling counts to %d partitions' % n_partitions)
+    variants, totals, sumstats, lineages = [], [], [], set()
+    with SpillPartitions(spill_dir, n_partitions) as spill:
+        _, gisaid_cols, max_gisaid_date = stream_process_metadata(
+            metadata_path, clean_path, chunksize=chunksize, compact=compact, n_workers=n_workers, spill=spill,
+            snapshot=snapshot)
+        for part_counts in spill.partitions():
+            part_counts = combine_sequence_counts([part_counts])
+            country_variants_df, all_sequences = lineage_count_parts(part_counts)
+            variants.append(country_variants_df)
+            totals.append(all_sequences)
+            sumstats.append(calc_lagstats_from_counts(part_counts))
+            lineages.update(part_counts['Pango lineage'].dropna().unique())
+
+    country_variants_df = decategorize(pd.concat(variants)).sort_values(VARIANT_KEYS, ignore_index=True)
+    all_sequences = decategorize(pd.concat(totals)).sort_values(VARIANT_KEYS[:-1], ignore_index=True)
+    sumstats_df = decategorize(pd.concat(sumstats)).sort_values(LAG_GROUP_COLS, ignore_index=True)
+    return label_key_lineages(country_variants_df, all_sequences, list(lineages)), sumstats_df, gisaid_cols, max_gisaid_date
+
+def incremental_process_metadata(metadata_path=METADATA_PATH, clean_path=CLEAN_METADATA_PATH,
+                                 state_dir=STATE_DIR, chunksize=500000, full_rebuild=False, n_workers=1):
+    # only run process_raw_metadata on accessions that are new or whose raw metadata changed since the last run,
+    # and patch the persisted sequence counts by subtracting the old rows and adding the reprocessed ones.
+    # flags that depend on things other than the row itself (Nextstrain exclude list, today's date) are
+    # refreshed over the whole stored state so the result matches a full rebuild
+
+    # stored rows are only reused if they were annotated with the current country name rules and code
+    annotations = metadata_state_store.annotation_version()
+    state = None if full_rebuild else metadata_state_store.load_state(state_dir)
+    if state is None:
+        print('  No stored state, processing all sequences')
+    elif state[2].get('annotations') != annotations:
+        print('  Country name rules or annotation code changed since the %s run, processing all sequences' % state[2]['run_date'])
+        state = None
+    if state is not None:
+        state_df, state_counts_df, state_meta = state
+        if 'Virus name' in state_df.columns:
+            # states written before the exclude index kept the names themselves
+            state_df['virus_hash'] = process_nextstrain_exclude.hash_virus_names(state_df.pop('Virus name'))
+        print('  Loaded state from %s run: %d sequences' % (state_meta['run_date'], state_df.shape[0]))
+        known_hashes = pd.Index(state_df['raw_hash'])
+
+    # the raw hash covers every column read from the export, Accession ID included, so a row is
+    # unchanged exactly when its hash is already in the state
+    raw_keys = []
+    processed = []
+    for chunk, exclude_sequences, pool in metadata_chunks_with_exclude_index(metadata_path, chunksize, n_workers):
+        chunk_keys = pd.DataFrame({'Accession ID': chunk['Accession ID'],
+                                   'raw_hash': metadata_state_store.hash_raw_rows(chunk)})
+        raw_keys.append(chunk_keys)
+        if state is None:
+            todo = np.ones(chunk.shape[0], dtype=bool)
+        else:
+            todo = known_hashes.get_indexer(chunk_keys['raw_hash']) < 0
+        if todo.any():
+            chunk_processed = process_raw_metadata_parallel(chunk[todo].copy(), n_workers, exclude_sequences, pool=pool)
+            chunk_processed['virus_hash'] = process_nextstrain_exclude.hash_virus_names(chunk.loc[todo, 'Virus name'])
+            chunk_processed['raw_hash'] = chunk_keys.loc[todo, 'raw_hash']
+            processed.append(chunk_processed)
+    exclude_sequences = process_nextstrain_exclude.load_exclude_index()
+    raw_keys = pd.concat(raw_keys)
+    if raw_keys['Accession ID'].duplicated().any():
+        raise RuntimeError('Accession IDs in %s are not unique, run without --incremental' % metadata_path)
+
+    if state is None:
+        state_df = pd.concat(processed)
+        gisaid_counts_df = count_sequences(state_df)
+        lag_histogram = LagHistogram.from_sequences(state_df, LAG_GROUP_COLS)
+    else:
+        processed_df = pd.concat(processed) if processed else state_df.iloc[:0]
+        # rows that left the export or were reprocessed are dropped from the state and their counts subtracted
+        keep = state_df['raw_hash'].isin(raw_keys['raw_hash'])
+        print('  %d new or changed sequences, %d removed, %d unchanged' % (
+            processed_df.shape[0], (~state_df['Accession ID'].isin(raw_keys['Accession ID'])).sum(), keep.sum()))
+        dropped_counts = count_sequences(state_df[~keep])
+        dropped_counts[['accession_count','row_count']] *= -1
+        gisaid_counts_df = combine_sequence_counts([state_counts_df, dropped_counts, count_sequences(processed_df)])
+        # states written before lag histograms were kept get one from their counts
+        lag_histogram = metadata_state_store.load_lag_histogram(state_dir, LAG_GROUP_COLS) or \
+            LagHistogram(state_counts_df, LAG_GROUP_COLS)
+        lag_histogram = lag_histogram.merge(LagHistogram.from_sequences(state_df[~keep], LAG_GROUP_COLS), subtract=True)
+        lag_histogram = lag_histogram.merge(LagHistogram.from_sequences(processed_df, LAG_GROUP_COLS))
+        state_df = pd.concat([state_df[keep], processed_df])
+
+    # put the state back in export order, indexed by row position like a full read
+    position = pd.Series(raw_keys.index, index=raw_keys['Accession ID'])
+    state_df.index = state_df['Accession ID'].map(position).to_numpy()
+    state_df.sort_index(inplace=True)
+
+    state_df['nextstrain_excluded'] = exclude_sequences.contains_hashes(state_df['virus_hash'].to_numpy())
+    # dates are rechecked over the whole state in one vectorized pass; ones that were in the future
+    # and have since passed stay flagged through the suspect date table
+    state_df = flag_abnormal_dates(state_df)
+    state_df['any_abnormal'] = any_abnormal(state_df)
+
+    gisaid_cols = [c for c in state_df.columns if c not in metadata_state_store.STATE_EXTRA_COLS]
+    write_clean_metadata(state_df, clean_path)
+    metadata_state_store.save_state(state_dir, state_df, gisaid_counts_df, lag_histogram, annotations)
+
+    return gisaid_counts_df, gisaid_cols, state_df['submit_date'].max()
+
+def verify_incremental(metadata_path=METADATA_PATH, clean_path=CLEAN_METADATA_PATH, state_dir=STATE_DIR, chunksize=500000,
+                       n_workers=1):
+    # run the incremental update against a copy of the stored state, then a full rebuild, and check they agree
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        incremental_state_dir = metadata_state_store.copy_state(state_dir, tmp_dir + '/state')
+        incremental_counts_df, _, _ = incremental_process_metadata(
+            metadata_path, tmp_dir + '/clean.csv', incremental_state_dir, chunksize=chunksize, n_workers=n_workers)
+        incremental_state_df = metadata_state_store.load_state(incremental_state_dir)[0]
+        incremental_lag_histogram = metadata_state_store.load_lag_histogram(incremental_state_dir, LAG_GROUP_COLS)
+        full_counts_df, gisaid_cols, max_gisaid_date = incremental_process_metadata(
+            metadata_path, clean_path, state_dir, chunksize=chunksize, full_rebuild=True, n_workers=n_workers)
+        full_state_df = metadata_state_store.load_state(state_dir)[0]
+
+    sort_counts = lambda df: df.sort_values(COUNT_COLS).reset_index(drop=True)
+    pd.testing.assert_frame_equal(sort_counts(incremental_counts_df), sort_counts(full_counts_df))
+    pd.testing.assert_frame_equal(incremental_state_df, full_state_df[incremental_state_df.columns])
+    pd.testing.assert_frame_equal(incremental_lag_histogram.counts_df,
+                                  metadata_state_store.load_lag_histogram(state_dir, LAG_GROUP_COLS).counts_df)
+    print('  Incremental state matches full rebuild')
+    return full_counts_df, gisaid_cols, max_gisaid_date
+
 ##############################################################################################
 ######################################   OWID data load    ###################################
 ##############################################################################################
 
+# downloads the run needs, prefetched with --async-fetch
+REMOTE_INPUTS = [fetch_cache.NEXTSTRAIN_EXCLUDE_URL, fetch_cache.OWID_URL]
+
 def load_owid_df():
-    url = 'https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.csv'
-    owid_df = pd.read_csv(url, parse_dates=['date'])
+    return prepare_owid_df(pd.read_csv(fetch_cache.fetch(fetch_cache.OWID_URL), parse_dates=['date']))
+
+def prepare_owid_df(owid_df):
+    # country-level OWID cases, population and daily vax changes from the raw owid-covid-data.csv frame
     owid_df.sort_values(['location','date'], ascending=True, inplace=True)
     # only keep data after Dec 2019
     owid_df = owid_df[owid_df['date']>='2019-12-01']
@@ -159,10 +476,11 @@ def load_owid_df():
     owid_cols = ['date','location','iso_code','continent','new_cases','new_cases_smoothed','population','people_vaccinated','people_fully_vaccinated']
     owid_df = owid_df[owid_cols]
     
-    # add vax columns calculating the daily change in people vaccinated to roll up into weekly sums
-    for loc in owid_df.location.unique():
-        owid_df.loc[owid_df['location']==loc,'new_people_vaccinated'] = owid_df[owid_df['location']==loc]['people_vaccinated'].ffill().fillna(0).diff()
-        owid_df.loc[owid_df['location']==loc,'new_people_fully_vaccinated'] = owid_df[owid_df['location']==loc]['people_fully_vaccinated'].ffill().fillna(0).diff()        
+    # add vax columns calculating the daily change in people vaccinated to roll up into weekly sums.
+    # one grouped pass per column over the location/date sorted frame: ffill within location, 0 before the first report, then diff
+    for col in ['people_vaccinated', 'people_fully_vaccinated']:
+        filled = owid_df.groupby('location', sort=False)[col].ffill().fillna(0)
+        owid_df['new_' + col] = filled.groupby(owid_df['location'], sort=False).diff()
 
     owid_df.columns = ['owid_%s' % x for x in owid_df.columns]
     
@@ -173,6 +491,9 @@ def load_owid_df():
 ##################################      Merge and pivot data   ###############################
 ##############################################################################################
 
+# reference code: merge_gisaid_owid and pivot_merged_df are the outer-merge join that pivot_gisaid_owid replaced.
+# main() doesn't call them; they are kept as the baseline benchmark_pipeline.py times and tests/test_date_country_grid.py
+# checks the grid join against, so change them only together with that join
 def merge_gisaid_owid(country_variants_df, owid_df):    
     merged_df = pd.merge(country_variants_df, owid_df,
         how='outer',
@@ -191,6 +512,7 @@ def merge_gisaid_owid(country_variants_df, owid_df):
     return merged_df
 
 def pivot_merged_df(merged_df):
+  # reference code, see merge_gisaid_owid
   # # add a placeholder in order to pivot on key_lineages and not drop empty collect_date rows
     merged_df['key_lineages'] = merged_df['key_lineages'].fillna('placeholder_dropmeplease')
     
@@ -202,7 +524,7 @@ def pivot_merged_df(merged_df):
     country_variants_pivot = country_variants_pivot[['collect_date','country','placeholder_dropmeplease','All lineages']+sorted([c for c in country_variants_pivot.columns if '.' in c])+['Other lineages']]
 
     # merge in owid cases columns which are date-dependent
-    cols = ['owid_location', 'owid_date', 'owid_new_cases', 'owid_new_cases_smoothed','owid_new_people_vaccinated','owid_new_people_fully_vaccinated']
+    cols = OWID_DATE_COLS
     country_variants_all_lineages = merged_df[
         merged_df['key_lineages'].isin(['All lineages','placeholder_dropmeplease'])][cols]
     country_variants_pivot = pd.merge(
@@ -231,17 +553,130 @@ def pivot_merged_df(merged_df):
         ['owid_date','owid_location'], ascending=[True, True], inplace=True)
 
     # fill out the yearweek and weekstartdate missing value
-    country_variants_pivot['collect_yearweek'] = country_variants_pivot['collect_date'].apply(lambda x: datetime.datetime.strftime(x, "%G-W%V"))
-    country_variants_pivot['collect_weekstartdate'] = country_variants_pivot['collect_date'].apply(get_weekstartdate)
+    country_variants_pivot['collect_yearweek'] = get_yearweeks(country_variants_pivot['collect_date'])
+    country_variants_pivot['collect_weekstartdate'] = get_weekstartdates(country_variants_pivot['collect_date'])
 
     country_variants_pivot.drop('placeholder_dropmeplease', axis=1, inplace=True)
 
     return country_variants_pivot
 
+# owid cases columns which are date-dependent, as attached by pivot_merged_df
+OWID_DATE_COLS = ['owid_location', 'owid_date', 'owid_new_cases', 'owid_new_cases_smoothed','owid_new_people_vaccinated','owid_new_people_fully_vaccinated']
+
+def lineage_column_order(labels):
+    # key lineage labels in the column order of the wide table
+    labels = set(labels)
+    return [c for c in ['All lineages'] if c in labels] + sorted([c for c in labels if '.' in c]) + \
+           [c for c in ['Other lineages'] if c in labels]
+
+def grid_owid_keys(grid, gisaid_cells, owid_df):
+    # one row per (date, country) cell with GISAID or OWID data, in (collect_date, country) order, with the cell's
+    # OWID date columns and the country's OWID location, continent and population, as pivot_merged_df attaches them.
+    # the OWID row of each cell and of each country is found by indexing per-cell / per-country lookups
+    owid_cells = grid.cells(owid_df['owid_date'], owid_df['owid_location'])
+    key_cells = grid.occupied(gisaid_cells, owid_cells)
+    owid_rows = grid.row_lookup(owid_cells)[key_cells]
+
+    keys_df = pd.DataFrame({'collect_date': grid.cell_dates(key_cells), 'country': grid.cell_countries(key_cells)})
+    for col in OWID_DATE_COLS:
+        if col != 'owid_location':
+            keys_df[col] = take_or_nan(owid_df[col].to_numpy(), owid_rows)
+    # a matched cell's owid_date is its collect_date, and unmatched ones are filled with it
+    keys_df['owid_date'] = keys_df['collect_date']
+
+    # owid population regardless of date
+    population_df = owid_df[['owid_location', 'owid_continent', 'owid_population']].drop_duplicates()
+    if population_df['owid_location'].is_unique:
+        country_rows = np.full(grid.n_countries, -1, dtype='int64')
+        country_rows[grid.country_codes(population_df['owid_location'])] = np.arange(population_df.shape[0])
+        rows = country_rows[grid.cell_country_codes(key_cells)]
+        for col in population_df.columns:
+            keys_df[col] = take_or_nan(population_df[col].to_numpy(), rows)
+    else:
+        # a location with several continent/population values gets a row for each, as with the merge
+        keys_df = pd.merge(keys_df, population_df, how='left', left_on=['country'], right_on=['owid_location'])
+    return keys_df, key_cells
+
+def pivot_gisaid_owid(country_variants_df, owid_df):
+    # same table as pivot_merged_df(merge_gisaid_owid(country_variants_df, owid_df)) without the outer merge:
+    # GISAID and OWID rows are placed on a dense (day x country) grid, lineage counts are summed into a
+    # (cell x lineage) matrix and OWID columns are taken by row lookups, so the cost follows the grid size
+    grid = DateCountryGrid([country_variants_df['collect_date'], owid_df['owid_date']],
+                           [country_variants_df['country'], owid_df['owid_location']])
+    gisaid_cells = grid.cells(country_variants_df['collect_date'], country_variants_df['country'])
+    keys_df, key_cells = grid_owid_keys(grid, gisaid_cells, owid_df)
+
+    labels = lineage_column_order(country_variants_df['key_lineages'].dropna())
+    label_codes = pd.Categorical(country_variants_df['key_lineages'], categories=labels).codes.astype('int64')
+    lineage_df = pd.DataFrame(
+        grid.sum_by_cell(key_cells, gisaid_cells, label_codes, country_variants_df['accession_id'].to_numpy(), len(labels)),
+        columns=labels, index=keys_df.index)
+    country_variants_pivot = pd.concat([keys_df[['collect_date','country']], lineage_df,
+                                        keys_df.drop(['collect_date','country'], axis=1)], axis=1)
+
+    country_variants_pivot.sort_values(
+        ['owid_date','owid_location'], ascending=[True, True], inplace=True)
+    country_variants_pivot['collect_yearweek'] = get_yearweeks(country_variants_pivot['collect_date'])
+    country_variants_pivot['collect_weekstartdate'] = get_weekstartdates(country_variants_pivot['collect_date'])
+
+    return country_variants_pivot
+
+def pivot_merged_long(country_variants_df, owid_df):
+    # same rows and columns as pivot_merged_df(merge_gisaid_owid(...)), but with the lineage counts kept long:
+    # one (lineage_key, key_lineages, accession_id) row per lineage present instead of a mostly empty column per lineage.
+    # OWID is joined once onto the distinct (date, country) cells of the grid, and widen_lineage_counts builds the wide view
+    lineage_counts_df = country_variants_df.groupby(
+        ['collect_date','country','key_lineages'])[['accession_id']].sum().reset_index()
+    lineage_order = lineage_column_order(lineage_counts_df['key_lineages'])
+    lineage_counts_df = lineage_counts_df[lineage_counts_df['key_lineages'].isin(lineage_order)].copy()
+    lineage_counts_df['key_lineages'] = pd.Categorical(lineage_counts_df['key_lineages'], categories=lineage_order)
+
+    grid = DateCountryGrid([lineage_counts_df['collect_date'], owid_df['owid_date']],
+                           [lineage_counts_df['country'], owid_df['owid_location']])
+    gisaid_cells = grid.cells(lineage_counts_df['collect_date'], lineage_counts_df['country'])
+    keys_df, key_cells = grid_owid_keys(grid, gisaid_cells, owid_df)
+    keys_df.insert(keys_df.columns.get_loc('owid_location'), 'lineage_key', np.arange(keys_df.shape[0]))
+    lineage_counts_df['lineage_key'] = grid.row_lookup(key_cells)[gisaid_cells]
+
+    # order and fill as pivot_merged_df does
+    keys_df.sort_values(
+        ['owid_date','owid_location'], ascending=[True, True], inplace=True)
+    keys_df['collect_yearweek'] = get_yearweeks(keys_df['collect_date'])
+    keys_df['collect_weekstartdate'] = get_weekstartdates(keys_df['collect_date'])
+
+    return keys_df, lineage_counts_df[['lineage_key','collect_date','country','key_lineages','accession_id']]
+
+def widen_lineage_counts(keys_df, lineage_counts_df, lineages=None):
+    # the wide pivot_merged_df layout, with a column only for the requested lineage labels (all of them by default).
+    # counts are scattered into a (keys x requested lineages) array, so nothing else is ever widened
+    labels = list(lineage_counts_df['key_lineages'].cat.categories)
+    if lineages is not None:
+        labels = [c for c in labels if c in set(lineages)]
+    counts_df = lineage_counts_df[lineage_counts_df['key_lineages'].isin(labels)]
+
+    wide = np.full((keys_df['lineage_key'].max() + 1 if keys_df.shape[0] else 0, len(labels)), np.nan)
+    wide[counts_df['lineage_key'].to_numpy(), pd.Categorical(counts_df['key_lineages'], categories=labels).codes] = \
+        counts_df['accession_id'].to_numpy(dtype='float64')
+    lineage_df = pd.DataFrame(wide[keys_df['lineage_key'].to_numpy()], columns=labels, index=keys_df.index)
+
+    return pd.concat([keys_df[['collect_date','country']], lineage_df,
+                      keys_df.drop(['collect_date','country','lineage_key'], axis=1)], axis=1)
+
+def write_lineage_counts(lineage_counts_df, output_path):
+    # long lineage counts, one row per (collect date, country, key lineage) with sequences
+    lineage_counts_df = lineage_counts_df.drop('lineage_key', axis=1)
+    if OUTPUT_FORMAT in ('csv', 'both'):
+        lineage_counts_df.to_csv(output_path, index=False)
+    if OUTPUT_FORMAT in ('parquet', 'both'):
+        columnar_io.write_partitioned_parquet(lineage_counts_df, parquet_path(output_path), PARTITION_BY,
+                                              date_col='collect_date', location_cols=['country'])
+
 # local path
-# def add_regions(merged_df, region_path='../data/raw/who_regions (2).csv'):
+# WHO_REGIONS_PATH = '../data/raw/who_regions (2).csv'
 # domino path
-def add_regions(merged_df, region_path='/mnt/data/raw/who_regions (2).csv'):
+WHO_REGIONS_PATH = '/mnt/data/raw/who_regions (2).csv'
+
+def add_regions(merged_df, region_path=WHO_REGIONS_PATH):
     who_regions = pd.read_csv(region_path)
     merged_df = pd.merge(merged_df, who_regions[['Entity','WHO region']], how='left', left_on=['owid_location'], right_on=['Entity'])
     merged_df.rename(columns={'WHO region': 'who_region'}, inplace=True)
@@ -256,30 +691,35 @@ def add_regions(merged_df, region_path='/mnt/data/raw/who_regions (2).csv'):
 #     merged_df.drop('Entity', axis=1, inplace=True)
 #     return merged_df    
 
-def concat_agglocations(merged_pivoted_df, group_cols=['collect_date','collect_yearweek','collect_weekstartdate','owid_date']):
-    continents_df = merged_pivoted_df.groupby(group_cols+['owid_continent']).sum().reset_index()
-    whoregions_df = merged_pivoted_df.groupby(group_cols+['who_region']).sum().reset_index()
-    global_df = merged_pivoted_df.groupby(group_cols).sum().reset_index()
-    
-    # create new col to distinguish these from country-level rows
-    continents_df.loc[:,'aggregate_location'] = continents_df['owid_continent']
-    whoregions_df.loc[:,'aggregate_location'] = 'WHO Region: ' + whoregions_df['who_region']
-    global_df.loc[:,'aggregate_location'] = 'Global'
-    
-    agglocation_df = pd.concat([continents_df, whoregions_df, global_df], sort=False)
+# aggregate_location levels the country rows are rolled up to, in output order. A new level is one more dict,
+# i.e. {'column': 'income_group', 'mapping': {country: group}, 'location': 'Income: {}'}
+AGG_LEVELS = [CONTINENT_LEVEL, WHO_REGION_LEVEL, GLOBAL_LEVEL]
 
-    return agglocation_df
+def concat_agglocations(merged_pivoted_df, group_cols=['collect_date','collect_yearweek','collect_weekstartdate','owid_date'],
+                        levels=AGG_LEVELS):
+    # sum the numeric columns of the country rows per continent, WHO region and globally.
+    # the date keys are factorized once and shared by all levels
+    rollup = LocationRollup(merged_pivoted_df, group_cols)
+    agglocation_df = pd.concat([rollup.sums(level) for level in levels], sort=False)
 
-def calc_regional_lagstats(gisaid_owid_df, group_cols=['collect_weekstartdate']):
-    continents_sumstats_df = calc_lagstats(gisaid_owid_df, group_cols=group_cols+['owid_continent'])
-    whoregions_sumstats_df = calc_lagstats(gisaid_owid_df, group_cols=group_cols+['who_region'])
-    global_sumstats_df = calc_lagstats(gisaid_owid_df, group_cols=group_cols)
+    return agglocation_df
 
-    continents_sumstats_df.loc[:,'aggregate_location'] = continents_sumstats_df['owid_continent']
-    whoregions_sumstats_df.loc[:,'aggregate_location'] = 'WHO Region: '+ whoregions_sumstats_df['who_region']
-    global_sumstats_df.loc[:,'aggregate_location'] = 'Global'
+def calc_regional_lagstats(gisaid_owid_df, group_cols=['collect_weekstartdate'],
+                           levels=[WHO_REGION_LEVEL, CONTINENT_LEVEL, GLOBAL_LEVEL]):
+    # lag counts per level from one set of key codes, then the same quantiles as calc_lagstats
+    rollup = LocationRollup(gisaid_owid_df, group_cols, country_col='country')
+    sumstats = []
+    for level in levels:
+        level_cols = group_cols + ([level['column']] if level['column'] is not None else [])
+        lag_counts = rollup.value_counts(level)
+        sumstats_df = calc_lagstats_from_counts(lag_counts, level_cols)
+        if level['column'] is not None:
+            sumstats_df.loc[:,'aggregate_location'] = [level['location'].format(x) for x in sumstats_df[level['column']]]
+        else:
+            sumstats_df.loc[:,'aggregate_location'] = level['location']
+        sumstats.append(sumstats_df)
 
-    return pd.concat([whoregions_sumstats_df, continents_sumstats_df, global_sumstats_df], sort=False)
+    return pd.concat(sumstats, sort=False)
 
 def cleanup_columns(merged_df, gisaid_cols):
     # prepend gisaid_ to respective columns except for the lineage ones
@@ -288,10 +728,12 @@ def cleanup_columns(merged_df, gisaid_cols):
     return merged_df
 
 def calc_vax_bottomup(vax_df, loc_col = 'owid_location'):
-    # adding up the daily or weekly new people vaccinated per region and then calculating the percent of pop
-    for loc in vax_df[loc_col].unique():
-      vax_df.loc[vax_df[loc_col]==loc,'owid_people_vaccinated'] = vax_df[vax_df[loc_col]==loc]['owid_new_people_vaccinated'].cumsum()
-      vax_df.loc[vax_df[loc_col]==loc,'owid_people_fully_vaccinated'] = vax_df[vax_df[loc_col]==loc]['owid_new_people_fully_vaccinated'].cumsum()
+    # adding up the daily or weekly new people vaccinated per region and then calculating the percent of pop.
+    # cumulative sums run per location in frame order; rows without a location are left as they were
+    has_loc = vax_df[loc_col].notna()
+    grouped = vax_df[has_loc].groupby(loc_col, sort=False)
+    vax_df.loc[has_loc, 'owid_people_vaccinated'] = grouped['owid_new_people_vaccinated'].cumsum()
+    vax_df.loc[has_loc, 'owid_people_fully_vaccinated'] = grouped['owid_new_people_fully_vaccinated'].cumsum()
     
     vax_df['owid_people_vaccinated_per_hundred'] = np.round(vax_df['owid_people_vaccinated'] / (vax_df['owid_population']/100),2)
     vax_df['owid_people_fully_vaccinated_per_hundred'] = np.round(vax_df['owid_people_fully_vaccinated'] / (vax_df['owid_population']/100),2)
@@ -307,11 +749,11 @@ def get_owid_vax_regional(get_weekly=True):
         'OWID_SAM':'South America',
         'OWID_WRL':'Global',
     }
-    owid_url = 'https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.csv'
-    owid_vax_df = pd.read_csv(owid_url, parse_dates=['date'])[['iso_code','date','people_vaccinated_per_hundred','people_fully_vaccinated_per_hundred']]
+    # same file as load_owid_df, served from the fetch cache rather than downloaded again
+    owid_vax_df = pd.read_csv(fetch_cache.fetch(fetch_cache.OWID_URL), parse_dates=['date'])[['iso_code','date','people_vaccinated_per_hundred','people_fully_vaccinated_per_hundred']]
     owid_vax_df.columns = ['owid_%s' % x for x in owid_vax_df.columns]
     owid_vax_df['aggregate_location'] = owid_vax_df['owid_iso_code'].map(iso2loc_dict)
-    owid_vax_df['gisaid_collect_weekstartdate'] = owid_vax_df['owid_date'].apply(get_weekstartdate)
+    owid_vax_df['gisaid_collect_weekstartdate'] = get_weekstartdates(owid_vax_df['owid_date'])
     owid_vax_df.drop('owid_iso_code', axis=1, inplace=True)
 
     region_vax_df = owid_vax_df[(~owid_vax_df['aggregate_location'].isna())]
@@ -349,78 +791,347 @@ def aggregate_weekly(df):
                             how='left', left_on=['gisaid_country'], right_on=['owid_location'])
     return weekly_agg_df
 
-def add_greek_cols(df):
-    # break out new columns aggregating the counts of variants grouped under WHO greek letters designated in greek_dict at top
-    # first find the lineages that exist in this gisaid export
-    greek_lineages_flattened = [v for v in greek_dict.values() for v in v]
-    match_list = find_lineages(greek_lineages_flattened, set(df.columns))
-    
-    # group lineages under each greek letter designation, sum, and create new 'who_' col for them
+def add_greek_cols(df, families=None):
+    # break out new columns aggregating the counts of variants grouped under WHO greek letters designated in greek_dict at top.
+    # the groups are compiled once against the lineage columns of this export into a lineage x group assignment, so every
+    # who_ column, who_other and any extra families (i.e. {'BA.2 family': ['BA.2', 'BA.2.*']}) come out of one matrix product
     print('Grouping into greek cols:','\n--------------------------')
-    who_list = []
-    for k, v in greek_dict.items(): 
-        print(f'Finding and grouping lineages for {k}:')
-        v_existing = find_lineages(v, set(df.columns))
-        df[k] = df[v_existing].sum(axis=1)
-        print('-->',k,':',v_existing)
-        who_list += v_existing
-    df['who_other'] = df['All lineages'] - df[match_list].sum(axis=1)
+    lineage_groups = LineageGroups(dict(greek_dict, **(families or {})), set(df.columns))
+    # families overlap the greek groups by design, but a lineage in two greek groups would be counted twice
+    overlaps = {x: names for x, names in lineage_groups.overlaps.items() if len(set(names) & set(greek_dict)) > 1}
+    if overlaps: print('  Lineages in more than one greek group, counted in each:', overlaps)
+
+    group_df = lineage_groups.groups(df, union_of=list(greek_dict))
+    for k in greek_dict:
+        df[k] = group_df[k]
+    # lineages in any greek group count once against who_other
+    df['who_other'] = df['All lineages'] - group_df['_any']
+    for k in (families or {}):
+        df[k] = group_df[k]
     return df
 
+##############################################################################################
+######################################   Stage cache    ######################################
+##############################################################################################
+
+def owid_version():
+    # sha256 of the current OWID download, fetching it first if needed
+    fetch_cache.fetch(fetch_cache.OWID_URL)
+    return fetch_cache.cache_entry(fetch_cache.OWID_URL)['sha256']
+
+def process_metadata_inputs(metadata_path, exclude_index):
+    # what the processed metadata depends on outside the code: the export, the exclude list, the country name rules,
+    # the suspect dates recorded by earlier runs and the run date, since future collection dates are judged against today.
+    # only accessions first flagged before today count: each run saves the ones it flags with today's date, so the file
+    # itself changes on every run, while those rows follow from the export and the run date already in the key
+    run_date = date.today().strftime('%Y-%m-%d')
+    suspect_date_table = filter_gisaid_metadata.SuspectDateTable(filter_gisaid_metadata.SUSPECT_DATE_PATH).table
+    earlier_suspects = suspect_date_table.loc[suspect_date_table['first_flagged'] != run_date, 'accession_id']
+    return {'metadata': parse_cache.file_fingerprint(metadata_path),
+            'exclude_list': exclude_index.version,
+            'country_name_corrections': parse_cache.file_fingerprint(filter_gisaid_metadata.COUNTRY_NAME_CORRECTIONS_PATH),
+            'known_countries': parse_cache.file_fingerprint(filter_gisaid_metadata.KNOWN_COUNTRIES_PATH),
+            'suspect_dates': hashlib.sha256('\n'.join(sorted(earlier_suspects)).encode()).hexdigest(),
+            'run_date': run_date}
+
+def build_stage_pipeline(args, cache):
+    # the steps of main() as named stages cached on disk. A stage's key covers the config and code its output
+    # depends on plus its upstream stages' keys, so i.e. editing other_important only re-runs aggregate_with_lineage
+    # and what comes after it, while the metadata and OWID stages are loaded from the cache.
+    # the exclude index is only loaded when the metadata stage's key or output is needed, not while building
+    pipeline = stage_cache.StagePipeline(cache)
+
+    def process_metadata():
+        # streamed as with --chunksize; also writes the clean metadata, which is only rewritten when this stage runs.
+        # the exclude entries matched are kept with the counts so a cache hit can still report them
+        gisaid_counts_df, gisaid_cols, max_gisaid_date = stream_process_metadata(
+            args.metadata_path, CLEAN_METADATA_PATH, chunksize=args.chunksize or 500000, compact=args.compact,
+            n_workers=args.workers)
+        return gisaid_counts_df, gisaid_cols, max_gisaid_date, process_nextstrain_exclude.load_exclude_index().matched.copy()
+    pipeline.add('process_metadata', process_metadata,
+                 config={'compact': args.compact, 'output_format': OUTPUT_FORMAT, 'partition_by': PARTITION_BY},
+                 code=(stream_process_metadata, metadata_chunks, worker_pool, count_sequences, combine_sequence_counts,
+                       write_clean_metadata, parquet_path, filter_gisaid_metadata, process_nextstrain_exclude,
+                       parse_cache, columnar_io),
+                 fingerprint=lambda: process_metadata_inputs(args.metadata_path,
+                                                             process_nextstrain_exclude.load_exclude_index()))
+
+    def aggregate(processed):
+        return aggregate_with_lineage_from_counts(processed[0])
+    pipeline.add('aggregate_with_lineage', aggregate, deps=['process_metadata'],
+                 config={'greek_dict': greek_dict, 'vocs': vocs, 'vois': vois, 'other_important': other_important,
+                         'lineage_replace_dict': lineage_replace_dict},
+                 code=(aggregate_with_lineage_from_counts, lineage_count_parts, label_key_lineages, decategorize,
+                       LineageIndex, map_labels))
+
+    pipeline.add('load_owid_df', load_owid_df, code=(prepare_owid_df,), fingerprint=owid_version)
+
+    if args.lineage_layout == 'long':
+        pipeline.add('pivot_merged_long', pivot_merged_long, deps=['aggregate_with_lineage', 'load_owid_df'],
+                     config={'owid_date_cols': OWID_DATE_COLS},
+                     code=(lineage_column_order, grid_owid_keys, DateCountryGrid, take_or_nan, get_weekstartdates,
+                           get_yearweeks))
+
+        def widen(long_counts):
+            return widen_lineage_counts(*long_counts)
+        pipeline.add('merged_pivoted', widen, deps=['pivot_merged_long'], code=(widen_lineage_counts,))
+    else:
+        pipeline.add('merged_pivoted', pivot_gisaid_owid, deps=['aggregate_with_lineage', 'load_owid_df'],
+                     config={'owid_date_cols': OWID_DATE_COLS},
+                     code=(lineage_column_order, grid_owid_keys, DateCountryGrid, take_or_nan, get_weekstartdates,
+                           get_yearweeks))
+
+    pipeline.add('add_regions', add_regions, deps=['merged_pivoted'], config={'region_path': WHO_REGIONS_PATH},
+                 fingerprint=lambda: parse_cache.file_fingerprint(WHO_REGIONS_PATH))
+
+    def add_agglocations(merged_pivoted_df):
+        return pd.concat([merged_pivoted_df, concat_agglocations(merged_pivoted_df)], sort=False)
+    pipeline.add('concat_agglocations', add_agglocations, deps=['add_regions'], config={'levels': AGG_LEVELS},
+                 code=(concat_agglocations, LocationRollup, take_by_codes))
+
+    def lagstats(processed):
+        return calc_lagstats_from_counts(processed[0])
+    pipeline.add('calc_lagstats', lagstats, deps=['process_metadata'], config={'group_cols': LAG_GROUP_COLS},
+                 code=(calc_lagstats_from_counts, lagstats_from_histogram, widen_lagstats, decategorize, LagHistogram))
+
+    def cleaning_output(merged_pivoted_df, sumstats_df, processed):
+        merged_pivoted_df = cleanup_columns(pd.merge(merged_pivoted_df, sumstats_df, how='left'), processed[1])
+        return merged_pivoted_df.loc[(merged_pivoted_df.owid_date <= processed[2])]
+    pipeline.add('cleaning_output', cleaning_output, deps=['concat_agglocations', 'calc_lagstats', 'process_metadata'],
+                 code=(cleanup_columns,))
+
+    return pipeline
+
+def record_snapshot(snapshot, store_dir=SNAPSHOT_DIR, changes_path=SEQUENCE_CHANGES_PATH):
+    # store this run's per-accession key columns as a delta against the previous run, and write the resulting
+    # change in sequences per country and lineage for the topline scripts
+    changes = SnapshotStore(store_dir).record(snapshot.frame())
+    if changes is None:
+        print('  First snapshot, no previous run to compare with')
+        return
+    print('  Since the previous run: %d added, %d removed, %d re-lineaged accessions' % (
+        changes.added.shape[0], changes.removed.shape[0], changes.relineaged.shape[0]))
+    changes.count_changes(['country', 'Pango lineage']).to_csv(changes_path, index=False)
+
+def run_stage_pipeline(args, metrics):
+    # main() through the stage cache: only stages whose inputs, config or code changed since a cached run execute
+    print('Running stages through the stage cache...')
+    pipeline = build_stage_pipeline(args, stage_cache.StageCache(stage_cache.STAGE_CACHE_DIR))
+    with metrics.stage('stage_pipeline') as stage:
+        merged_pivoted_df_latest = pipeline.get('cleaning_output')
+        stage.output(merged_pivoted_df_latest)
+    if args.lineage_layout == 'long':
+        with metrics.stage('write_lineage_counts'):
+            write_lineage_counts(pipeline.get('pivot_merged_long')[1], LINEAGE_COUNTS_PATH)
+    with metrics.stage('write_cleaning_output', merged_pivoted_df_latest):
+        write_cleaning_output(merged_pivoted_df_latest, CLEANING_OUTPUT_PATH)
+    with metrics.stage('write_aggregate_cube', merged_pivoted_df_latest):
+        write_aggregate_cube(merged_pivoted_df_latest, CUBE_PATH)
+
+    exclude_index = process_nextstrain_exclude.load_exclude_index()
+    exclude_index.matched |= pipeline.get('process_metadata')[3]
+    pipeline.summary()
+
+    load_suspect_date_table().save()
+    process_nextstrain_exclude.write_exclude_matches(exclude_index, EXCLUDE_MATCHES_PATH, EXCLUDE_HISTORY_PATH)
+    metrics.summary()
+
+def parse_args(args_list=None):
+    parser = argparse.ArgumentParser(description='Process GISAID metadata and merge with OWID case data.')
+    parser.add_argument('--metadata-path', default=METADATA_PATH,
+                        help='GISAID metadata.tsv export')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream metadata.tsv in chunks of this many rows instead of loading it whole')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes for filtering and annotating sequences')
+    parser.add_argument('--compact', action='store_true',
+                        help='keep the annotated sequences as categoricals and narrow ints, and print a memory report')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='stream metadata.tsv (in --chunksize rows, default 500000) and spill the sequence counts to '
+                             'disk partitioned by country and week, then aggregate one partition at a time; '
+                             'not with --incremental or --stage-cache')
+    parser.add_argument('--memory-budget-mb', type=int, default=4000,
+                        help='with --out-of-core, size partitions to hold at most this much of the export')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process accessions that are new or changed since the last run')
+    parser.add_argument('--full-rebuild', action='store_true',
+                        help='with --incremental, rebuild the stored state from scratch and check it matches the incremental update')
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'both'], default=OUTPUT_FORMAT,
+                        help='write processed outputs as csv, partitioned parquet, or both')
+    parser.add_argument('--partition-by', choices=['week', 'country'], default=PARTITION_BY,
+                        help='partition parquet outputs by collection week or by country')
+    parser.add_argument('--offline', action='store_true',
+                        help='use the cached OWID and Nextstrain files without contacting the servers')
+    parser.add_argument('--parse-cache', action='store_true',
+                        help='keep a memory-mapped snapshot of the parsed export and reuse it while metadata.tsv is unchanged')
+    parser.add_argument('--lineage-layout', choices=['wide', 'long'], default=LINEAGE_LAYOUT,
+                        help='long keeps lineage counts as (date, country, lineage, count) rows, joins OWID once '
+                             'and writes them to gisaid_lineage_counts.csv; the wide output is built from them')
+    parser.add_argument('--metrics-path', default=METRICS_PATH,
+                        help='JSON lines file per-stage timings and memory are appended to')
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help='also run each stage under cProfile (.prof files next to the metrics) or tracemalloc')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='keep each run\'s per-accession key columns as a delta in processed/snapshots and write the '
+                             'change in sequences per country and lineage since the previous run (not with --stage-cache)')
+    parser.add_argument('--async-fetch', action='store_true',
+                        help='start the OWID and Nextstrain downloads in the background at startup, so they overlap with '
+                             'reading and filtering metadata.tsv; each step waits only for the file it needs')
+    parser.add_argument('--stage-cache', action='store_true',
+                        help='cache each stage\'s output on disk and only re-run the stages whose inputs, config or code '
+                             'changed; metadata is streamed in --chunksize rows (default 500000) and --incremental is ignored')
+    args = parser.parse_args(args_list)
+    # main() would run only one of these, so the combinations are rejected rather than one silently ignored
+    for other in ['incremental', 'stage_cache']:
+        if args.out_of_core and getattr(args, other):
+            parser.error('--out-of-core can\'t be combined with --%s' % other.replace('_', '-'))
+    return args
+
 def main(args_list=None):
+    args = parse_args(args_list)
+    if args.offline: fetch_cache.OFFLINE = True
+    if args.async_fetch: fetch_cache.prefetch(REMOTE_INPUTS)
+    global OUTPUT_FORMAT, PARTITION_BY, PARSE_CACHE
+    OUTPUT_FORMAT, PARTITION_BY, PARSE_CACHE = args.output_format, args.partition_by, args.parse_cache
 
-    # local path
-    # gisaid_df = pd.read_csv('../data/raw/metadata.tsv', sep='\t')
+    metrics = RunMetrics(args.metrics_path, args.profile)
+    if args.stage_cache:
+        run_stage_pipeline(args, metrics)
+        return
 
-    # domino path
-    gisaid_df = pd.read_csv('/domino/datasets/local/metadata/metadata.tsv', sep='\t')
+    snapshot = SnapshotBuilder() if args.snapshot else None
+    gisaid_counts_df = None
+    gisaid_country_variants_df = None
+    sumstats_df = None
+    lag_histogram = None
+    if args.out_of_core:
+        print('Streaming, filtering and aggregating GISAID data out of core, %d MB memory budget...' % args.memory_budget_mb)
+        with metrics.stage('process_metadata_out_of_core') as stage:
+            gisaid_country_variants_df, sumstats_df, gisaid_cols, max_gisaid_date = out_of_core_process_metadata(
+                args.metadata_path, CLEAN_METADATA_PATH, chunksize=args.chunksize or 500000, compact=args.compact,
+                n_workers=args.workers, spill_dir=SPILL_DIR, memory_budget_mb=args.memory_budget_mb, snapshot=snapshot)
+            stage.output(gisaid_country_variants_df, sumstats_df)
+        print('Done.')
+    elif args.incremental:
+        print('Incrementally filtering and aggregating GISAID data...')
+        with metrics.stage('process_metadata_incremental') as stage:
+            if args.full_rebuild:
+                gisaid_counts_df, gisaid_cols, max_gisaid_date = verify_incremental(
+                    args.metadata_path, CLEAN_METADATA_PATH, STATE_DIR, chunksize=args.chunksize or 500000,
+                    n_workers=args.workers)
+            else:
+                gisaid_counts_df, gisaid_cols, max_gisaid_date = incremental_process_metadata(
+                    args.metadata_path, CLEAN_METADATA_PATH, STATE_DIR, chunksize=args.chunksize or 500000,
+                    n_workers=args.workers)
+            lag_histogram = metadata_state_store.load_lag_histogram(STATE_DIR, LAG_GROUP_COLS)
+            if snapshot is not None: snapshot.add(metadata_state_store.load_state(STATE_DIR)[0])
+            stage.output(gisaid_counts_df)
+    elif args.chunksize:
+        print('Streaming, filtering and aggregating GISAID data in chunks of %d rows...' % args.chunksize)
+        with metrics.stage('process_metadata_stream') as stage:
+            gisaid_counts_df, gisaid_cols, max_gisaid_date = stream_process_metadata(
+                args.metadata_path, CLEAN_METADATA_PATH, chunksize=args.chunksize, compact=args.compact,
+                n_workers=args.workers, snapshot=snapshot)
+            stage.output(gisaid_counts_df)
 
-    print('Loading and filtering GISAID data...')
-    gisaid_df = process_raw_metadata(gisaid_df)
-    gisaid_cols = list(gisaid_df.columns)
-    print('Done, %d sequences' % gisaid_df.shape[0])
-    
-    gisaid_df_subset = gisaid_df[['collect_date', 'submit_date', 'any_abnormal', 'country', 'Pango lineage']]
+    if gisaid_counts_df is not None:
+        print('Done, %d sequences' % gisaid_counts_df['row_count'].sum())
 
-    # local path
-    # gisaid_df_subset.to_csv('../data/processed/inital_clean_metadata.csv')
+        print('Aggregating GISAID data...')
+        print('Break out key pango lineages into columns')
+        with metrics.stage('aggregate_with_lineage', gisaid_counts_df) as stage:
+            gisaid_country_variants_df = aggregate_with_lineage_from_counts(gisaid_counts_df)
+            stage.output(gisaid_country_variants_df)
+        print('Done.')
+    elif gisaid_country_variants_df is None:
+        with metrics.stage('read_metadata') as stage:
+            if PARSE_CACHE:
+                gisaid_df = parse_cache.read_cached_metadata(args.metadata_path, parse_cache.PARSE_CACHE_DIR)
+            else:
+                gisaid_df = pd.read_csv(args.metadata_path, sep='\t')
+            stage.output(gisaid_df)
 
-    # domino path
-    gisaid_df_subset.to_csv('/mnt/data/processed/inital_clean_metadata.csv')
+        print('Loading and filtering GISAID data...')
+        with metrics.stage('process_raw_metadata', gisaid_df) as stage:
+            gisaid_df = process_raw_metadata_parallel(gisaid_df, args.workers, compact=args.compact)
+            stage.output(gisaid_df)
+        gisaid_cols = list(gisaid_df.columns)
+        if snapshot is not None: snapshot.add(gisaid_df)
+        print('Done, %d sequences' % gisaid_df.shape[0])
+        
+        with metrics.stage('write_clean_metadata', gisaid_df):
+            write_clean_metadata(gisaid_df, CLEAN_METADATA_PATH)
 
-    print('Aggregating GISAID data...')
-    print('Break out key pango lineages into columns')
-    gisaid_country_variants_df = aggregate_with_lineage(gisaid_df)
-    print('Done.')
+        print('Aggregating GISAID data...')
+        print('Break out key pango lineages into columns')
+        with metrics.stage('aggregate_with_lineage', gisaid_df) as stage:
+            gisaid_country_variants_df = aggregate_with_lineage(gisaid_df)
+            stage.output(gisaid_country_variants_df)
+        print('Done.')
+        max_gisaid_date = gisaid_df.submit_date.max()
 
     print('Loading OWID data...')
-    owid_df = load_owid_df()
+    with metrics.stage('load_owid_df') as stage:
+        owid_df = load_owid_df()
+        stage.output(owid_df)
     print('Done, %d rows' % owid_df.shape[0])
 
-    print('Merging GISAID and OWID data...')
-    merged_df = merge_gisaid_owid(gisaid_country_variants_df, owid_df)
-    print('Pivoting merged data...')
-    merged_pivoted_df = pivot_merged_df(merged_df)
+    if args.lineage_layout == 'long':
+        print('Joining OWID data onto long lineage counts...')
+        with metrics.stage('pivot_merged_long', gisaid_country_variants_df, owid_df) as stage:
+            keys_df, lineage_counts_df = pivot_merged_long(gisaid_country_variants_df, owid_df)
+            stage.output(keys_df, lineage_counts_df)
+        with metrics.stage('write_lineage_counts', lineage_counts_df):
+            write_lineage_counts(lineage_counts_df, LINEAGE_COUNTS_PATH)
+        with metrics.stage('widen_lineage_counts', keys_df, lineage_counts_df) as stage:
+            merged_pivoted_df = widen_lineage_counts(keys_df, lineage_counts_df)
+            stage.output(merged_pivoted_df)
+    else:
+        print('Joining and pivoting GISAID and OWID data...')
+        with metrics.stage('pivot_gisaid_owid', gisaid_country_variants_df, owid_df) as stage:
+            merged_pivoted_df = pivot_gisaid_owid(gisaid_country_variants_df, owid_df)
+            stage.output(merged_pivoted_df)
     print('Add region assignments to countries...')
-    merged_pivoted_df = add_regions(merged_pivoted_df)
+    with metrics.stage('add_regions', merged_pivoted_df) as stage:
+        merged_pivoted_df = add_regions(merged_pivoted_df)
+        stage.output(merged_pivoted_df)
     # merged_pivoted_df = add_continents(merged_pivoted_df)
     print('Aggregate locations and concatenate...')
-    agglocation_df = concat_agglocations(merged_pivoted_df)
-    merged_pivoted_df = pd.concat([merged_pivoted_df, agglocation_df], sort=False)
+    with metrics.stage('concat_agglocations', merged_pivoted_df) as stage:
+        agglocation_df = concat_agglocations(merged_pivoted_df)
+        merged_pivoted_df = pd.concat([merged_pivoted_df, agglocation_df], sort=False)
+        stage.output(merged_pivoted_df)
     print('Add submission lag stats...')
-    sumstats_df = calc_lagstats(gisaid_df)  
-    merged_pivoted_df = pd.merge(merged_pivoted_df, sumstats_df, how='left')
+    with metrics.stage('calc_lagstats', merged_pivoted_df) as stage:
+        if lag_histogram is not None:
+            sumstats_df = lagstats_from_histogram(lag_histogram)
+        elif gisaid_counts_df is not None:
+            sumstats_df = calc_lagstats_from_counts(gisaid_counts_df)
+        elif sumstats_df is None:
+            # out-of-core runs have already computed it per partition
+            sumstats_df = calc_lagstats(gisaid_df)
+        merged_pivoted_df = pd.merge(merged_pivoted_df, sumstats_df, how='left')
+        stage.output(merged_pivoted_df)
     print('Final data file cleanup...')
     merged_pivoted_df = cleanup_columns(merged_pivoted_df, gisaid_cols)
     #print(f'Locations without OWID join and how many sequences:\n{merged_pivoted_df[(merged_pivoted_df["owid_location"].isna())&(merged_pivoted_df["aggregate_location"].isna())].groupby("gisaid_country").sum()["All lineages"]}')
     print('Done.')
 
-    max_gisaid_date = gisaid_df.submit_date.max()
     merged_pivoted_df_latest = merged_pivoted_df.loc[(merged_pivoted_df.owid_date <= max_gisaid_date)]
-    # local path
-    # merged_pivoted_df_latest.to_csv('../data/processed/gisaid_cleaning_output.csv')
-    # domino path
-    merged_pivoted_df_latest.to_csv('/mnt/data/processed/gisaid_cleaning_output.csv')
+    with metrics.stage('write_cleaning_output', merged_pivoted_df_latest):
+        write_cleaning_output(merged_pivoted_df_latest, CLEANING_OUTPUT_PATH)
+    with metrics.stage('write_aggregate_cube', merged_pivoted_df_latest):
+        write_aggregate_cube(merged_pivoted_df_latest, CUBE_PATH)
+
+    load_suspect_date_table().save()
+    process_nextstrain_exclude.write_exclude_matches(
+        process_nextstrain_exclude.load_exclude_index(), EXCLUDE_MATCHES_PATH, EXCLUDE_HISTORY_PATH)
+    if snapshot is not None:
+        print('Recording per-accession snapshot...')
+        with metrics.stage('record_snapshot'):
+            record_snapshot(snapshot)
+
+    metrics.summary()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Per-group histograms of submission lag (lag_days).
+
+lag_days is a small integer, so the lag distribution of a group of sequences
+is fully described by how many sequences have each lag value. A LagHistogram
+stores these as sparse (group columns, lag_days, count) rows sorted by group
+then lag. Histograms from separate chunks or runs add up (and subtract, for
+rows that left the export), and give exact count/median/min/max/q1/q3 with
+the same linear interpolation as pandas' quantile.
+"""
+
+import numpy as np
+import pandas as pd
+
+# quantile columns of the lag stats and their q
+LAG_QUANTILES = [('gisaid_lagdays_median', 0.5), ('gisaid_lagdays_q1', 0.25), ('gisaid_lagdays_q3', 0.75)]
+LAG_STATS_COLS = ['seq_count', 'gisaid_lagdays_median', 'gisaid_lagdays_min', 'gisaid_lagdays_max',
+                  'gisaid_lagdays_q1', 'gisaid_lagdays_q3']
+
+
+class LagHistogram:
+    """Sparse lag_days histogram per group.
+
+    Parameters
+    ----------
+    counts_df : pandas.core.frame.DataFrame
+        group_cols, lag_days and count rows. Rows with the same key are added
+        up and rows with a zero count or a missing key are dropped.
+    group_cols : list
+        Columns identifying a group.
+    count_col : str
+        Column of counts_df holding the number of sequences.
+    """
+
+    def __init__(self, counts_df, group_cols, count_col='row_count'):
+        self.group_cols = list(group_cols)
+        counts = counts_df.groupby(self.group_cols+['lag_days'], observed=True)[count_col].sum()
+        self.counts_df = counts[counts != 0].rename('row_count').reset_index()
+
+    @classmethod
+    def from_sequences(cls, gisaid_df, group_cols):
+        """Histogram of one row per sequence, i.e. the annotated metadata."""
+        counts = gisaid_df.groupby(list(group_cols)+['lag_days'], observed=True).size()
+        return cls(counts.rename('row_count').reset_index(), group_cols)
+
+    def merge(self, *others, subtract=False):
+        """Sum of this and other histograms over the same group columns.
+
+        Parameters
+        ----------
+        *others : LagHistogram
+            Histograms to add.
+        subtract : bool
+            Subtract the others instead, i.e. to remove sequences that were
+            reprocessed or dropped from the export.
+        """
+        sign = -1 if subtract else 1
+        parts = [self.counts_df] + [other.counts_df.assign(row_count=sign * other.counts_df['row_count'])
+                                    for other in others]
+        return LagHistogram(pd.concat(parts), self.group_cols)
+
+    def stats(self):
+        """Count, median, min, max, q1 and q3 of lag_days per group.
+
+        Quantiles use pandas' linear interpolation, the value at rank
+        (n-1)*q within the sorted group, found by binary search on the
+        cumulative counts instead of expanding the histogram.
+
+        Returns
+        -------
+        sumstats_df : pandas.core.frame.DataFrame
+            group_cols followed by LAG_STATS_COLS, one row per group.
+        """
+        lag_values = self.counts_df['lag_days'].to_numpy().astype('int64')
+        cum_counts = self.counts_df['row_count'].to_numpy().cumsum()
+
+        sumstats_df = self.counts_df.groupby(self.group_cols, observed=True).agg(
+            seq_count=('row_count', 'sum'),
+            gisaid_lagdays_min=('lag_days', 'min'),
+            gisaid_lagdays_max=('lag_days', 'max'),
+        ).reset_index()
+        n = sumstats_df['seq_count'].to_numpy()
+        group_offset = n.cumsum() - n
+
+        def value_at_rank(rank):
+            return lag_values[np.searchsorted(cum_counts, group_offset + rank, side='right')]
+
+        for col, q in LAG_QUANTILES:
+            h = (n - 1) * q
+            lo = np.floor(h).astype('int64')
+            hi = np.minimum(lo + 1, n - 1)
+            lo_value = value_at_rank(lo)
+            sumstats_df[col] = lo_value + (h - lo) * (value_at_rank(hi) - lo_value)
+
+        return sumstats_df[self.group_cols+LAG_STATS_COLS]
+
+    def to_pickle(self, path):
+        """Persist the histogram, see read_pickle."""
+        self.counts_df.to_pickle(path)
+
+    @classmethod
+    def read_pickle(cls, path, group_cols):
+        """Load a histogram written by to_pickle."""
+        histogram = cls.__new__(cls)
+        histogram.group_cols = list(group_cols)
+        histogram.counts_df = pd.read_pickle(path)
+        return histogram
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Prefix trie over the dotted components of Pango lineage names.
+
+Built once from the lineages present in an export, it resolves exact names and
+"*" wildcards (i.e. "AY.*", "B.1.1.529.*") by walking to the prefix node and
+collecting its subtree, instead of comparing every pattern against every
+lineage. Resolved patterns compile to a lineage -> label mapping that is
+applied to a whole column with one factorize and one array lookup.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class LineageIndex:
+    """Trie of the lineage names in one export.
+
+    Parameters
+    ----------
+    lineages : iterable
+        Lineage names, e.g. the unique values of the Pango lineage column or
+        the lineage columns of the pivoted frame. Non-strings (NaN) are kept
+        out of the trie and matched against their str().
+    """
+
+    def __init__(self, lineages):
+        self.lineages = set(lineages)
+        self.root = {'children': {}, 'names': []}
+        self.others = []
+        for name in self.lineages:
+            if not isinstance(name, str):
+                self.others.append(name)
+                continue
+            node = self.root
+            for component in name.split('.'):
+                node = node['children'].setdefault(component, {'children': {}, 'names': []})
+            node['names'].append(name)
+
+    def match_wildcard(self, pattern):
+        """Lineages matching a pattern with one "*".
+
+        Same rule as the original string slicing: a lineage matches when it
+        starts with the pattern with the "*" removed. The complete components
+        of that prefix are walked in the trie, then every child starting with
+        the trailing partial component is collected with its subtree.
+        Patterns with several "*" keep the original slicing, which compares
+        one character more than the prefix has.
+        """
+        prefix = pattern.replace('*', '')
+        if pattern.count('*') != 1:
+            return [c for c in self.lineages if prefix == str(c)[:len(pattern)-1]]
+
+        # the few non-string lineages go through the original rule
+        res = [c for c in self.others if prefix == str(c)[:len(pattern)-1]]
+        components = prefix.split('.')
+        node = self.root
+        for component in components[:-1]:
+            node = node['children'].get(component)
+            if node is None:
+                return res
+
+        stack = [child for name, child in node['children'].items() if name.startswith(components[-1])]
+        while stack:
+            node = stack.pop()
+            res += node['names']
+            stack += node['children'].values()
+        return res
+
+    def find(self, input_pango, verbose=True):
+        """Lineages in the index matching input_pango, as find_lineages.
+
+        Parameters
+        ----------
+        input_pango : list
+            Lineage names and wildcard patterns.
+        verbose : bool
+            Print what was matched and what was not found.
+
+        Returns
+        -------
+        list
+            Sorted exact matches plus wildcard matches.
+        """
+        match_list = sorted(set(self.lineages) & set(input_pango))
+        if verbose: print('  Matched these lineages:', match_list)
+        wildcards = [c for c in input_pango if '*' in c]
+        wildcard_res = []
+        for w in wildcards:
+            res = self.match_wildcard(w)
+            if verbose: print(f'  Found {w}:', sorted(res))
+            wildcard_res += res
+        not_found = set(input_pango)-set(wildcards)-set(match_list)
+        if verbose and len(not_found) > 0: print('  Not found:', not_found)
+        return sorted(match_list+wildcard_res)
+
+    def compile_labels(self, patterns, replace_dict=None, verbose=True):
+        """Map every lineage matched by patterns to its output label.
+
+        Parameters
+        ----------
+        patterns : list
+            Lineage names and wildcard patterns to break out.
+        replace_dict : dict, optional
+            Aliases applied to the matched lineages, i.e. B.1.427 and B.1.429
+            both labelled B.1.427/429.
+
+        Returns
+        -------
+        dict
+            lineage -> label for the matched lineages only.
+        """
+        replace_dict = replace_dict or {}
+        return {x: replace_dict.get(x, x) for x in self.find(patterns, verbose=verbose)}
+
+
+def map_labels(lineage_series, label_map, default):
+    """Label a lineage column through a compiled label map.
+
+    Each distinct lineage is looked up once, then labels are assigned to all
+    rows with a single array take over the factorized codes.
+
+    Parameters
+    ----------
+    lineage_series : pandas.core.series.Series
+        Pango lineage values.
+    label_map : dict
+        Output of LineageIndex.compile_labels.
+    default : str
+        Label for lineages not in label_map, and for missing lineages.
+
+    Returns
+    -------
+    numpy.ndarray
+        Object array of labels, aligned with lineage_series.
+    """
+    codes, uniques = pd.factorize(lineage_series)
+    labels = np.array([label_map.get(x, default) for x in uniques] + [default], dtype=object)
+    return labels[codes]
+
+
+class LineageGroups:
+    """Lineage -> group assignment compiled once from group patterns.
+
+    The assignment is kept as sparse (lineage, group) pairs; groups() turns
+    it into a (lineages x groups) 0/1 matrix so every group total comes out
+    of one matrix product over the lineage count block.
+
+    Parameters
+    ----------
+    groups : dict
+        Group name -> lineage names and wildcard patterns.
+    lineages : iterable
+        Lineages present, i.e. the lineage columns of the pivoted frame.
+    verbose : bool
+        Print what each group matched.
+
+    Attributes
+    ----------
+    lineages : list
+        Lineages in at least one group, the rows of the matrix.
+    overlaps : dict
+        lineage -> groups, for lineages matched by more than one group.
+    """
+
+    def __init__(self, groups, lineages, verbose=True):
+        index = LineageIndex(lineages)
+        self.names = list(groups)
+        members = {}
+        for name, patterns in groups.items():
+            if verbose: print(f'Finding and grouping lineages for {name}:')
+            members[name] = sorted(set(index.find(patterns, verbose=verbose)))
+            if verbose: print('-->', name, ':', members[name])
+
+        self.lineages = sorted({x for matched in members.values() for x in matched})
+        position = {x: i for i, x in enumerate(self.lineages)}
+        self.rows = np.array([position[x] for name in self.names for x in members[name]], dtype='int64')
+        self.cols = np.array([i for i, name in enumerate(self.names) for _ in members[name]], dtype='int64')
+
+        in_groups = {}
+        for name in self.names:
+            for x in members[name]:
+                in_groups.setdefault(x, []).append(name)
+        self.overlaps = {x: names for x, names in in_groups.items() if len(names) > 1}
+
+    def matrix(self):
+        """(lineages x groups) 0/1 assignment matrix."""
+        matrix = np.zeros((len(self.lineages), len(self.names)))
+        matrix[self.rows, self.cols] = 1
+        return matrix
+
+    def groups(self, df, union_of=None):
+        """Total of each group's lineage columns per row.
+
+        Missing counts count as 0, as in DataFrame.sum.
+
+        Parameters
+        ----------
+        df : pandas.core.frame.DataFrame
+            Frame with the lineage columns.
+        union_of : list, optional
+            Groups whose lineages are also totalled together in an '_any'
+            column, each lineage counted once however many of the groups it
+            is in. Defaults to every group.
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            One column per group plus '_any', aligned with df.
+        """
+        matrix = self.matrix()
+        union_cols = [self.names.index(name) for name in (self.names if union_of is None else union_of)]
+        union = matrix[:, union_cols].max(axis=1) if union_cols else np.zeros(len(self.lineages))
+        values = np.nan_to_num(df[self.lineages].to_numpy(dtype='float64'), nan=0.0)
+        return pd.DataFrame(values @ np.column_stack([matrix, union]), columns=self.names + ['_any'], index=df.index)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Roll country-level rows up to continents, WHO regions and global in one pass.
+
+The date keys (i.e. collect_date, collect_yearweek, collect_weekstartdate,
+owid_date) are factorized once into a single integer code per row. Each
+aggregation level is then just an integer label per row, taken from a column
+of the frame (owid_continent, who_region) or from a country -> group mapping
+applied to the factorized countries, so rolling up one more level costs one
+sort of integer keys and one vectorized reduction over the value columns.
+
+A level is a dict with
+    column : the output column holding the level's label, or None for a
+             single group (global)
+    mapping : optional dict or Series country -> label, used instead of an
+              existing column, i.e. for income groups or sub-regions
+    location : format of aggregate_location, i.e. 'WHO Region: {}'
+"""
+
+import numpy as np
+import pandas as pd
+
+from filter_gisaid_metadata import take_by_codes
+
+CONTINENT_LEVEL = {'column': 'owid_continent', 'location': '{}'}
+WHO_REGION_LEVEL = {'column': 'who_region', 'location': 'WHO Region: {}'}
+GLOBAL_LEVEL = {'column': None, 'location': 'Global'}
+
+
+class LocationRollup:
+    """Key codes of one frame, shared by every level rolled up from it.
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Country-level rows.
+    group_cols : list
+        Columns every level is grouped by in addition to its own label.
+    country_col : str
+        Country column that mapping levels are applied to.
+    """
+
+    def __init__(self, df, group_cols, country_col='owid_location'):
+        self.df = df
+        self.group_cols = list(group_cols)
+        self.country_col = country_col
+
+        # one sorted code per distinct combination of the group columns, -1 where any is missing.
+        # codes are compressed after each column so the combined key stays small
+        key = np.zeros(df.shape[0], dtype='int64')
+        valid = np.ones(df.shape[0], dtype=bool)
+        for col in self.group_cols:
+            codes, uniques = pd.factorize(df[col], sort=True)
+            valid &= codes >= 0
+            key = pd.factorize(key * max(len(uniques), 1) + np.maximum(codes, 0), sort=True)[0]
+        self.key_codes = np.where(valid, key, -1)
+        self.n_keys = key.max() + 1 if len(key) else 0
+        # a row holding each key's values, to read the group columns back from
+        self.key_rows = np.zeros(self.n_keys, dtype='int64')
+        self.key_rows[self.key_codes[valid]] = np.flatnonzero(valid)
+        self._country_codes = None
+
+    def level_codes(self, level):
+        """Sorted label codes (-1 for missing) and labels of a level."""
+        if level['column'] is None:
+            return np.zeros(self.df.shape[0], dtype='int64'), np.array([None], dtype=object)
+        if level.get('mapping') is None:
+            codes, labels = pd.factorize(self.df[level['column']], sort=True)
+            return codes, np.asarray(labels)
+        if self._country_codes is None:
+            self._country_codes = pd.factorize(self.df[self.country_col])
+        codes, countries = self._country_codes
+        mapping = dict(level['mapping'])
+        codes, labels = pd.factorize(take_by_codes([mapping.get(c, np.nan) for c in countries], codes), sort=True)
+        return codes, np.asarray(labels)
+
+    def group_keys(self, level):
+        """Combined (group columns, level) code per row, -1 where either is missing.
+
+        Codes sort in the same order as the group column values then the
+        level label, so groups come out in groupby(sort=True) order.
+        """
+        codes, labels = self.level_codes(level)
+        n_labels = max(len(labels), 1)
+        keys = np.where((self.key_codes >= 0) & (codes >= 0), self.key_codes * n_labels + codes, -1)
+        return keys, labels, n_labels
+
+    def level_frame(self, level, group_keys, labels, n_labels):
+        """Group columns and level label for each group key, with aggregate_location."""
+        out = self.df[self.group_cols].iloc[self.key_rows[group_keys // n_labels]].reset_index(drop=True)
+        if level['column'] is not None:
+            out[level['column']] = labels[group_keys % n_labels]
+            out['aggregate_location'] = [level['location'].format(x) for x in out[level['column']]]
+        else:
+            out['aggregate_location'] = level['location']
+        return out
+
+    def sums(self, level, value_cols=None):
+        """Sum of the numeric columns per group columns and level label.
+
+        Parameters
+        ----------
+        level : dict
+            Level to roll up to.
+        value_cols : list, optional
+            Columns to add up. Defaults to every numeric (or bool) column
+            that isn't a group column or the level column, as groupby().sum()
+            would pick. Missing values count as 0.
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            The same rows and columns as
+            df.groupby(group_cols+[level column]).sum().reset_index(), plus
+            aggregate_location.
+        """
+        if value_cols is None:
+            skip = set(self.group_cols) | {level['column']}
+            value_cols = [c for c in self.df.columns if c not in skip and pd.api.types.is_numeric_dtype(self.df[c])
+                          and not isinstance(self.df[c].dtype, pd.CategoricalDtype)]
+        keys, labels, n_labels = self.group_keys(level)
+
+        rows = np.flatnonzero(keys >= 0)
+        order = rows[np.argsort(keys[rows], kind='stable')]
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(order) else np.array([], dtype='int64')
+
+        out = self.level_frame(level, sorted_keys[starts], labels, n_labels)
+        location = out.pop('aggregate_location')
+        if len(order) and value_cols:
+            values = np.nan_to_num(self.df[value_cols].to_numpy(dtype='float64')[order], nan=0.0)
+            totals = np.add.reduceat(values, starts, axis=0)
+        else:
+            totals = np.zeros((len(starts), len(value_cols)))
+        # the value columns are added in one concat, as inserting hundreds of lineage columns one by one fragments the frame
+        totals = pd.DataFrame({col: totals[:, i].astype('int64') if (self.df[col].dtype.kind in 'iub') else totals[:, i]
+                               for i, col in enumerate(value_cols)}, index=out.index)
+        out = pd.concat([out, totals], axis=1)
+        out['aggregate_location'] = location
+        return out
+
+    def value_counts(self, level, value_col='lag_days', count_col='row_count'):
+        """Rows per group columns, level label and value of value_col.
+
+        The counts can be fed to calc_lagstats_from_counts with
+        group_cols + [level column] to get the level's quantiles.
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            Group columns, level column, value_col, count_col and
+            aggregate_location, one row per distinct combination.
+        """
+        keys, labels, n_labels = self.group_keys(level)
+        values = self.df[value_col].to_numpy().astype('int64')
+        rows = keys >= 0
+        if not rows.any():
+            out = self.level_frame(level, np.array([], dtype='int64'), labels, n_labels)
+            out[value_col], out[count_col] = np.array([], dtype='int64'), np.array([], dtype='int64')
+            return out
+        low = values[rows].min()
+        n_values = values[rows].max() - low + 1
+        combined, counts = np.unique(keys[rows] * n_values + (values[rows] - low), return_counts=True)
+
+        out = self.level_frame(level, combined // n_values, labels, n_labels)
+        location = out.pop('aggregate_location')
+        out[value_col] = combined % n_values + low
+        out[count_col] = counts
+        out['aggregate_location'] = location
+        return out
+
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Persisted per-accession state for incremental GISAID metadata processing.
+
+Keeps the previous run's annotated rows (the subset_gisaid_df output plus a
+hash of the Nextstrain virus name and of the raw row), the sequence counts and lag
+histogram built from them, so the next run only needs to process new or
+changed accessions. The state also records a fingerprint of the country name
+rules and the annotation code, and is only reused while those are unchanged.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+from datetime import date
+
+import pandas as pd
+
+import filter_gisaid_metadata
+from filter_gisaid_metadata import METADATA_USECOLS
+from lag_histograms import LagHistogram
+from stage_cache import code_version
+
+# columns kept in the state on top of the subset_gisaid_df output
+STATE_EXTRA_COLS = ['virus_hash', 'raw_hash']
+
+
+def hash_raw_rows(gisaid_df: pd.core.frame.DataFrame) -> pd.core.series.Series:
+    """Fingerprint each raw metadata row.
+
+    Parameters
+    ----------
+    gisaid_df : pandas.core.frame.DataFrame
+        Raw GISAID metadata, as read by read_metadata_chunks.
+
+    Returns
+    -------
+    raw_hash : pandas.core.series.Series
+        uint64 hash of the METADATA_USECOLS values of each row. Accession ID
+        is one of them, so equal hashes mean the same accession, unchanged.
+    """
+    return pd.util.hash_pandas_object(gisaid_df[METADATA_USECOLS], index=False)
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def annotation_version() -> dict:
+    """What the annotations of a row depend on besides the row itself.
+
+    Returns
+    -------
+    dict
+        sha256 of the country name corrections and known countries files at
+        their current paths, and of the source of filter_gisaid_metadata and
+        this module (hash_raw_rows decides which rows are reused).
+    """
+    return {'country_name_corrections': _file_sha256(filter_gisaid_metadata.COUNTRY_NAME_CORRECTIONS_PATH),
+            'known_countries': _file_sha256(filter_gisaid_metadata.KNOWN_COUNTRIES_PATH),
+            'code': code_version([filter_gisaid_metadata, sys.modules[__name__]])}
+
+
+def load_state(state_dir: str):
+    """Load the state written by the previous run.
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory holding the state files.
+
+    Returns
+    -------
+    state : tuple or None
+        (state_df, gisaid_counts_df, meta), or None if there is no complete
+        state in state_dir.
+    """
+    meta_path = os.path.join(state_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    state_df = pd.read_pickle(os.path.join(state_dir, 'annotated.pkl'))
+    gisaid_counts_df = pd.read_pickle(os.path.join(state_dir, 'counts.pkl'))
+    return state_df, gisaid_counts_df, meta
+
+
+def load_lag_histogram(state_dir: str, group_cols: list):
+    """Lag histogram of the stored state, or None if the state has none."""
+    path = os.path.join(state_dir, 'lag_histogram.pkl')
+    if not os.path.exists(os.path.join(state_dir, 'meta.json')) or not os.path.exists(path):
+        return None
+    return LagHistogram.read_pickle(path, group_cols)
+
+
+def save_state(state_dir: str, state_df: pd.core.frame.DataFrame,
+               gisaid_counts_df: pd.core.frame.DataFrame, lag_histogram: LagHistogram = None,
+               annotations: dict = None) -> None:
+    """Write the state for the next run.
+
+    meta.json is written last and is what load_state looks for, so a run that
+    dies halfway leaves either the old state or none, never a mix.
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory holding the state files.
+    state_df : pandas.core.frame.DataFrame
+        Annotated rows for every accession in the export.
+    gisaid_counts_df : pandas.core.frame.DataFrame
+        Sequence counts built from state_df.
+    lag_histogram : LagHistogram, optional
+        lag_days histogram built from state_df.
+    annotations : dict, optional
+        annotation_version() the rows were annotated with.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    meta_path = os.path.join(state_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    frames = [('annotated.pkl', state_df), ('counts.pkl', gisaid_counts_df)]
+    if lag_histogram is not None:
+        frames.append(('lag_histogram.pkl', lag_histogram.counts_df))
+    for name, df in frames:
+        df.to_pickle(os.path.join(state_dir, name + '.tmp'))
+        os.replace(os.path.join(state_dir, name + '.tmp'), os.path.join(state_dir, name))
+    with open(meta_path, 'w') as f:
+        json.dump({'run_date': date.today().strftime('%Y-%m-%d'),
+                   'n_sequences': int(state_df.shape[0]),
+                   'annotations': annotations}, f)
+
+
+def copy_state(state_dir: str, copy_dir: str) -> str:
+    """Copy the state to copy_dir, if there is one, and return copy_dir."""
+    if os.path.exists(os.path.join(state_dir, 'meta.json')):
+        shutil.copytree(state_dir, copy_dir)
+    return copy_dir
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the parsed GISAID metadata export.
+
+The first read of a metadata.tsv parses it chunk by chunk (as
+read_metadata_chunks does, only METADATA_USECOLS with METADATA_DTYPES) and
+writes the typed columns to an uncompressed Arrow IPC file. Later reads of the
+same export memory-map that file instead of parsing the TSV: numeric columns
+are used without copying, and only the string columns are converted.
+
+Snapshots are keyed by the export's size, mtime and a sha256 of three 1 MB
+blocks of its contents (start, middle and end). Hashing the whole export
+would take about as long as parsing it, so sampling is deliberate: an export
+edited in place outside those blocks, with its size and mtime restored, would
+be served from the old snapshot.
+A manifest in the cache folder records the snapshots; writing a new one drops
+older snapshots of the same export and then the least recently used ones over
+the size and count limits. Needs pyarrow.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+from filter_gisaid_metadata import METADATA_DTYPES, METADATA_USECOLS, read_metadata_chunks
+
+# local path
+# PARSE_CACHE_DIR = '../data/cache/parsed_metadata'
+
+# domino path
+PARSE_CACHE_DIR = '/mnt/data/cache/parsed_metadata'
+
+MAX_CACHE_BYTES = 40e9
+MAX_SNAPSHOTS = 3
+# bytes hashed at each of the start, middle and end of the export
+SAMPLE_BYTES = 1 << 20
+
+
+def file_fingerprint(path: str, sample_bytes: int = SAMPLE_BYTES) -> dict:
+    """Size, mtime and sampled-content hash of a file.
+
+    Only sample_bytes at the start, middle and end are hashed, not the whole
+    file. That keeps this well under a second for a multi-GB export, while
+    still catching a replaced file whose size and mtime happen to match.
+    """
+    stat = os.stat(path)
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for offset in sorted({0, max(stat.st_size // 2 - sample_bytes // 2, 0), max(stat.st_size - sample_bytes, 0)}):
+            f.seek(offset)
+            sha256.update(f.read(sample_bytes))
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sample_sha256': sha256.hexdigest()}
+
+
+def snapshot_key(fingerprint: dict) -> str:
+    """Snapshot name for a fingerprint."""
+    key = '%(size)d-%(mtime_ns)d-%(sample_sha256)s' % fingerprint
+    return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+
+def _arrow_schema():
+    import pyarrow as pa
+    # categoricals are stored as plain strings, since each chunk would have its own dictionary
+    arrow_types = {'object': pa.string(), 'category': pa.string(), 'float32': pa.float32(), 'float64': pa.float64()}
+    return pa.schema([(col, arrow_types[METADATA_DTYPES[col]]) for col in METADATA_USECOLS])
+
+
+def _load_manifest(cache_dir):
+    path = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _snapshot_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.arrow')
+
+
+def write_snapshot(metadata_path: str, path: str, chunksize: int = 500000) -> int:
+    """Parse metadata_path in chunks into an Arrow IPC file at path.
+
+    Returns
+    -------
+    int
+        Rows written.
+    """
+    import pyarrow as pa
+
+    schema = _arrow_schema()
+    categorical_cols = {col: object for col, dtype in METADATA_DTYPES.items() if dtype == 'category'}
+    n_rows = 0
+    with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for chunk in read_metadata_chunks(metadata_path, chunksize=chunksize):
+            writer.write_batch(pa.RecordBatch.from_pandas(chunk.astype(categorical_cols), schema=schema,
+                                                          preserve_index=False))
+            n_rows += chunk.shape[0]
+    os.replace(path + '.tmp', path)
+    return n_rows
+
+
+def evict(cache_dir: str, manifest: dict, keep: str = None, max_bytes: float = MAX_CACHE_BYTES,
+          max_snapshots: int = MAX_SNAPSHOTS) -> dict:
+    """Drop the least recently used snapshots over the limits, never keep."""
+    by_last_used = sorted(manifest, key=lambda k: manifest[k]['last_used'], reverse=True)
+    total = 0
+    for i, key in enumerate(by_last_used):
+        total += manifest[key]['bytes']
+        if key != keep and (i >= max_snapshots or total > max_bytes):
+            if os.path.exists(_snapshot_path(cache_dir, key)):
+                os.remove(_snapshot_path(cache_dir, key))
+            print('  Evicted parsed snapshot of %s' % manifest[key]['source'])
+            total -= manifest[key]['bytes']
+            del manifest[key]
+    return manifest
+
+
+def cached_metadata_table(metadata_path: str, cache_dir: str = PARSE_CACHE_DIR, chunksize: int = 500000,
+                          max_bytes: float = MAX_CACHE_BYTES, max_snapshots: int = MAX_SNAPSHOTS):
+    """Memory-mapped Arrow table of the parsed export, parsing it first if needed.
+
+    Parameters
+    ----------
+    metadata_path : str
+        Path to the tab-separated GISAID metadata.tsv.
+    cache_dir : str
+        Folder holding the snapshots and manifest.json.
+    chunksize : int
+        Rows per chunk when parsing a new snapshot.
+    max_bytes, max_snapshots : float, int
+        Limits applied when a new snapshot is written.
+
+    Returns
+    -------
+    pyarrow.Table
+        METADATA_USECOLS of every row, backed by the memory-mapped snapshot.
+    """
+    import pyarrow as pa
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = file_fingerprint(metadata_path)
+    key = snapshot_key(fingerprint)
+    path = _snapshot_path(cache_dir, key)
+    manifest = _load_manifest(cache_dir)
+
+    if key not in manifest or not os.path.exists(path):
+        print('  Parsing %s into the parse cache...' % metadata_path)
+        n_rows = write_snapshot(metadata_path, path, chunksize)
+        source = os.path.abspath(metadata_path)
+        # an export that changed in place makes its older snapshots stale
+        for stale in [k for k, entry in manifest.items() if entry['source'] == source and k != key]:
+            if os.path.exists(_snapshot_path(cache_dir, stale)):
+                os.remove(_snapshot_path(cache_dir, stale))
+            del manifest[stale]
+        manifest[key] = dict(fingerprint, source=source, rows=n_rows, bytes=os.path.getsize(path),
+                             created=time.time(), last_used=time.time())
+        manifest = evict(cache_dir, manifest, key, max_bytes, max_snapshots)
+    else:
+        print('  Using parsed snapshot of %s' % metadata_path)
+        manifest[key]['last_used'] = time.time()
+    _save_manifest(cache_dir, manifest)
+
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+def table_to_metadata(table, start: int = 0) -> pd.core.frame.DataFrame:
+    """Frame with the dtypes of read_metadata_chunks, indexed from start."""
+    gisaid_df = table.to_pandas()
+    # string columns come back as the str dtype with newer pandas, so object columns are cast back too
+    gisaid_df = gisaid_df.astype({col: dtype for col, dtype in METADATA_DTYPES.items() if dtype in ('category', 'object')})
+    gisaid_df.index = pd.RangeIndex(start, start + gisaid_df.shape[0])
+    return gisaid_df
+
+
+def read_cached_metadata(metadata_path: str, cache_dir: str = PARSE_CACHE_DIR) -> pd.core.frame.DataFrame:
+    """The whole parsed export as a frame, see cached_metadata_table."""
+    return table_to_metadata(cached_metadata_table(metadata_path, cache_dir))
+
+
+def read_cached_metadata_chunks(metadata_path: str, cache_dir: str = PARSE_CACHE_DIR, chunksize: int = 500000):
+    """read_metadata_chunks served from the parse cache.
+
+    Each chunk is a slice of the memory-mapped table, so only one chunk at a
+    time is converted to pandas.
+    """
+    table = cached_metadata_table(metadata_path, cache_dir, chunksize)
+    for start in range(0, table.num_rows, chunksize):
+        yield table_to_metadata(table.slice(start, chunksize), start)
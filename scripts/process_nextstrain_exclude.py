@@ -6,51 +6,193 @@ Created on Wed Nov 17 12:16:57 2021.
 
 Pulls and processes the Nextstrain sequences to exclude from GISAID in order
 to clean the GISAID metadata. Adapted by original file by Dave Luo from PTC.
+
+The list is parsed once per version into an ExcludeIndex of sorted 64-bit
+hashes of the virus names, cached next to the downloaded file, so membership
+is a vectorized hash lookup rather than a set of strings held by each run.
 """
 
-import requests
+import datetime
+import json
+import os
+
+import numpy as np
 import pandas as pd
+import fetch_cache
+
+EXCLUDE_INDEX_FILE = 'nextstrain_exclude_index.npz'
 
-def load_nextstrain_exclude_sequences() -> requests.models.Response:
-    """Pull list of GISAID sequences identified as problematic by Nextstrain.
+# indexes loaded this run, by cache_dir, so every stage records matches on the same one
+_loaded_indexes = {}
 
-    Best documentation I can find on cxclusion criteria is here:
+def normalize_exclude_entries(exclude_sequences_text: str) -> list:
+    """Virus names of the exclude list, in the form GISAID metadata uses.
+
+    Comment and blank lines are skipped, surrounding whitespace (i.e. a CR
+    from CRLF line ends) is removed and each name is prepended with hCoV-19/.
+    Best documentation on the exclusion criteria is here:
     https://docs.nextstrain.org/projects/ncov/en/latest/analysis/data-prep.html
 
+    Parameters
+    ----------
+    exclude_sequences_text : str
+        Contents of exclude.txt from the Nextstrain Github.
+
     Returns
     -------
-    exclude_sequences_response : requests.models.Response object
-        Contains the exclude.txt values from the Nextstrain Github and
-        information about the status of the connection request.
+    list
+        Unique names prepended with hCoV-19/, in list order.
     """
-    url = 'https://raw.githubusercontent.com/nextstrain/ncov/master/defaults/exclude.txt'
-    exclude_sequences_response = requests.get(url)
+    entries = [x.strip() for x in exclude_sequences_text.split('\n')]
+    return list(dict.fromkeys(
+        "hCoV-19/%s" % x for x in entries if x != '' and not x.startswith('#')))
+
 
-    return exclude_sequences_response
+def hash_virus_names(virus_names) -> np.ndarray:
+    """uint64 hash of each virus name, the key of an ExcludeIndex."""
+    return pd.util.hash_array(np.asarray(virus_names, dtype=object))
 
 
-def process_nextstrain_exclude_sequences(exclude_sequences_response:
-                                         requests.models.Response) -> set:
-    """Convert Response object to set compatible with GISAID (meta)data.
+class ExcludeIndex:
+    """Sorted 64-bit hashes of the exclude list entries.
 
     Parameters
     ----------
-    exclude_sequences_response : requests.models.Response
-        Contains the exclude.txt values from the Nextstrain Github and
-        information about the status of the connection request.
+    entries : list
+        Virus names to exclude, see normalize_exclude_entries.
+    version : str, optional
+        Version of the list, the sha256 of the downloaded file.
+    etag : str, optional
+        ETag the server sent with that version.
+
+    Notes
+    -----
+    Matching compares hashes only. With a few thousand entries the chance
+    that any of tens of millions of virus names collides with one is around
+    1e-8.
+    """
+
+    def __init__(self, entries, version=None, etag=None):
+        entries = np.asarray(entries, dtype=object)
+        hashes = hash_virus_names(entries)
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.entries = entries[order]
+        self.version = version
+        self.etag = etag
+        # entries seen in the metadata this run
+        self.matched = np.zeros(len(self.hashes), dtype=bool)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def contains_hashes(self, hashes, record=True) -> np.ndarray:
+        """Which of the hashed virus names are on the list.
+
+        Parameters
+        ----------
+        hashes : numpy.ndarray
+            uint64 hashes from hash_virus_names.
+        record : bool
+            Mark the entries that matched, see match_report.
+
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array aligned with hashes.
+        """
+        hashes = np.asarray(hashes, dtype='uint64')
+        if len(self.hashes) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        position = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        found = self.hashes[position] == hashes
+        if record:
+            self.matched[position[found]] = True
+        return found
+
+    def contains(self, virus_names, record=True) -> np.ndarray:
+        """Which of virus_names are on the list, see contains_hashes."""
+        return self.contains_hashes(hash_virus_names(virus_names), record)
+
+    def match_report(self) -> pd.core.frame.DataFrame:
+        """Every entry and whether it matched a sequence this run."""
+        return pd.DataFrame({'entry': self.entries, 'matched': self.matched})
+
+    def save(self, path: str) -> None:
+        """Store the hashes, entries, version and ETag, see load."""
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, hashes=self.hashes, entries=self.entries.astype(str),
+                     version=np.array(self.version or ''), etag=np.array(self.etag or ''))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load an index written by save."""
+        with np.load(path) as stored:
+            index = cls.__new__(cls)
+            index.hashes = stored['hashes']
+            index.entries = stored['entries'].astype(object)
+            index.version = str(stored['version']) or None
+            index.etag = str(stored['etag']) or None
+        index.matched = np.zeros(len(index.hashes), dtype=bool)
+        return index
+
+
+def load_exclude_index(cache_dir: str = None) -> ExcludeIndex:
+    """ExcludeIndex of the current Nextstrain exclude list.
+
+    The list goes through fetch_cache. The index is rebuilt only when the
+    downloaded file changed, otherwise the stored one next to it is loaded,
+    and it is loaded once per run.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        fetch_cache root. Defaults to fetch_cache.CACHE_DIR.
 
     Returns
     -------
-    exclude_sequences : set
-        The names of the sequences in the GISAID repository to be excluded
-        prepended with hcov-19/ to allow compatability with GISAID structure.
+    ExcludeIndex
+        Shared by every caller in this process, so matches add up.
     """
-    exclude_sequences = {
-        "hCoV-19/%s" % x for x in
-        exclude_sequences_response.text.split('\n') if x != ''
-        and not x.startswith('#')}
+    cache_dir = cache_dir or fetch_cache.CACHE_DIR
+    if cache_dir in _loaded_indexes:
+        return _loaded_indexes[cache_dir]
+
+    path = fetch_cache.fetch(fetch_cache.NEXTSTRAIN_EXCLUDE_URL, cache_dir)
+    entry = fetch_cache.cache_entry(fetch_cache.NEXTSTRAIN_EXCLUDE_URL, cache_dir) or {}
+    version = os.path.basename(path)
+    index_path = os.path.join(cache_dir, EXCLUDE_INDEX_FILE)
+
+    index = ExcludeIndex.load(index_path) if os.path.exists(index_path) else None
+    if index is None or index.version != version:
+        with open(path, encoding='utf-8') as f:
+            index = ExcludeIndex(normalize_exclude_entries(f.read()), version, entry.get('etag'))
+        index.save(index_path)
+        print('  Indexed %d Nextstrain exclude entries' % len(index))
+
+    _loaded_indexes[cache_dir] = index
+    return index
 
-    return exclude_sequences
+
+def write_exclude_matches(index: ExcludeIndex, matches_path: str, history_path: str) -> None:
+    """Write which exclude entries matched this run and log the list version.
+
+    Parameters
+    ----------
+    index : ExcludeIndex
+        Index the run's sequences were checked against.
+    matches_path : str
+        CSV of every entry and whether it matched, overwritten each run.
+    history_path : str
+        JSON lines file with one line per run: date, list version and ETag,
+        entries and entries matched.
+    """
+    index.match_report().to_csv(matches_path, index=False)
+    with open(history_path, 'a') as f:
+        f.write(json.dumps({'run_date': datetime.date.today().strftime('%Y-%m-%d'),
+                            'version': index.version, 'etag': index.etag,
+                            'entries': int(len(index)), 'matched': int(index.matched.sum())}) + '\n')
 
 
 def is_nextstrain_exclude_sequence(gisaid_df: pd.core.frame.DataFrame,
@@ -61,7 +203,7 @@ def is_nextstrain_exclude_sequence(gisaid_df: pd.core.frame.DataFrame,
     ----------
     gisaid_df : pandas.core.frame.DataFrame
         The dataframe containing GISAID metadata.
-    exclude_sequences : set
+    exclude_sequences : ExcludeIndex or set
         The names of the sequences in the GISAID repository to be excluded
         prepended with hcov-19/ to allow compatability with GISAID structure.
 
@@ -71,6 +213,9 @@ def is_nextstrain_exclude_sequence(gisaid_df: pd.core.frame.DataFrame,
         A boolean flag indicating if the sequence is in the exclude list.
 
     """
-    exclude = gisaid_df['Virus name'].isin(exclude_sequences)
+    if isinstance(exclude_sequences, ExcludeIndex):
+        exclude = pd.Series(exclude_sequences.contains(gisaid_df['Virus name']), index=gisaid_df.index)
+    else:
+        exclude = gisaid_df['Virus name'].isin(exclude_sequences)
 
     return exclude
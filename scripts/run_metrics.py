@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory records for pipeline runs.
+
+Each stage of a run is wrapped in RunMetrics.stage, which records wall time,
+CPU time, the growth of the process' peak RSS and the rows and in-memory
+size of the stage's input and output frames. Records are appended as JSON
+lines to a metrics file next to the processed outputs, one line per stage
+plus a summary line per run, and a table is printed at the end of the run.
+
+Optionally each stage can be run under cProfile (a .prof file per stage) or
+tracemalloc (peak traced allocations added to the record). Without a profiler
+the cost per stage is a few clock and getrusage calls.
+"""
+
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
+
+
+def frame_stats(frames) -> tuple:
+    """Total rows and shallow size in MB of the frames, ignoring non-frames.
+
+    Shallow sizes (memory_usage without deep=True) are used so measuring
+    doesn't walk every string of object columns.
+    """
+    rows, size = 0, 0
+    for df in frames:
+        if isinstance(df, pd.DataFrame):
+            rows += df.shape[0]
+            size += df.memory_usage(index=True).sum()
+        elif isinstance(df, pd.Series):
+            rows += df.shape[0]
+            size += df.memory_usage(index=True)
+    return rows, size / 1e6
+
+
+class StageRecord(dict):
+    """Record of one stage. Call output() with the stage's result frame(s)."""
+
+    def output(self, *frames):
+        self['rows_out'], self['mb_out'] = frame_stats(frames)
+
+
+class RunMetrics:
+    """Collects the stage records of one run.
+
+    Parameters
+    ----------
+    metrics_path : str, optional
+        JSON lines file the records are appended to. Nothing is written if
+        not given.
+    profiler : str, optional
+        'cprofile' or 'tracemalloc' to profile every stage.
+    profile_dir : str, optional
+        Folder for the cProfile output, one <run_id>_<stage>.prof per stage.
+        Defaults to the folder of metrics_path.
+    """
+
+    def __init__(self, metrics_path=None, profiler=None, profile_dir=None):
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError('Unknown profiler %s, expected one of %s' % (profiler, PROFILERS))
+        self.metrics_path = metrics_path
+        self.profiler = profiler
+        self.profile_dir = profile_dir or (os.path.dirname(metrics_path) if metrics_path else '.')
+        self.run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.records = []
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name, *inputs):
+        """Time and measure the block as stage name.
+
+        Parameters
+        ----------
+        name : str
+            Stage name.
+        *inputs : pandas.core.frame.DataFrame
+            Frames the stage reads, for rows_in/mb_in.
+
+        Yields
+        ------
+        StageRecord
+            Call its output() with the frames the stage produced.
+        """
+        record = StageRecord(run_id=self.run_id, stage=name)
+        record['rows_in'], record['mb_in'] = frame_stats(inputs)
+        record['rows_out'], record['mb_out'] = None, None
+
+        profile = None
+        if self.profiler == 'cprofile':
+            profile = cProfile.Profile()
+        elif self.profiler == 'tracemalloc':
+            tracemalloc.start()
+
+        rss_before = peak_rss_mb()
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        if profile is not None: profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None: profile.disable()
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            record['peak_rss_mb'] = peak_rss_mb()
+            # the peak only grows, so this is how far the stage raised the high-water mark
+            record['peak_rss_delta_mb'] = record['peak_rss_mb'] - rss_before
+            if self.profiler == 'tracemalloc':
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+                tracemalloc.stop()
+            if profile is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile_path'] = os.path.join(self.profile_dir, '%s_%s.prof' % (self.run_id, name))
+                profile.dump_stats(record['profile_path'])
+            self.records.append(record)
+            self._write(record)
+
+    def _write(self, record):
+        if self.metrics_path is None:
+            return
+        with open(self.metrics_path, 'a') as f:
+            f.write(json.dumps(record, default=float) + '\n')
+
+    def summary(self):
+        """Write the run summary line and print the per-stage table.
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            One row per stage.
+        """
+        summary = {'run_id': self.run_id, 'stage': 'run_total',
+                   'wall_s': time.perf_counter() - self.start_wall,
+                   'cpu_s': time.process_time() - self.start_cpu,
+                   'peak_rss_mb': peak_rss_mb(),
+                   'stages': len(self.records)}
+        self._write(summary)
+
+        stages_df = pd.DataFrame(self.records)
+        if not stages_df.empty:
+            cols = [c for c in ['stage', 'wall_s', 'cpu_s', 'peak_rss_delta_mb', 'traced_peak_mb',
+                                'rows_in', 'rows_out', 'mb_in', 'mb_out'] if c in stages_df.columns]
+            print('Stage timings:')
+            print(stages_df[cols].to_string(index=False, float_format=lambda x: '%.2f' % x))
+        print('Total: %.1fs wall, %.1fs CPU, peak RSS %.0f MB' % (
+            summary['wall_s'], summary['cpu_s'], summary['peak_rss_mb']))
+        return stages_df
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Per-accession snapshots of each run, stored as deltas against the previous run.
+
+A snapshot is the key columns of every annotated sequence (accession,
+collection date, country, lineage and flags). The store keeps the latest
+snapshot in full, to diff the next run against, and one delta per run: the
+accessions added, removed or changed, with their values before and after.
+Because deltas carry both sides, what changed between any two runs, and the
+resulting count changes per country and lineage, come from the deltas in
+between alone, without reading a full snapshot:
+
+    store = SnapshotStore(SNAPSHOT_DIR)
+    changes = store.diff()                   # since the previous run
+    changes = store.diff(since='2022-05-01') # since the last run on or before that day
+    changes.count_changes(['country', 'Pango lineage'])
+
+Accession IDs of the form EPI_ISL_<n> are stored as the integer n.
+"""
+
+import json
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_COLS = ['Accession ID', 'collect_date', 'country', 'Pango lineage', 'nextstrain_excluded', 'any_abnormal']
+VALUE_COLS = SNAPSHOT_COLS[1:]
+ACCESSION_PREFIX = 'EPI_ISL_'
+
+
+def encode_accessions(accessions):
+    """EPI_ISL_<n> IDs as int64 n, or the IDs unchanged if any has another form."""
+    accessions = pd.Series(accessions, dtype=object)
+    if accessions.str.startswith(ACCESSION_PREFIX).all():
+        numbers = pd.to_numeric(accessions.str.slice(len(ACCESSION_PREFIX)), errors='coerce')
+        if numbers.notna().all():
+            return numbers.to_numpy(dtype='int64')
+    return accessions.to_numpy()
+
+
+def decode_accessions(accessions):
+    accessions = np.asarray(accessions)
+    if accessions.dtype.kind == 'i':
+        return np.array([ACCESSION_PREFIX + str(x) for x in accessions], dtype=object)
+    return accessions
+
+
+class SnapshotBuilder:
+    """Collects the snapshot columns of annotated chunks as they are processed."""
+
+    def __init__(self):
+        self.parts = []
+
+    def add(self, gisaid_df):
+        part = gisaid_df[SNAPSHOT_COLS].copy()
+        part['Accession ID'] = encode_accessions(part['Accession ID'])
+        for col in ['country', 'Pango lineage']:
+            part[col] = part[col].astype('category')
+        self.parts.append(part)
+
+    def frame(self):
+        """The snapshot, one row per accession (the last one seen for repeats)."""
+        snapshot_df = pd.concat(self.parts, ignore_index=True) if self.parts else \
+            pd.DataFrame(columns=SNAPSHOT_COLS)
+        for col in ['country', 'Pango lineage']:
+            snapshot_df[col] = snapshot_df[col].astype('category')
+        return snapshot_df.drop_duplicates('Accession ID', keep='last', ignore_index=True)
+
+
+def _differs(old, new):
+    # element-wise old != new, treating two missing values as equal
+    old, new = pd.Series(old, dtype=object), pd.Series(new, dtype=object)
+    return ~((old == new) | (old.isna() & new.isna())).to_numpy()
+
+
+def diff_snapshots(old_df, new_df):
+    """Delta between two snapshots.
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per added, removed or changed accession: Accession ID,
+        change, and old_ / new_ of each value column (missing on the side
+        where the accession is absent).
+    """
+    positions = pd.Index(old_df['Accession ID']).get_indexer(new_df['Accession ID'])
+    in_new = np.zeros(old_df.shape[0], dtype=bool)
+    in_new[positions[positions >= 0]] = True
+
+    common_new = np.flatnonzero(positions >= 0)
+    common_old = positions[common_new]
+    changed = np.zeros(len(common_new), dtype=bool)
+    for col in VALUE_COLS:
+        changed |= _differs(old_df[col].to_numpy()[common_old], new_df[col].to_numpy()[common_new])
+
+    added = new_df.iloc[np.flatnonzero(positions < 0)]
+    removed = old_df.iloc[np.flatnonzero(~in_new)]
+    parts = [
+        _delta_rows('added', added['Accession ID'], None, added),
+        _delta_rows('removed', removed['Accession ID'], removed, None),
+        _delta_rows('changed', new_df['Accession ID'].iloc[common_new[changed]],
+                    old_df.iloc[common_old[changed]], new_df.iloc[common_new[changed]]),
+    ]
+    return pd.concat(parts, ignore_index=True)
+
+
+def _delta_rows(change, accessions, old_df, new_df):
+    delta_df = pd.DataFrame({'Accession ID': np.asarray(accessions), 'change': change})
+    for side, df in [('old_', old_df), ('new_', new_df)]:
+        for col in VALUE_COLS:
+            # the missing side is object too, so concatenating with the other changes doesn't mix in float columns
+            delta_df[side + col] = np.full(delta_df.shape[0], np.nan, dtype=object) if df is None else \
+                np.asarray(df[col].to_numpy(), dtype=object)
+    return delta_df
+
+
+class SnapshotDiff:
+    """Accessions added, removed and changed between two runs.
+
+    Parameters
+    ----------
+    delta_df : pandas.core.frame.DataFrame
+        Output of diff_snapshots, or of composing several.
+    """
+
+    def __init__(self, delta_df):
+        self.delta_df = delta_df
+
+    def _rows(self, mask):
+        rows_df = self.delta_df[mask].copy()
+        rows_df['Accession ID'] = decode_accessions(rows_df['Accession ID'])
+        return rows_df.reset_index(drop=True)
+
+    @property
+    def added(self):
+        return self._rows(self.delta_df['change'] == 'added')
+
+    @property
+    def removed(self):
+        return self._rows(self.delta_df['change'] == 'removed')
+
+    @property
+    def changed(self):
+        return self._rows(self.delta_df['change'] == 'changed')
+
+    @property
+    def relineaged(self):
+        """Changed accessions whose Pango lineage is different."""
+        return self._rows((self.delta_df['change'] == 'changed') &
+                          _differs(self.delta_df['old_Pango lineage'], self.delta_df['new_Pango lineage']))
+
+    def count_changes(self, by=('country', 'Pango lineage')):
+        """Net change in sequences per group.
+
+        Each delta row takes one sequence from its old group and adds one to
+        its new group, so a re-lineaged accession moves between lineages.
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            by columns and 'sequence_change', groups with no net change left out.
+        """
+        by = list(by)
+        present = self.delta_df['change'] != 'removed'
+        was_present = self.delta_df['change'] != 'added'
+        moves = pd.concat([
+            self.delta_df.loc[was_present, ['old_' + c for c in by]].set_axis(by, axis=1).assign(sequence_change=-1),
+            self.delta_df.loc[present, ['new_' + c for c in by]].set_axis(by, axis=1).assign(sequence_change=1),
+        ], ignore_index=True)
+        changes = moves.groupby(by, dropna=False)['sequence_change'].sum().reset_index()
+        return changes[changes['sequence_change'] != 0].reset_index(drop=True)
+
+
+def compose_deltas(deltas):
+    """One delta equivalent to applying deltas in order.
+
+    Each accession keeps the old values of its first delta row and the new
+    values of its last; accessions that end up as they started drop out.
+    """
+    if not deltas:
+        return _delta_rows('changed', [], None, None).iloc[:0]
+    stacked = pd.concat(deltas, ignore_index=True)
+    grouped = stacked.groupby('Accession ID', sort=False)
+    first = grouped.head(1).set_index('Accession ID')
+    last = stacked.loc[grouped.tail(1).index].set_index('Accession ID').loc[first.index]
+
+    composed = pd.DataFrame({'Accession ID': first.index.to_numpy()})
+    was_present = (first['change'] != 'added').to_numpy()
+    present = (last['change'] != 'removed').to_numpy()
+    for col in VALUE_COLS:
+        composed['old_' + col] = first['old_' + col].to_numpy()
+        composed['new_' + col] = last['new_' + col].to_numpy()
+    composed['change'] = np.select([~was_present & present, was_present & ~present], ['added', 'removed'], 'changed')
+
+    keep = was_present != present
+    both = was_present & present
+    for col in VALUE_COLS:
+        keep |= both & _differs(composed['old_' + col], composed['new_' + col])
+    return composed[keep][['Accession ID', 'change'] + [c for c in composed.columns if c.startswith(('old_', 'new_'))]] \
+        .reset_index(drop=True)
+
+
+class SnapshotStore:
+    """Latest snapshot plus one delta per run in store_dir.
+
+    Parameters
+    ----------
+    store_dir : str
+        Folder holding manifest.json, the latest run's snapshot file and deltas/.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(os.path.join(store_dir, 'deltas'), exist_ok=True)
+        manifest_path = os.path.join(store_dir, 'manifest.json')
+        self.runs = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.runs = json.load(f)['runs']
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def _delta_path(self, name):
+        return os.path.join(self.store_dir, 'deltas', name)
+
+    def latest(self):
+        """Snapshot of the latest run in the manifest, None before the first."""
+        if not self.runs:
+            return None
+        return pd.read_pickle(self._snapshot_path(self.runs[-1]['snapshot']))
+
+    def record(self, snapshot_df, run_date=None):
+        """Store a run's snapshot, from SnapshotBuilder.frame.
+
+        Returns
+        -------
+        SnapshotDiff or None
+            Changes since the previous run, None for the first one.
+        """
+        run_date = run_date or date.today().strftime('%Y-%m-%d')
+        name = '%s-%04d.pkl' % (run_date, len(self.runs))
+        previous_df = self.latest()
+        delta_df = None
+        run = {'run_date': run_date, 'sequences': int(snapshot_df.shape[0]), 'snapshot': 'snapshot-' + name,
+               'delta': None}
+        if previous_df is not None:
+            delta_df = diff_snapshots(previous_df, snapshot_df)
+            run['delta'] = name
+            run.update({change: int((delta_df['change'] == change).sum()) for change in ['added', 'removed', 'changed']})
+            delta_df.to_pickle(self._delta_path(run['delta']))
+        snapshot_df.to_pickle(self._snapshot_path(run['snapshot']))
+
+        # files are named after the run and only referenced once the manifest is replaced, so that replace is
+        # the commit point: a run that dies before it leaves the manifest pointing at the previous run's files
+        manifest_path = os.path.join(self.store_dir, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'runs': self.runs + [run]}, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        # then the previous snapshot, and any left by runs that died before their commit, can go
+        for stale in os.listdir(self.store_dir):
+            if stale.startswith('snapshot-') and stale != run['snapshot']:
+                os.remove(self._snapshot_path(stale))
+        self.runs.append(run)
+        return SnapshotDiff(delta_df) if delta_df is not None else None
+
+    def diff(self, since=None):
+        """Changes from an earlier run to the latest one.
+
+        Parameters
+        ----------
+        since : str, optional
+            YYYY-MM-DD; compare against the last run on or before that day.
+            Defaults to the run before the latest.
+
+        Returns
+        -------
+        SnapshotDiff
+            Built from the deltas of the runs after that one only.
+        """
+        if since is None:
+            newer = self.runs[-1:] if len(self.runs) > 1 else []
+        else:
+            newer = [run for run in self.runs if run['run_date'] > since]
+            if len(newer) == len(self.runs):
+                raise ValueError('No snapshot on or before %s, the first is from %s' % (since, self.runs[0]['run_date']))
+        return SnapshotDiff(compose_deltas([pd.read_pickle(self._delta_path(run['delta'])) for run in newer]))
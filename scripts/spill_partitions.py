@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Hash-partitioned spill files for aggregating exports larger than memory.
+
+Rows added to a SpillPartitions are split by a hash of their partition key
+columns (country and collection week by default) and appended to one pickle
+per chunk in that partition's folder. Every row with a given key lands in the
+same partition, so any aggregation grouped by columns that include the key
+(or determine it, as collect_date determines the week) can be run on one
+partition at a time and the results concatenated.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+PARTITION_COLS = ['country', 'collect_weekstartdate']
+
+
+def partitions_for_budget(input_bytes: int, memory_budget_bytes: int) -> int:
+    """Number of partitions so each holds at most memory_budget_bytes of the input.
+
+    Spilled rows are sequence counts, far smaller than the raw export they
+    are counted from, so sizing by the export keeps partitions well inside
+    the budget.
+    """
+    return max(1, math.ceil(input_bytes / memory_budget_bytes))
+
+
+class SpillPartitions:
+    """Spill files of one run, removed on exit when used as a context manager.
+
+    Parameters
+    ----------
+    spill_dir : str
+        Folder the run's temporary folder is created in.
+    n_partitions : int
+        Number of hash partitions.
+    key_cols : list
+        Columns rows are partitioned by.
+    """
+
+    def __init__(self, spill_dir, n_partitions, key_cols=PARTITION_COLS):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='spill-', dir=spill_dir)
+        self.n_partitions = n_partitions
+        self.key_cols = list(key_cols)
+        self.n_chunks = 0
+        self.bytes = [0] * n_partitions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def _partition_dir(self, partition):
+        return os.path.join(self.path, '%04d' % partition)
+
+    def add(self, df):
+        """Append df's rows to their partitions."""
+        partition = pd.util.hash_pandas_object(df[self.key_cols], index=False).to_numpy() % self.n_partitions
+        for p, part_df in df.groupby(partition, sort=False):
+            os.makedirs(self._partition_dir(p), exist_ok=True)
+            path = os.path.join(self._partition_dir(p), '%06d.pkl' % self.n_chunks)
+            part_df.to_pickle(path)
+            self.bytes[p] += os.path.getsize(path)
+        self.n_chunks += 1
+
+    def partitions(self):
+        """Rows of each non-empty partition in turn, in the order they were added."""
+        for p in range(self.n_partitions):
+            if not os.path.isdir(self._partition_dir(p)):
+                continue
+            names = sorted(os.listdir(self._partition_dir(p)))
+            yield pd.concat([pd.read_pickle(os.path.join(self._partition_dir(p), name)) for name in names],
+                            ignore_index=True)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline of named stages with outputs memoized on disk.
+
+Each stage is a function of the outputs of the stages it depends on. Its
+cache key is a hash of its name, its config (i.e. lineage lists, replace
+dicts, paths), the source code of the functions and modules it runs, the
+keys of its dependencies and, for stages that read files or downloads, a
+fingerprint of those inputs. Keys only depend on upstream keys, never on
+upstream data, so all keys are known before anything runs: a rerun loads
+the outputs of stages whose key is unchanged and only executes the stages
+downstream of a change. Outputs are pickled to cache_dir and evicted least
+recently used first beyond the size and count limits.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import time
+
+import pandas as pd
+
+# local path
+# STAGE_CACHE_DIR = '../data/cache/stages'
+
+# domino path
+STAGE_CACHE_DIR = '/mnt/data/cache/stages'
+
+MAX_CACHE_BYTES = 20e9
+MAX_ENTRIES = 200
+
+
+def code_version(objects) -> str:
+    """Hash of the source of the given functions, classes or modules."""
+    sha256 = hashlib.sha256()
+    for obj in objects:
+        sha256.update(inspect.getsource(obj).encode())
+    return sha256.hexdigest()
+
+
+class StageCache:
+    """Pickled stage outputs in cache_dir, indexed by manifest.json."""
+
+    def __init__(self, cache_dir=STAGE_CACHE_DIR, max_bytes=MAX_CACHE_BYTES, max_entries=MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _save_manifest(self):
+        manifest_path = os.path.join(self.cache_dir, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def __contains__(self, key):
+        return key in self.manifest and os.path.exists(self._path(key))
+
+    def load(self, key):
+        value = pd.read_pickle(self._path(key))
+        self.manifest[key]['last_used'] = time.time()
+        self._save_manifest()
+        return value
+
+    def store(self, key, stage, value):
+        pd.to_pickle(value, self._path(key) + '.tmp')
+        os.replace(self._path(key) + '.tmp', self._path(key))
+        self.manifest[key] = {'stage': stage, 'bytes': os.path.getsize(self._path(key)),
+                              'created': time.time(), 'last_used': time.time()}
+        self.evict(keep=key)
+        self._save_manifest()
+
+    def evict(self, keep=None):
+        """Drop the least recently used outputs over the limits, never keep."""
+        total = 0
+        for i, key in enumerate(sorted(self.manifest, key=lambda k: self.manifest[k]['last_used'], reverse=True)):
+            total += self.manifest[key]['bytes']
+            if key != keep and (i >= self.max_entries or total > self.max_bytes):
+                if os.path.exists(self._path(key)):
+                    os.remove(self._path(key))
+                total -= self.manifest[key]['bytes']
+                del self.manifest[key]
+
+
+class StagePipeline:
+    """DAG of named stages run through a StageCache.
+
+    Parameters
+    ----------
+    cache : StageCache
+        Where outputs are stored.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.stages = {}
+        self._keys = {}
+        self._values = {}
+        self.report = []
+
+    def add(self, name, func, deps=(), config=None, code=(), fingerprint=None):
+        """Add a stage.
+
+        Parameters
+        ----------
+        name : str
+            Stage name, unique in the pipeline.
+        func : callable
+            Called with the outputs of deps, in order.
+        deps : tuple
+            Names of the stages whose outputs func takes.
+        config : dict, optional
+            Settings the output depends on. Must be JSON serializable, or
+            have a stable repr.
+        code : tuple
+            Functions, classes or modules whose source the output depends
+            on, on top of func itself.
+        fingerprint : callable, optional
+            Returns a JSON serializable description of inputs read from
+            outside the pipeline (file fingerprints, download versions).
+            Called once, when the key is first needed.
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('Stage %s depends on unknown stage %s' % (name, dep))
+        self.stages[name] = {'func': func, 'deps': tuple(deps), 'config': config or {},
+                             'code': (func,) + tuple(code), 'fingerprint': fingerprint}
+
+    def key(self, name):
+        """Cache key of a stage, from its own inputs and its dependencies' keys."""
+        if name not in self._keys:
+            stage = self.stages[name]
+            description = {
+                'stage': name,
+                'config': stage['config'],
+                'code': code_version(stage['code']),
+                'deps': [self.key(dep) for dep in stage['deps']],
+                'fingerprint': stage['fingerprint']() if stage['fingerprint'] is not None else None,
+            }
+            self._keys[name] = hashlib.sha256(
+                json.dumps(description, sort_keys=True, default=repr).encode()).hexdigest()[:32]
+        return self._keys[name]
+
+    def get(self, name):
+        """Output of a stage: from memory, from the cache, or by running it."""
+        if name in self._values:
+            return self._values[name]
+        key = self.key(name)
+        start = time.perf_counter()
+        if key in self.cache:
+            value = self.cache.load(key)
+            status = 'hit'
+        else:
+            stage = self.stages[name]
+            inputs = [self.get(dep) for dep in stage['deps']]
+            # time spent on dependencies is reported under their own names
+            start = time.perf_counter()
+            value = stage['func'](*inputs)
+            self.cache.store(key, name, value)
+            status = 'miss'
+        self.report.append({'stage': name, 'status': status, 'seconds': time.perf_counter() - start, 'key': key})
+        print('  Stage %s: cache %s (%.1fs)' % (name, status, self.report[-1]['seconds']))
+        self._values[name] = value
+        return value
+
+    def summary(self):
+        """Hits and misses of the stages run so far, as a frame."""
+        report_df = pd.DataFrame(self.report, columns=['stage', 'status', 'seconds', 'key'])
+        print('Stage cache: %d hits, %d misses' % ((report_df['status'] == 'hit').sum(),
+                                                   (report_df['status'] == 'miss').sum()))
+        return report_df
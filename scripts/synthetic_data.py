@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic GISAID metadata and OWID data for offline benchmarks.
+
+The generated frames have the columns and value formats of metadata.tsv and
+owid-covid-data.csv, with realistic cardinality: ~200 countries, ~1500
+hierarchical Pango lineages with a skewed frequency distribution, collection
+dates since 2020 with a skewed submission lag, and a small share of rows that
+trip each of the quality filters (short or N-rich sequences, abnormal GC
+content, partial or future dates, non-human hosts, Nextstrain excludes).
+Everything is driven by a seed so runs are repeatable.
+"""
+
+import numpy as np
+import pandas as pd
+
+from filter_gisaid_metadata import check_col_names
+
+START_DATE = '2020-01-01'
+END_DATE = '2022-07-31'
+
+CONTINENTS = ['Africa', 'Asia', 'Europe', 'North America', 'Oceania', 'South America']
+WHO_REGIONS = ['Africa', 'Americas', 'Eastern Mediterranean', 'Europe', 'South-East Asia', 'Western Pacific']
+
+# real names first so the country name corrections get exercised, including raw GISAID spellings
+REAL_COUNTRIES = ['United States', 'United Kingdom', 'Germany', 'Denmark', 'Canada', 'France', 'Japan',
+                  'India', 'Brazil', 'South Africa', 'Australia', 'Spain', 'Sweden', 'Israel', 'Czechia',
+                  'Belgium', 'Netherlands', 'Switzerland', 'Italy', 'Mexico', 'Nigeria', 'Kenya', 'Peru']
+RAW_COUNTRY_SPELLINGS = {'United States': ['USA', 'Puerto Rico'], 'United Kingdom': ['England'],
+                         'Czechia': ['Czech Republic'], 'Nigeria': ['Niogeria']}
+
+
+def make_countries(n_countries=200):
+    """Country names, real ones first then 'Country NNN' placeholders."""
+    placeholders = ['Country %03d' % i for i in range(n_countries - len(REAL_COUNTRIES))]
+    return (REAL_COUNTRIES + placeholders)[:n_countries]
+
+
+def make_lineages(n_lineages=1500, seed=0):
+    """Hierarchical Pango lineage names covering the breakout patterns.
+
+    Includes the lineages named in greek_dict/other_important, wildcard
+    families such as AY.*, BA.*, Q.* and P.1.*, and generic B.1.* sublineages
+    up to n_lineages in total.
+    """
+    rng = np.random.default_rng(seed)
+    named = ['B.1.1.7', 'B.1.351', 'B.1.351.2', 'P.1', 'P.1.1', 'B.1.617.2', 'B.1.1.529', 'C.37', 'B.1.621',
+             'B.1.617.3', 'B.1.427', 'B.1.429', 'B.1.525', 'B.1.526', 'B.1.526.1', 'B.1.617.1', 'P.2', 'P.3',
+             'A', 'B', 'B.1', 'B.1.1']
+    families = ['AY.%d' % i for i in range(1, 134)] + ['Q.%d' % i for i in range(1, 9)]
+    families += ['BA.%d' % i for i in range(1, 6)]
+    families += ['BA.%d.%d' % (i, j) for i in (1, 2, 4, 5) for j in range(1, 30)]
+    families += ['BA.%d.%d.%d' % (i, j, k) for i in (2, 5) for j in range(1, 6) for k in range(1, 10)]
+    lineages = list(dict.fromkeys(named + families))
+    while len(lineages) < n_lineages:
+        depth = rng.integers(1, 4)
+        lineages.append('B.1.' + '.'.join(str(x) for x in rng.integers(1, 700, depth)))
+        lineages = list(dict.fromkeys(lineages))
+    return lineages[:n_lineages]
+
+
+def skewed_choice(rng, values, size, skew=1.1):
+    """Draw values with Zipf-like frequencies, the first values most common."""
+    weights = 1 / np.arange(1, len(values) + 1) ** skew
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size=size, p=weights / weights.sum())]
+
+
+def generate_metadata(n_rows, n_countries=200, n_lineages=1500, seed=0):
+    """Synthetic metadata.tsv frame.
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of sequences.
+    n_countries : int
+        Distinct countries.
+    n_lineages : int
+        Distinct Pango lineages.
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+    gisaid_df : pandas.core.frame.DataFrame
+        Frame with every column check_col_names expects.
+    """
+    rng = np.random.default_rng(seed)
+    countries = make_countries(n_countries)
+    lineages = make_lineages(n_lineages, seed)
+
+    country = skewed_choice(rng, countries, n_rows, skew=1.3)
+    # a share of rows use the raw GISAID spelling of their country
+    for canonical, spellings in RAW_COUNTRY_SPELLINGS.items():
+        rows = np.flatnonzero((country == canonical) & (rng.random(n_rows) < 0.3))
+        country[rows] = np.asarray(spellings, dtype=object)[rng.integers(0, len(spellings), rows.size)]
+    division = np.asarray(['Division %d' % i for i in range(50)], dtype=object)[rng.integers(0, 50, n_rows)]
+    has_division = rng.random(n_rows) < 0.8
+    location = pd.Series('Region / ' + pd.Series(country))
+    location[has_division] = location[has_division] + ' / ' + pd.Series(division)[has_division]
+
+    start, end = pd.Timestamp(START_DATE), pd.Timestamp(END_DATE)
+    n_days = (end - start).days + 1
+    collect = start + pd.to_timedelta(rng.integers(0, n_days, n_rows), unit='D')
+    lag = np.minimum(rng.geometric(1 / 20, n_rows), 400)
+    submit = collect + pd.to_timedelta(lag, unit='D')
+    collection_date = pd.Series(collect.strftime('%Y-%m-%d'))
+    # partial dates and dates in the future
+    partial = rng.random(n_rows) < 0.01
+    collection_date[partial] = collection_date[partial].str[:7]
+    future = rng.random(n_rows) < 0.001
+    collection_date[future] = '2099-01-01'
+    submit_date = pd.Series(submit.strftime('%Y-%m-%d'))
+    submit_date[partial | future] = pd.Series(collect.strftime('%Y-%m-%d'))[partial | future]
+
+    accession = 'EPI_ISL_' + pd.Series(np.arange(1000000, 1000000 + n_rows)).astype(str)
+    virus_name = 'hCoV-19/' + pd.Series(country) + '/' + accession.str[8:] + '/' + collection_date.str[:4]
+
+    sequence_length = rng.normal(29800, 150, n_rows).astype(int)
+    sequence_length[rng.random(n_rows) < 0.01] = 15000
+    n_content = rng.exponential(0.004, n_rows)
+    n_content[rng.random(n_rows) < 0.2] = np.nan
+    gc_content = rng.normal(0.38, 0.004, n_rows)
+    gc_content[rng.random(n_rows) < 0.002] = 0.45
+    host = np.where(rng.random(n_rows) < 0.998, 'Human', 'Environment')
+
+    gisaid_df = pd.DataFrame({
+        'Virus name': virus_name,
+        'Type': 'betacoronavirus',
+        'Accession ID': accession,
+        'Collection date': collection_date,
+        'Location': location,
+        'Additional location information': np.nan,
+        'Sequence length': sequence_length,
+        'Host': host,
+        'Patient age': 'unknown',
+        'Gender': 'unknown',
+        'Clade': 'GRY',
+        'Pango lineage': skewed_choice(rng, lineages, n_rows),
+        'Pangolin version': '2022-07-01',
+        'Variant': np.nan,
+        'AA Substitutions': np.nan,
+        'Submission date': submit_date,
+        'Is reference?': np.nan,
+        'Is complete?': True,
+        'Is high coverage?': np.nan,
+        'Is low coverage?': np.nan,
+        'N-Content': n_content,
+        'GC-Content': gc_content,
+    })
+    check_col_names(gisaid_df)
+    return gisaid_df
+
+
+def generate_exclude_sequences(gisaid_df, fraction=0.001, seed=0):
+    """Nextstrain-style exclude set covering a random share of gisaid_df."""
+    rng = np.random.default_rng(seed)
+    return set(gisaid_df['Virus name'][rng.random(gisaid_df.shape[0]) < fraction])
+
+
+def generate_owid(n_countries=200, seed=0):
+    """Synthetic owid-covid-data.csv frame.
+
+    One row per country and day from START_DATE to END_DATE, plus the OWID_
+    continent and world aggregate rows that load_owid_df drops and
+    get_owid_vax_regional reads.
+
+    Parameters
+    ----------
+    n_countries : int
+        Distinct countries, the same names generate_metadata uses.
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+    owid_df : pandas.core.frame.DataFrame
+        Frame with a parsed date column.
+    """
+    rng = np.random.default_rng(seed)
+    locations = make_countries(n_countries)
+    continents = list(np.asarray(CONTINENTS, dtype=object)[rng.integers(0, len(CONTINENTS), n_countries)])
+    iso_codes = ['C%02d' % i for i in range(n_countries)]
+    locations += CONTINENTS + ['World']
+    continents += [np.nan] * (len(CONTINENTS) + 1)
+    iso_codes += ['OWID_AFR', 'OWID_ASI', 'OWID_EUR', 'OWID_NAM', 'OWID_OCE', 'OWID_SAM', 'OWID_WRL']
+
+    dates = pd.date_range(START_DATE, END_DATE)
+    n_loc, n_days = len(locations), len(dates)
+    population = rng.integers(100000, 300000000, n_loc).astype(float)
+    new_cases = rng.poisson(rng.uniform(10, 50000, n_loc)[:, None], (n_loc, n_days)).astype(float)
+    vax_start = rng.integers(330, 450, n_loc)
+    daily_vax = rng.uniform(0.0005, 0.004, n_loc)[:, None] * population[:, None]
+    day = np.arange(n_days)[None, :]
+    people_vaccinated = np.where(day >= vax_start[:, None],
+                                 np.minimum((day - vax_start[:, None]) * daily_vax, 0.9 * population[:, None]), np.nan)
+    # vax figures are reported irregularly
+    people_vaccinated[rng.random((n_loc, n_days)) < 0.5] = np.nan
+    people_fully_vaccinated = people_vaccinated * 0.85
+
+    owid_df = pd.DataFrame({
+        'iso_code': np.repeat(iso_codes, n_days),
+        'continent': np.repeat(np.asarray(continents, dtype=object), n_days),
+        'location': np.repeat(locations, n_days),
+        'date': np.tile(dates, n_loc),
+        'new_cases': new_cases.ravel(),
+        'population': np.repeat(population, n_days),
+        'people_vaccinated': people_vaccinated.ravel(),
+        'people_fully_vaccinated': people_fully_vaccinated.ravel(),
+    })
+    owid_df['new_cases_smoothed'] = owid_df.groupby('location')['new_cases'].transform(
+        lambda x: x.rolling(7, min_periods=1).mean())
+    owid_df['people_vaccinated_per_hundred'] = owid_df['people_vaccinated'] / owid_df['population'] * 100
+    owid_df['people_fully_vaccinated_per_hundred'] = owid_df['people_fully_vaccinated'] / owid_df['population'] * 100
+    return owid_df
+
+
+def generate_who_regions(n_countries=200, seed=0):
+    """Synthetic WHO regions table in the format add_regions reads."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'Entity': make_countries(n_countries),
+                         'WHO region': np.asarray(WHO_REGIONS, dtype=object)[rng.integers(0, len(WHO_REGIONS), n_countries)]})
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures. The pipeline modules live in scripts/ and import each other
+by module name, so that folder is put on the path.
+
+    python -m pytest -q tests
+"""
+
+import os
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'static')
+sys.path.insert(0, SCRIPTS_DIR)
+
+import filter_gisaid_metadata  # noqa: E402
+
+
+@pytest.fixture
+def local_paths(tmp_path, monkeypatch):
+    """Country name rules from data/static and a suspect date table in tmp_path, as benchmark_pipeline.main sets them."""
+    monkeypatch.setattr(filter_gisaid_metadata, 'COUNTRY_NAME_CORRECTIONS_PATH',
+                        os.path.join(STATIC_DIR, 'gisaid_country_name_corrections.csv'))
+    monkeypatch.setattr(filter_gisaid_metadata, 'KNOWN_COUNTRIES_PATH',
+                        os.path.join(STATIC_DIR, 'country_lat_long_names.csv'))
+    monkeypatch.setattr(filter_gisaid_metadata, 'SUSPECT_DATE_PATH', str(tmp_path / 'suspect_date.csv'))
+    return tmp_path
+
+
+@pytest.fixture
+def exclude_index(tmp_path, monkeypatch):
+    """An empty Nextstrain exclude index served by load_exclude_index without a download; add entries as needed."""
+    import fetch_cache
+    import process_nextstrain_exclude
+    cache_dir = str(tmp_path / 'fetch_cache')
+    index = process_nextstrain_exclude.ExcludeIndex([], version='test')
+    monkeypatch.setattr(fetch_cache, 'CACHE_DIR', cache_dir)
+    monkeypatch.setattr(process_nextstrain_exclude, '_loaded_indexes', {cache_dir: index})
+    return index
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""AggregateCube range totals against a groupby over the cleaning output rows."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregate_cube import AggregateCube
+
+GROUPS = {'omicron': ['BA.*'], 'alpha': ['B.1.1.7'], 'All lineages': ['All lineages'], 'nothing': ['Z.*']}
+
+
+@pytest.fixture
+def cleaning_output():
+    # country rows and aggregate rows over 60 days with gaps, missing counts and a row without a date
+    rng = np.random.default_rng(15)
+    n = 800
+    df = pd.DataFrame({'gisaid_collect_date': pd.Timestamp('2022-01-01') + pd.to_timedelta(rng.integers(0, 60, n), unit='D'),
+                       'gisaid_country': rng.choice(['France', 'Peru', 'Japan'], n).astype(object),
+                       'aggregate_location': None})
+    df.loc[df.sample(frac=0.2, random_state=1).index, 'aggregate_location'] = rng.choice(['Europe', 'Global'], 160)
+    df.loc[df['aggregate_location'].notna(), 'gisaid_country'] = None
+    for col in ['BA.1', 'BA.2', 'BA.2.12.1', 'B.1.1.7', 'All lineages', 'Other lineages']:
+        df[col] = np.where(rng.random(n) < 0.1, np.nan, rng.integers(0, 30, n))
+    df['owid_new_cases'] = np.where(rng.random(n) < 0.1, np.nan, rng.random(n) * 500)
+    df.loc[5, 'gisaid_collect_date'] = pd.NaT
+    return df
+
+
+def groupby_totals(df, start, end):
+    # each measure summed per location over start..end with a plain groupby
+    measures = pd.DataFrame({'omicron': df[['BA.1', 'BA.2', 'BA.2.12.1']].sum(axis=1), 'alpha': df['B.1.1.7'].fillna(0),
+                             'All lineages': df['All lineages'].fillna(0), 'nothing': 0.0,
+                             'owid_new_cases': df['owid_new_cases'].fillna(0)})
+    in_range = (df['gisaid_collect_date'] >= pd.Timestamp(start)) & (df['gisaid_collect_date'] <= pd.Timestamp(end))
+    location = df['aggregate_location'].fillna(df['gisaid_country'])
+    return measures[in_range].groupby(location[in_range]).sum()
+
+
+@pytest.mark.parametrize('start, end', [('2022-01-01', '2022-03-01'), ('2022-01-10', '2022-01-16'),
+                                        ('2022-02-05', '2022-02-05'), ('2021-12-01', '2022-01-03'),
+                                        ('2022-02-25', '2022-06-01'), ('2022-05-01', '2022-05-31')])
+def test_sum_matches_groupby(cleaning_output, start, end, tmp_path):
+    cube = AggregateCube.from_frame(cleaning_output, GROUPS)
+    path = str(tmp_path / 'cube.npz')
+    cube.save(path)
+    loaded = AggregateCube.load(path)
+    expected = groupby_totals(cleaning_output, start, end)
+
+    for measure in ['omicron', 'alpha', 'All lineages', 'nothing', 'owid_new_cases']:
+        for c in [cube, loaded]:
+            totals = c.sum(measure, start, end)
+            assert set(totals.index) == {'France', 'Peru', 'Japan', 'Europe', 'Global'}
+            np.testing.assert_allclose(totals.sort_index(), expected[measure].reindex(sorted(totals.index)).fillna(0),
+                                       rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(cube.sum(['omicron', 'alpha'], start, end, 'Peru'),
+                               expected[['omicron', 'alpha']].sum(axis=1).get('Peru', 0), rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(cube.sum('omicron', start, end, ['Global', 'France']),
+                               expected['omicron'].reindex(['Global', 'France']).fillna(0), rtol=1e-12, atol=1e-9)
+
+
+def test_last_days_matches_groupby(cleaning_output):
+    cube = AggregateCube.from_frame(cleaning_output, GROUPS)
+    last = cleaning_output['gisaid_collect_date'].max()
+    assert cube.last_days(7) == (last - pd.Timedelta(days=6), last)
+    assert cube.last_days(1, end='2022-01-20') == (pd.Timestamp('2022-01-20'), pd.Timestamp('2022-01-20'))
+
+    for n_days in [1, 7, 30]:
+        expected = groupby_totals(cleaning_output, last - pd.Timedelta(days=n_days - 1), last)
+        ratio = cube.ratio('All lineages', 'owid_new_cases', *cube.last_days(n_days))
+        expected_ratio = expected['All lineages'] / expected['owid_new_cases'].where(expected['owid_new_cases'] != 0)
+        np.testing.assert_allclose(ratio.reindex(expected_ratio.index), expected_ratio, rtol=1e-12)
@@ -0,0 +1,45 @@
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+
+import columnar_io
+
+
+def cleaning_output_df():
+    # country rows and regional rollup rows, as write_cleaning_output writes them
+    return pd.DataFrame({'gisaid_collect_date': pd.to_datetime(['2022-01-03', '2022-01-04', '2022-01-11',
+                                                                '2022-01-12', '2022-01-12']),
+                         'gisaid_country': ['France', 'Peru', 'France', None, None],
+                         'aggregate_location': [None, None, None, 'Europe', 'Global'],
+                         'BA.2': [1, 2, 3, 4, 10]})
+
+
+@pytest.mark.parametrize('partition_by', ['week', 'country'])
+def test_locations_filter_uses_write_time_location_cols(tmp_path, partition_by):
+    df = cleaning_output_df()
+    path = str(tmp_path / 'gisaid_cleaning_output.parquet')
+    columnar_io.write_partitioned_parquet(df, path, partition_by, date_col='gisaid_collect_date',
+                                          location_cols=['gisaid_country', 'aggregate_location'])
+
+    for locations in [['France'], ['Europe', 'Peru'], ['Global']]:
+        subset = columnar_io.read_parquet_subset(path, columns=['gisaid_collect_date', 'BA.2'],
+                                                 date_col='gisaid_collect_date', locations=locations)
+        location = df['gisaid_country'].fillna(df['aggregate_location'])
+        expected = df[location.isin(locations)]
+        assert sorted(subset['BA.2']) == sorted(expected['BA.2'])
+
+    subset = columnar_io.read_parquet_subset(path, columns=['BA.2'], start='2022-01-10',
+                                             date_col='gisaid_collect_date', locations=['France'],
+                                             location_cols=['gisaid_country', 'aggregate_location'])
+    assert list(subset['BA.2']) == [3]
+
+
+def test_string_columns_are_dictionary_encoded(tmp_path):
+    df = cleaning_output_df()
+    df['gisaid_country'] = df['gisaid_country'].astype('str')
+    path = str(tmp_path / 'out.parquet')
+    columnar_io.write_partitioned_parquet(df, path, 'week', date_col='gisaid_collect_date',
+                                          location_cols=['gisaid_country', 'aggregate_location'])
+    schema = ds.dataset(path, format='parquet', partitioning='hive').schema
+    assert str(schema.field('gisaid_country').type).startswith('dictionary')
+    assert str(schema.field('aggregate_location').type).startswith('dictionary')
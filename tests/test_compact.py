@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""The compact schema changes dtypes only, not values or aggregates."""
+
+import pandas as pd
+import pytest
+
+import filter_gisaid_metadata
+import gisaid_metadata_processing as gmp
+import synthetic_data
+
+
+@pytest.fixture
+def annotated(local_paths):
+    gisaid_df = synthetic_data.generate_metadata(3000, n_countries=25, n_lineages=150, seed=8)
+    exclude_sequences = synthetic_data.generate_exclude_sequences(gisaid_df, fraction=0.01, seed=8)
+    plain_df = filter_gisaid_metadata.process_raw_metadata(gisaid_df.copy(), exclude_sequences)
+    compact_df = filter_gisaid_metadata.process_raw_metadata(gisaid_df.copy(), exclude_sequences, compact=True)
+    return plain_df, compact_df
+
+
+def test_compact_frame_holds_the_same_values(annotated):
+    plain_df, compact_df = annotated
+    assert compact_df['Pango lineage'].dtype == 'category'
+    assert compact_df['lag_days'].dtype.itemsize < plain_df['lag_days'].dtype.itemsize
+    restored = compact_df.astype({col: plain_df[col].dtype for col in plain_df.columns})
+    pd.testing.assert_frame_equal(restored, plain_df)
+
+
+def test_aggregates_match(annotated):
+    plain_df, compact_df = annotated
+    pd.testing.assert_frame_equal(gmp.aggregate_with_lineage(compact_df), gmp.aggregate_with_lineage(plain_df))
+    pd.testing.assert_frame_equal(gmp.calc_lagstats(compact_df), gmp.calc_lagstats(plain_df))
+    pd.testing.assert_frame_equal(gmp.count_sequences(compact_df).reset_index(drop=True).astype(
+        gmp.count_sequences(plain_df).dtypes.to_dict()), gmp.count_sequences(plain_df).reset_index(drop=True))
+
+
+def test_streamed_counts_match(local_paths, exclude_index, tmp_path):
+    metadata_path = str(tmp_path / 'metadata.tsv')
+    synthetic_data.generate_metadata(2000, n_countries=25, n_lineages=150, seed=9).to_csv(
+        metadata_path, sep='\t', index=False)
+    plain = gmp.stream_process_metadata(metadata_path, str(tmp_path / 'plain.csv'), chunksize=600)
+    compact = gmp.stream_process_metadata(metadata_path, str(tmp_path / 'compact.csv'), chunksize=600, compact=True)
+    pd.testing.assert_frame_equal(gmp.aggregate_with_lineage_from_counts(compact[0]),
+                                  gmp.aggregate_with_lineage_from_counts(plain[0]))
+    pd.testing.assert_frame_equal(gmp.calc_lagstats_from_counts(compact[0]), gmp.calc_lagstats_from_counts(plain[0]))
+    assert compact[2] == plain[2]
+    with open(tmp_path / 'plain.csv') as f, open(tmp_path / 'compact.csv') as g:
+        assert f.read() == g.read()
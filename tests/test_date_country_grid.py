@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""The grid join against the outer merge + pivot_table path it replaced."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import filter_gisaid_metadata
+import gisaid_metadata_processing as gmp
+import synthetic_data
+from date_country_grid import take_or_nan
+
+
+@pytest.fixture
+def gisaid_owid(local_paths):
+    gisaid_df = synthetic_data.generate_metadata(5000, n_countries=30, n_lineages=200, seed=1)
+    # partial collection dates are kept, they land on the first of the month
+    assert (gisaid_df['Collection date'].str.len() < 10).any()
+    exclude_sequences = synthetic_data.generate_exclude_sequences(gisaid_df, seed=1)
+    gisaid_df = filter_gisaid_metadata.process_raw_metadata(gisaid_df, exclude_sequences)
+    country_variants_df = gmp.aggregate_with_lineage(gisaid_df)
+    owid_df = gmp.prepare_owid_df(synthetic_data.generate_owid(n_countries=30, seed=1))
+    return country_variants_df, owid_df
+
+
+def test_take_or_nan_fills_dates_with_nat():
+    dates = np.array(['2022-01-01', '2022-01-02'], dtype='datetime64[ns]')
+    taken = take_or_nan(dates, np.array([1, -1, 0]))
+    assert taken.dtype == dates.dtype
+    assert taken[0] == dates[1] and np.isnat(taken[1]) and taken[2] == dates[0]
+    assert np.isnan(take_or_nan(np.array([1, 2]), np.array([-1]))[0])
+
+
+def test_pivot_gisaid_owid_matches_merge_path(gisaid_owid):
+    country_variants_df, owid_df = gisaid_owid
+    expected = gmp.pivot_merged_df(gmp.merge_gisaid_owid(country_variants_df, owid_df))
+    pd.testing.assert_frame_equal(gmp.pivot_gisaid_owid(country_variants_df, owid_df), expected)
+
+
+def test_pivot_merged_long_widens_to_merge_path(gisaid_owid):
+    country_variants_df, owid_df = gisaid_owid
+    expected = gmp.pivot_merged_df(gmp.merge_gisaid_owid(country_variants_df, owid_df))
+    widened = gmp.widen_lineage_counts(*gmp.pivot_merged_long(country_variants_df, owid_df))
+    pd.testing.assert_frame_equal(widened, expected)
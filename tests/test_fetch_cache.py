@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""fetch_cache against a local HTTP server standing in for OWID and Nextstrain."""
+
+import email.utils
+import os
+import http.server
+import threading
+import time
+
+import pytest
+
+import fetch_cache
+
+
+class FakeSource(http.server.BaseHTTPRequestHandler):
+    """Serves server.files[path] = (body, etag, last_modified), answering conditional requests with 304.
+
+    Every response waits server.delay seconds. The first server.stalls[path]
+    requests for a path stall for a second and the next server.failures[path]
+    get a 503.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        if server.delay:
+            time.sleep(server.delay)
+        if server.stalls.get(self.path, 0) > 0:
+            server.stalls[self.path] -= 1
+            time.sleep(1)
+            return
+        if server.failures.get(self.path, 0) > 0:
+            server.failures[self.path] -= 1
+            self.send_error(503)
+            return
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        body, etag, last_modified = server.files[self.path]
+        if (etag and self.headers.get('If-None-Match') == etag) or \
+                (not etag and last_modified and self.headers.get('If-Modified-Since') == last_modified):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def source():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeSource)
+    server.daemon_threads = True
+    server.files, server.requests, server.failures, server.stalls, server.delay = {}, [], {}, {}, 0
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    # a fresh process: nothing fetched yet, no waiting between retries
+    monkeypatch.setattr(fetch_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(fetch_cache, 'OFFLINE', False)
+    monkeypatch.setattr(fetch_cache, 'RETRY_BACKOFF', 0)
+    monkeypatch.setattr(fetch_cache, '_fetched', {})
+    monkeypatch.setattr(fetch_cache, '_url_locks', {})
+    return str(tmp_path / 'cache')
+
+
+def new_run(monkeypatch):
+    # each url is revalidated once per process, so a later run is a cleared memo
+    monkeypatch.setattr(fetch_cache, '_fetched', {})
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_cache_dir_is_read_at_call_time(source, cache_dir):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    path = fetch_cache.fetch(source.url + '/owid.csv')
+    assert path.startswith(cache_dir)
+    assert fetch_cache.cache_entry(source.url + '/owid.csv')['etag'] == '"v1"'
+
+
+def test_fetched_once_per_run(source, cache_dir):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    assert fetch_cache.fetch(source.url + '/owid.csv') == fetch_cache.fetch(source.url + '/owid.csv')
+    assert len(source.requests) == 1
+
+
+def test_unchanged_etag_reuses_cached_copy(source, cache_dir, monkeypatch):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    first = fetch_cache.fetch(source.url + '/owid.csv')
+    new_run(monkeypatch)
+    assert fetch_cache.fetch(source.url + '/owid.csv') == first
+    assert source.requests[-1][1].get('If-None-Match') == '"v1"'
+
+
+def test_unchanged_last_modified_reuses_cached_copy(source, cache_dir, monkeypatch):
+    last_modified = email.utils.formatdate(usegmt=True)
+    source.files['/exclude.txt'] = (b'EPI_ISL_1\n', None, last_modified)
+    first = fetch_cache.fetch(source.url + '/exclude.txt')
+    new_run(monkeypatch)
+    assert fetch_cache.fetch(source.url + '/exclude.txt') == first
+    assert source.requests[-1][1].get('If-Modified-Since') == last_modified
+
+
+def test_changed_source_is_downloaded_again(source, cache_dir, monkeypatch):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    first = fetch_cache.fetch(source.url + '/owid.csv')
+    source.files['/owid.csv'] = (b'a,b\n1,2\n3,4\n', '"v2"', None)
+    new_run(monkeypatch)
+    second = fetch_cache.fetch(source.url + '/owid.csv')
+    assert read(second) == b'a,b\n1,2\n3,4\n'
+    assert fetch_cache.cache_entry(source.url + '/owid.csv')['etag'] == '"v2"'
+    # the object no url points at any more is dropped
+    assert second != first and not os.path.exists(first)
+
+
+def test_offline_serves_cached_copy(source, cache_dir, monkeypatch):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    first = fetch_cache.fetch(source.url + '/owid.csv')
+    new_run(monkeypatch)
+    monkeypatch.setattr(fetch_cache, 'OFFLINE', True)
+    assert fetch_cache.fetch(source.url + '/owid.csv') == first
+    assert len(source.requests) == 1
+    with pytest.raises(RuntimeError):
+        fetch_cache.fetch(source.url + '/not-cached.csv')
+
+
+def test_unreachable_source_falls_back_to_last_good_copy(source, cache_dir, monkeypatch):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    first = fetch_cache.fetch(source.url + '/owid.csv')
+    new_run(monkeypatch)
+    source.failures['/owid.csv'] = fetch_cache.RETRIES + 1
+    assert fetch_cache.fetch(source.url + '/owid.csv') == first
+    # one attempt plus RETRIES, with no adapter-level retries stacked on top
+    assert len(source.requests) == 1 + fetch_cache.RETRIES + 1
+    assert fetch_cache.get_session().get_adapter(source.url).max_retries.total == 0
+
+
+def test_prefetch_downloads_concurrently(source, cache_dir):
+    urls = [source.url + '/%d.csv' % i for i in range(4)]
+    for i in range(4):
+        source.files['/%d.csv' % i] = (b'x,%d\n' % i, '"%d"' % i, None)
+    source.delay = 0.4
+    start = time.perf_counter()
+    paths = fetch_cache.prefetch(urls).result(timeout=10)
+    # one after another would take 4 delays
+    assert time.perf_counter() - start < 3 * source.delay
+    assert [read(paths[url]) for url in urls] == [b'x,%d\n' % i for i in range(4)]
+
+
+def test_prefetch_reports_failures_per_url(source, cache_dir):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    paths = fetch_cache.prefetch([source.url + '/owid.csv', source.url + '/missing.txt']).result(timeout=10)
+    assert read(paths[source.url + '/owid.csv']) == b'a,b\n1,2\n'
+    assert isinstance(paths[source.url + '/missing.txt'], RuntimeError)
+    # a 4xx is not retried
+    assert [path for path, _ in source.requests].count('/missing.txt') == 1
+
+
+def test_timeouts_and_server_errors_are_retried(source, cache_dir, monkeypatch):
+    monkeypatch.setattr(fetch_cache, 'TIMEOUT', 0.2)
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    source.stalls['/owid.csv'] = 1
+    source.failures['/owid.csv'] = 1
+    paths = fetch_cache.prefetch([source.url + '/owid.csv']).result(timeout=10)
+    assert read(paths[source.url + '/owid.csv']) == b'a,b\n1,2\n'
+    assert len(source.requests) == 3
+
+
+def test_fetch_waits_for_download_in_progress(source, cache_dir):
+    source.files['/owid.csv'] = (b'a,b\n1,2\n', '"v1"', None)
+    source.delay = 0.3
+    future = fetch_cache.prefetch([source.url + '/owid.csv'])
+    while not source.requests:
+        time.sleep(0.01)
+    # the download has started: fetch blocks on it rather than sending its own request
+    path = fetch_cache.fetch(source.url + '/owid.csv')
+    assert path == future.result(timeout=10)[source.url + '/owid.csv']
+    assert len(source.requests) == 1
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Reading, flagging and annotating raw metadata."""
+
+import os
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+
+import filter_gisaid_metadata
+import synthetic_data
+
+
+@pytest.fixture
+def metadata_path(tmp_path):
+    path = tmp_path / 'metadata.tsv'
+    synthetic_data.generate_metadata(500, n_countries=20, n_lineages=100, seed=2).to_csv(path, sep='\t', index=False)
+    return path
+
+
+def test_read_metadata_chunks_matches_full_read(metadata_path):
+    chunks = list(filter_gisaid_metadata.read_metadata_chunks(metadata_path, chunksize=120))
+    assert len(chunks) == 5
+    full_df = pd.read_csv(metadata_path, sep='\t', usecols=filter_gisaid_metadata.METADATA_USECOLS,
+                          dtype=filter_gisaid_metadata.METADATA_DTYPES)
+    pd.testing.assert_frame_equal(pd.concat(chunks), full_df)
+
+
+def test_read_metadata_chunks_rejects_missing_columns(metadata_path, tmp_path):
+    path = tmp_path / 'no_gc.tsv'
+    pd.read_csv(metadata_path, sep='\t').drop(columns='GC-Content').to_csv(path, sep='\t', index=False)
+    with pytest.raises(RuntimeError, match='GC-Content'):
+        filter_gisaid_metadata.read_metadata_chunks(path)
+
+
+def test_partial_dates_parse_as_first_of_month(local_paths):
+    gisaid_df = synthetic_data.generate_metadata(200, n_countries=10, n_lineages=50, seed=4)
+    gisaid_df.loc[:2, 'Collection date'] = ['2021-06', '2021', '2021-06-03']
+    gisaid_df = filter_gisaid_metadata.annotate_sequences(gisaid_df)
+    assert list(gisaid_df.loc[:2, 'collect_date']) == [pd.Timestamp('2021-06-01'), pd.Timestamp('2021-01-01'),
+                                                       pd.Timestamp('2021-06-03')]
+
+
+def test_flagged_chunks_need_no_virus_name(local_paths):
+    gisaid_df = synthetic_data.generate_metadata(200, n_countries=10, n_lineages=50, seed=4)
+    gisaid_df = filter_gisaid_metadata.flag_nextstrain_excluded(gisaid_df[filter_gisaid_metadata.METADATA_USECOLS], set())
+    assert 'Virus name' not in gisaid_df.columns
+    filter_gisaid_metadata.process_raw_metadata(gisaid_df)
+    with pytest.raises(RuntimeError, match='Host'):
+        filter_gisaid_metadata.process_raw_metadata(gisaid_df.drop(columns='Host'))
+
+
+LOCATIONS = pd.Series(['Europe / France / Paris', 'Asia / Japan', ' Europe/ Denmark /Hovedstaden / Copenhagen ',
+                       'North America / USA / New York / Kings County / Brooklyn', 'Asia / Japan',
+                       'Oceania / Australia / '])
+
+
+def test_split_locations_matches_per_row_split():
+    locations = pd.concat([LOCATIONS, synthetic_data.generate_metadata(300, n_countries=20, seed=5)['Location']],
+                          ignore_index=True)
+    parts = filter_gisaid_metadata.split_locations(locations)
+    # the per-row splits annotate_sequences used
+    assert list(parts['region']) == list(locations.apply(lambda x: x.split('/')[0].strip()))
+    assert list(parts['country']) == list(locations.apply(lambda x: x.split('/')[1].strip()))
+    assert list(parts['division']) == list(locations.apply(
+        lambda x: x.split('/')[2].strip() if len(x.split('/'))>2 else ''))
+
+
+def test_weeks_match_per_row_isocalendar():
+    # across the ISO year boundaries, where %G differs from %Y
+    dates = pd.Series(pd.date_range('2019-12-20', '2023-01-15')).sample(frac=1, random_state=0)
+    dates = pd.concat([dates, dates.iloc[:50]], ignore_index=True)
+    assert list(filter_gisaid_metadata.get_yearweeks(dates)) == \
+        list(dates.apply(lambda x: datetime.strftime(x, "%G-W%V")))
+    assert list(filter_gisaid_metadata.get_weekstartdates(dates)) == \
+        list(dates.apply(filter_gisaid_metadata.get_weekstartdate))
+    assert (filter_gisaid_metadata.get_yearweeks(dates) ==
+            dates.dt.isocalendar().apply(lambda x: '%d-W%02d' % (x['year'], x['week']), axis=1)).all()
+
+
+def replace_chain(gisaid_df):
+    # the replace chain correct_location_names used before the rules table
+    gisaid_df.loc[:,'country'] = gisaid_df['country'].apply(filter_gisaid_metadata.titlecase_location)
+    gisaid_df.loc[gisaid_df['country'].fillna('').str.contains('USA', case=False), 'country'] = 'United States'
+    for old, new in [('Puerto Rico', 'United States'), ('Guam', 'United States'),
+                     ('Northern Mariana Islands', 'United States'), ('U.s. Virgin Islands', 'United States'),
+                     ('Czech Republic', 'Czechia'), ('Antigua', 'Antigua and Barbuda'),
+                     ('Democratic Republic of the Congo', 'Democratic Republic of Congo'),
+                     ('Republic of the Congo', 'Congo'), ('Faroe Islands', 'Faeroe Islands'),
+                     ('Guinea Bissau', 'Guinea-Bissau'), ('Niogeria', 'Nigeria'),
+                     ('Bosni and Herzegovina', 'Bosnia and Herzegovina'), ('England', 'United Kingdom'),
+                     ('The Bahamas', 'Bahamas')]:
+        gisaid_df.loc[gisaid_df['country'] == old, 'country'] = new
+    return gisaid_df
+
+
+def test_correct_location_names_matches_replace_chain(local_paths):
+    raw = ['USA', 'usa', 'Puerto Rico', 'puerto rico', 'Guam', 'Northern Mariana Islands', 'U.S. Virgin Islands',
+           'Czech Republic', 'Antigua', 'Democratic Republic of the Congo', 'Republic of the Congo', 'Faroe Islands',
+           'Guinea Bissau', 'Niogeria', 'Bosni and Herzegovina', 'England', 'The Bahamas', 'the bahamas',
+           "Cote d'Ivoire", 'Trinidad and Tobago', 'Denmark', 'south africa', 'Country 007']
+    countries = pd.Series(raw * 3 + list(synthetic_data.generate_metadata(300, n_countries=40, seed=5)['Location']
+                                         .str.split('/').str[1].str.strip()))
+    corrected = filter_gisaid_metadata.correct_location_names(pd.DataFrame({'country': countries.copy()}))
+    expected = replace_chain(pd.DataFrame({'country': countries.copy()}))
+    assert list(corrected['country']) == list(expected['country'])
+
+
+@pytest.mark.parametrize('n_rows, n_workers, partitions_per_worker', [(503, 3, 4), (503, 2, 1), (7, 2, 4)])
+def test_parallel_matches_serial(local_paths, n_rows, n_workers, partitions_per_worker):
+    import process_nextstrain_exclude
+    # shuffled index, so concatenating the partitions out of order would show
+    gisaid_df = synthetic_data.generate_metadata(n_rows, n_countries=15, n_lineages=80, seed=8)
+    gisaid_df.index = gisaid_df.index[::-1] + 10
+    exclude = process_nextstrain_exclude.ExcludeIndex(list(gisaid_df['Virus name'].iloc[::5]), version='test')
+    serial_df = filter_gisaid_metadata.process_raw_metadata(gisaid_df.copy(), exclude)
+    parallel_df = filter_gisaid_metadata.process_raw_metadata_parallel(
+        gisaid_df.copy(), n_workers=n_workers, exclude_sequences=exclude, partitions_per_worker=partitions_per_worker)
+    assert serial_df['nextstrain_excluded'].any()
+    pd.testing.assert_frame_equal(parallel_df, serial_df)
+
+
+def test_suspect_dates_match_is_suspect_date():
+    today = date.today()
+    dates = pd.Series(['2021-06-03', '2021-06', '2021', '2019-11-30', '2019-12-01', '2019-12-02', '2019-12',
+                       today.strftime('%Y-%m-%d'), (today + timedelta(days=1)).strftime('%Y-%m-%d'),
+                       (today + timedelta(days=400)).strftime('%Y-%m'), '2021-6-3', '2021-06-03'])
+    expected = [filter_gisaid_metadata.is_suspect_date(x) for x in dates]
+    assert list(filter_gisaid_metadata.suspect_dates(dates)) == expected
+    assert expected == [False, True, True, True, True, False, True, False, True, True, True, False]
+    # missing dates, which is_suspect_date can't take, are suspect
+    assert list(filter_gisaid_metadata.suspect_dates(pd.Series(['2021-06-03', None]))) == [False, True]
+
+
+def test_flagged_accessions_stay_flagged(tmp_path):
+    path = str(tmp_path / 'suspect_date.csv')
+    gisaid_df = pd.DataFrame({'Accession ID': ['EPI_ISL_1', 'EPI_ISL_2', 'EPI_ISL_3'],
+                              'Collection date': ['2022-03-01', '2022-03-10', '2022-02']})
+    table = filter_gisaid_metadata.SuspectDateTable(path)
+    flagged = filter_gisaid_metadata.flag_abnormal_dates(gisaid_df.copy(), table, today=date(2022, 3, 5))
+    assert list(flagged['abnormal_date']) == [False, True, True]
+    table.save()
+
+    # once 2022-03-10 has passed, the date itself looks fine but the accession stays flagged
+    table = filter_gisaid_metadata.SuspectDateTable(path)
+    flagged = filter_gisaid_metadata.flag_abnormal_dates(gisaid_df.copy(), table, today=date(2022, 4, 1))
+    assert list(filter_gisaid_metadata.suspect_dates(gisaid_df['Collection date'], date(2022, 4, 1))) == [False, False, True]
+    assert list(flagged['abnormal_date']) == [False, True, True]
+    mtime = os.stat(path).st_mtime_ns
+    table.save()
+    assert os.stat(path).st_mtime_ns == mtime
+    assert pd.read_csv(path).values.tolist() == [['EPI_ISL_2', '2022-03-05'], ['EPI_ISL_3', '2022-03-05']]
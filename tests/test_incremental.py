@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Incremental metadata processing against a full rebuild."""
+
+import pandas as pd
+import pytest
+
+import filter_gisaid_metadata
+import gisaid_metadata_processing as gmp
+import metadata_state_store
+import synthetic_data
+
+
+def sort_counts(df):
+    return df.sort_values(gmp.COUNT_COLS).reset_index(drop=True)
+
+
+def assert_matches_full_rebuild(metadata_path, state_dir, tmp_path):
+    counts_df, _, max_date = gmp.incremental_process_metadata(
+        metadata_path, str(tmp_path / 'clean.csv'), state_dir, chunksize=150)
+    full_dir = str(tmp_path / 'full_state')
+    full_counts_df, _, full_max_date = gmp.incremental_process_metadata(
+        metadata_path, str(tmp_path / 'full_clean.csv'), full_dir, chunksize=150, full_rebuild=True)
+    pd.testing.assert_frame_equal(sort_counts(counts_df), sort_counts(full_counts_df))
+    assert max_date == full_max_date
+    state_df = metadata_state_store.load_state(state_dir)[0]
+    full_state_df = metadata_state_store.load_state(full_dir)[0]
+    pd.testing.assert_frame_equal(state_df, full_state_df[state_df.columns])
+    return counts_df
+
+
+@pytest.fixture
+def exports(tmp_path, local_paths, exclude_index):
+    first_df = synthetic_data.generate_metadata(600, n_countries=25, n_lineages=120, seed=6)
+    # the next export drops some accessions, re-lineages others and adds new ones
+    second_df = first_df.iloc[40:].copy()
+    second_df.iloc[:30, second_df.columns.get_loc('Pango lineage')] = 'BA.2'
+    new_df = synthetic_data.generate_metadata(80, n_countries=25, n_lineages=120, seed=7)
+    new_df['Accession ID'] = 'EPI_ISL_' + (2000000 + pd.Series(range(80))).astype(str)
+    new_df['Virus name'] = new_df['Virus name'].str.replace('/1000', '/2000')
+    second_df = pd.concat([second_df, new_df], ignore_index=True)
+
+    paths = []
+    for i, df in enumerate([first_df, second_df]):
+        paths.append(str(tmp_path / ('metadata_%d.tsv' % i)))
+        df.to_csv(paths[-1], sep='\t', index=False)
+    return paths
+
+
+def test_incremental_update_matches_full_rebuild(exports, tmp_path):
+    state_dir = str(tmp_path / 'state')
+    gmp.incremental_process_metadata(exports[0], str(tmp_path / 'clean.csv'), state_dir, chunksize=150)
+    assert_matches_full_rebuild(exports[1], state_dir, tmp_path)
+
+
+def test_rule_change_rebuilds_state(exports, tmp_path, monkeypatch, capsys):
+    state_dir = str(tmp_path / 'state')
+    gmp.incremental_process_metadata(exports[0], str(tmp_path / 'clean.csv'), state_dir, chunksize=150)
+
+    # the same export, with Denmark renamed by a new rule
+    corrections_path = tmp_path / 'corrections.csv'
+    with open(filter_gisaid_metadata.COUNTRY_NAME_CORRECTIONS_PATH) as f:
+        corrections_path.write_text(f.read().rstrip('\n') + '\nDenmark,Kingdom of Denmark,exact\n')
+    monkeypatch.setattr(filter_gisaid_metadata, 'COUNTRY_NAME_CORRECTIONS_PATH', str(corrections_path))
+    capsys.readouterr()
+
+    counts_df = assert_matches_full_rebuild(exports[0], state_dir, tmp_path)
+    assert 'Country name rules or annotation code changed' in capsys.readouterr().out
+    assert 'Kingdom of Denmark' in set(counts_df['country'])
+    assert 'Denmark' not in set(counts_df['country'])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Lag stats from histograms against pandas' groupby quantiles."""
+
+import numpy as np
+import pandas as pd
+
+import gisaid_metadata_processing as gmp
+from lag_histograms import LagHistogram, LAG_QUANTILES
+
+
+def sequences_df():
+    # many ties in lag_days, groups of one, two and many sequences, and a compact int16 lag_days
+    rng = np.random.default_rng(11)
+    n = 4000
+    df = pd.DataFrame({'collect_date': pd.Timestamp('2022-03-01') + pd.to_timedelta(rng.integers(0, 20, n), unit='D'),
+                       'country': rng.choice(['France', 'Peru', 'Japan', 'Kenya'], n),
+                       'lag_days': rng.choice([0, 1, 1, 2, 5, 5, 5, 30, 120], n).astype('int16')})
+    singles = pd.DataFrame({'collect_date': pd.to_datetime(['2022-04-01', '2022-04-02', '2022-04-02']),
+                            'country': ['Fiji', 'Fiji', 'Tonga'],
+                            'lag_days': np.array([7, 3, 400], dtype='int16')})
+    pairs = pd.DataFrame({'collect_date': pd.to_datetime(['2022-04-05'] * 2), 'country': ['Chad'] * 2,
+                          'lag_days': np.array([4, 9], dtype='int16')})
+    return pd.concat([df, singles, pairs], ignore_index=True).sample(frac=1, random_state=1)
+
+
+def test_calc_lagstats_matches_groupby_quantile():
+    gisaid_df = sequences_df()
+    sumstats_df = gmp.calc_lagstats(gisaid_df)
+    grouped = gisaid_df.groupby(gmp.LAG_GROUP_COLS)['lag_days']
+    expected = grouped.agg(['count', 'min', 'max']).reset_index()
+    assert (expected['count'] == 1).sum() == 3 and (expected['count'] == 2).sum() == 1
+
+    assert list(sumstats_df[gmp.LAG_GROUP_COLS].itertuples(index=False)) == \
+        list(expected[gmp.LAG_GROUP_COLS].itertuples(index=False))
+    np.testing.assert_array_equal(sumstats_df['seq_count'], expected['count'])
+    np.testing.assert_array_equal(sumstats_df['gisaid_lagdays_min'], expected['min'])
+    np.testing.assert_array_equal(sumstats_df['gisaid_lagdays_max'], expected['max'])
+    for col, q in LAG_QUANTILES:
+        np.testing.assert_allclose(sumstats_df[col], grouped.quantile(q).to_numpy(), rtol=0, atol=1e-9)
+
+
+def test_merged_chunk_histograms_match_whole():
+    gisaid_df = sequences_df()
+    chunks = [LagHistogram.from_sequences(gisaid_df.iloc[start:start+700], gmp.LAG_GROUP_COLS)
+              for start in range(0, gisaid_df.shape[0], 700)]
+    merged = chunks[0].merge(*chunks[1:])
+    pd.testing.assert_frame_equal(merged.stats(), LagHistogram.from_sequences(gisaid_df, gmp.LAG_GROUP_COLS).stats())
+    # taking the first chunk out again leaves the rest
+    rest = merged.merge(chunks[0], subtract=True)
+    pd.testing.assert_frame_equal(rest.stats(), LagHistogram.from_sequences(gisaid_df.iloc[700:], gmp.LAG_GROUP_COLS).stats())
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Lineage pattern matching and greek groups against the string slicing, per-row labelling and per-group sums they replaced."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gisaid_metadata_processing as gmp
+import synthetic_data
+from lineage_index import LineageGroups, LineageIndex, map_labels
+
+
+def slice_wildcard(pattern, search_pango):
+    # the wildcard rule find_lineages used
+    return [c for c in set(search_pango) if pattern.replace('*','') == str(c)[:len(pattern)-1]]
+
+
+def slice_find_lineages(input_pango, search_pango):
+    # find_lineages before the trie, without the printing
+    match_list = sorted(set(search_pango) & set(input_pango))
+    wildcards = [c for c in input_pango if '*' in c]
+    wildcard_res = []
+    for w in wildcards:
+        wildcard_res += slice_wildcard(w, search_pango)
+    return sorted(match_list+wildcard_res)
+
+
+LINEAGES = ['B', 'B.1', 'B.1.1', 'B.1.1.7', 'B.1.1.529', 'B.1.1.529.1', 'B.1.617.2', 'BA', 'BA.1', 'BA.1.1',
+            'BA.2', 'BA.2.12.1', 'BA.2.75', 'BA.20', 'BA.2X', 'BA.3', 'AY.4', 'AY.4.2', 'AY.44', 'Q.1', 'P.1.1',
+            'XBB.1.5', 'None', 'nan', np.nan]
+
+PATTERNS = ['AY.*', 'AY.4*', 'BA.2*', 'BA.2.*', 'BA.*', 'BA*', 'B.1.1.529.*', 'B*', '*', 'n*', 'Q.*',
+            'XBB.1.5*', 'XBB.1.5.*', 'C.*', 'B.1.1.7.*', 'B.*.7', '*.1', 'BA.*.*', '**', 'BA.2.**']
+
+
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_match_wildcard_matches_slicing(pattern):
+    index = LineageIndex(LINEAGES)
+    assert sorted(map(str, index.match_wildcard(pattern))) == sorted(map(str, slice_wildcard(pattern, LINEAGES)))
+
+
+def test_find_matches_find_lineages():
+    lineages = synthetic_data.generate_metadata(3000, n_countries=5, n_lineages=400, seed=6)['Pango lineage'].unique()
+    patterns = gmp.vocs + gmp.vois + gmp.other_important + ['BA.2*', 'B.1.1.*', 'AY.1*', 'Nope.1']
+    assert gmp.find_lineages(patterns, lineages) == slice_find_lineages(patterns, lineages)
+
+
+def test_key_lineages_match_apply():
+    lineages = pd.Series(synthetic_data.generate_metadata(3000, n_countries=5, n_lineages=400, seed=7)['Pango lineage'])
+    lineages[::50] = np.nan
+    lineages[1::50] = 'B.1.427'
+    lineages[2::50] = 'B.1.429'
+    patterns = gmp.vocs + gmp.vois + gmp.other_important
+
+    key_variants = slice_find_lineages(patterns, lineages.dropna().unique())
+    expected = lineages.apply(lambda x: x if x in key_variants else 'Other lineages').replace(gmp.lineage_replace_dict)
+
+    key_labels = LineageIndex(lineages.unique()).compile_labels(patterns, gmp.lineage_replace_dict, verbose=False)
+    labels = map_labels(lineages, key_labels, 'Other lineages')
+    assert list(labels) == list(expected)
+    assert 'B.1.427/429' in set(labels) and (expected != 'Other lineages').any()
+
+
+def old_add_greek_cols(df, greek_dict):
+    # add_greek_cols before LineageGroups, without the printing
+    greek_lineages_flattened = [v for v in greek_dict.values() for v in v]
+    match_list = slice_find_lineages(greek_lineages_flattened, set(df.columns))
+    for k, v in greek_dict.items():
+        df[k] = df[slice_find_lineages(v, set(df.columns))].sum(axis=1)
+    df['who_other'] = df['All lineages'] - df[match_list].sum(axis=1)
+    return df
+
+
+@pytest.fixture
+def wide_counts():
+    # lineage count columns as in the wide cleaning output, with missing counts
+    rng = np.random.default_rng(17)
+    lineages = ['B.1.1.7', 'Q.1', 'Q.4', 'B.1.351', 'P.1', 'P.1.12', 'B.1.617.2', 'AY.4', 'AY.4.2', 'B.1.1.529',
+                'BA.1', 'BA.1.1', 'BA.2', 'BA.2.12.1', 'BA.4', 'C.37', 'B.1.621', 'B.1.427/429', 'B.1.526',
+                'Other lineages']
+    df = pd.DataFrame(rng.integers(0, 40, (300, len(lineages))).astype('float64'), columns=lineages)
+    df = df.mask(rng.random(df.shape) < 0.1)
+    df['All lineages'] = df.sum(axis=1) + 5
+    df['owid_new_cases'] = 1000.0
+    return df
+
+
+def test_greek_cols_match_per_group_sums(wide_counts):
+    expected = old_add_greek_cols(wide_counts.copy(), gmp.greek_dict)
+    df = gmp.add_greek_cols(wide_counts.copy())
+    for col in list(gmp.greek_dict) + ['who_other']:
+        np.testing.assert_allclose(df[col], expected[col], rtol=0, atol=1e-9)
+
+
+def test_overlapping_groups_count_once_in_who_other(wide_counts, monkeypatch):
+    greek_dict = dict(gmp.greek_dict, who_ba2=['BA.2', 'BA.2.*'])
+    monkeypatch.setattr(gmp, 'greek_dict', greek_dict)
+    df = gmp.add_greek_cols(wide_counts.copy(), families={'AY.4 family': ['AY.4', 'AY.4.*']})
+
+    groups = LineageGroups(dict(greek_dict, **{'AY.4 family': ['AY.4', 'AY.4.*']}), set(wide_counts.columns),
+                           verbose=False)
+    assert groups.overlaps == {'BA.2': ['who_omicron', 'who_ba2'], 'BA.2.12.1': ['who_omicron', 'who_ba2'],
+                               'AY.4': ['who_delta', 'AY.4 family'], 'AY.4.2': ['who_delta', 'AY.4 family']}
+    # every lineage of any greek group once, as the old sum over the deduplicated match list
+    greek_lineages = sorted(set(slice_find_lineages([v for v in greek_dict.values() for v in v], wide_counts.columns)))
+    np.testing.assert_allclose(df['who_other'], wide_counts['All lineages'] - wide_counts[greek_lineages].sum(axis=1),
+                               rtol=0, atol=1e-9)
+    np.testing.assert_allclose(df['who_ba2'], wide_counts[['BA.2', 'BA.2.12.1']].sum(axis=1), rtol=0, atol=1e-9)
+    np.testing.assert_allclose(df['AY.4 family'], wide_counts[['AY.4', 'AY.4.2']].sum(axis=1), rtol=0, atol=1e-9)
+
+    # '_any' of a subset of groups
+    union = groups.groups(wide_counts, union_of=['who_ba2', 'who_delta'])['_any']
+    np.testing.assert_allclose(union, wide_counts[['BA.2', 'BA.2.12.1', 'B.1.617.2', 'AY.4', 'AY.4.2']].sum(axis=1),
+                               rtol=0, atol=1e-9)
+    assert (groups.groups(wide_counts, union_of=[])['_any'] == 0).all()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Continent, WHO region and global rollups against the groupby versions they replaced."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gisaid_metadata_processing as gmp
+
+GROUP_COLS = ['collect_date', 'collect_yearweek', 'collect_weekstartdate', 'owid_date']
+
+
+def groupby_concat_agglocations(merged_pivoted_df, group_cols=GROUP_COLS):
+    # concat_agglocations before location_rollup, on the numeric columns
+    continents_df = merged_pivoted_df.groupby(group_cols+['owid_continent']).sum().reset_index()
+    whoregions_df = merged_pivoted_df.groupby(group_cols+['who_region']).sum().reset_index()
+    global_df = merged_pivoted_df.drop(columns=['owid_continent', 'who_region']).groupby(group_cols).sum().reset_index()
+
+    continents_df.loc[:,'aggregate_location'] = continents_df['owid_continent']
+    whoregions_df.loc[:,'aggregate_location'] = 'WHO Region: ' + whoregions_df['who_region']
+    global_df.loc[:,'aggregate_location'] = 'Global'
+
+    return pd.concat([continents_df, whoregions_df, global_df], sort=False)
+
+
+def groupby_calc_lagstats(gisaid_df, group_cols):
+    # calc_lagstats before lag histograms
+    def q1(x): return x.quantile(0.25)
+    def q3(x): return x.quantile(0.75)
+    sumstats_df = gisaid_df.groupby(group_cols).agg({'lag_days':['count','median','min','max',q1,q3]}).reset_index()
+    sumstats_df.rename(columns={'count':'seq_count',
+                       'median':'gisaid_lagdays_median',
+                       'q1':'gisaid_lagdays_q1',
+                       'q3':'gisaid_lagdays_q3',
+                       'min':'gisaid_lagdays_min',
+                       'max':'gisaid_lagdays_max',
+                       'lag_days':'',
+                       }, inplace=True)
+    sumstats_df.columns = sumstats_df.columns.map(''.join)
+    return sumstats_df
+
+
+def groupby_calc_regional_lagstats(gisaid_owid_df, group_cols=['collect_weekstartdate']):
+    continents_sumstats_df = groupby_calc_lagstats(gisaid_owid_df, group_cols=group_cols+['owid_continent'])
+    whoregions_sumstats_df = groupby_calc_lagstats(gisaid_owid_df, group_cols=group_cols+['who_region'])
+    global_sumstats_df = groupby_calc_lagstats(gisaid_owid_df, group_cols=group_cols)
+
+    continents_sumstats_df.loc[:,'aggregate_location'] = continents_sumstats_df['owid_continent']
+    whoregions_sumstats_df.loc[:,'aggregate_location'] = 'WHO Region: '+ whoregions_sumstats_df['who_region']
+    global_sumstats_df.loc[:,'aggregate_location'] = 'Global'
+
+    return pd.concat([whoregions_sumstats_df, continents_sumstats_df, global_sumstats_df], sort=False)
+
+
+@pytest.fixture
+def country_rows():
+    # country rows over a few weeks, some without continent, region or date, in no particular order
+    rng = np.random.default_rng(9)
+    n = 3000
+    countries = np.array(['Country %02d' % i for i in range(30)], dtype=object)
+    country = countries[rng.integers(0, len(countries), n)]
+    continent = {c: ['Africa', 'Asia', 'Europe', 'Oceania', np.nan][i % 5] for i, c in enumerate(countries)}
+    region = {c: ['AFRO', 'EURO', 'SEARO', 'WPRO', 'AMRO', 'EMRO', np.nan][i % 7] for i, c in enumerate(countries)}
+    collect_date = pd.Timestamp('2022-01-01') + pd.to_timedelta(rng.integers(0, 40, n), unit='D')
+    df = pd.DataFrame({'collect_date': collect_date,
+                       'collect_yearweek': collect_date.strftime('%G-W%V'),
+                       'collect_weekstartdate': collect_date - pd.to_timedelta(collect_date.weekday, unit='D'),
+                       'owid_date': collect_date,
+                       'owid_location': country,
+                       'country': country,
+                       'owid_continent': [continent[c] for c in country],
+                       'who_region': [region[c] for c in country],
+                       'BA.2': rng.integers(0, 50, n),
+                       'BA.1': rng.integers(0, 50, n),
+                       'owid_new_cases': np.where(rng.random(n) < 0.1, np.nan, rng.random(n) * 1000),
+                       'lag_days': rng.integers(0, 60, n)})
+    df.loc[::97, 'collect_date'] = pd.NaT
+    return df
+
+
+def test_concat_agglocations_matches_groupby(country_rows):
+    value_cols = ['BA.2', 'BA.1', 'owid_new_cases']
+    frame = country_rows[GROUP_COLS + ['owid_continent', 'who_region'] + value_cols]
+    expected = groupby_concat_agglocations(frame).reset_index(drop=True)
+    # string columns such as owid_location, which the old groupby().sum() concatenated, are left out
+    agglocation_df = gmp.concat_agglocations(country_rows.drop(columns=['lag_days'])).reset_index(drop=True)
+    assert set(agglocation_df.columns) == set(GROUP_COLS + value_cols + ['owid_continent', 'who_region', 'aggregate_location'])
+    # the other levels' label columns held concatenated strings in the old rows, so aggregate_location stands for them
+    compare_cols = GROUP_COLS + value_cols + ['aggregate_location']
+    pd.testing.assert_frame_equal(agglocation_df[compare_cols], expected[compare_cols])
+
+
+def test_calc_regional_lagstats_matches_groupby(country_rows):
+    expected = groupby_calc_regional_lagstats(country_rows).reset_index(drop=True)
+    sumstats_df = gmp.calc_regional_lagstats(country_rows).reset_index(drop=True)
+    pd.testing.assert_frame_equal(sumstats_df, expected[sumstats_df.columns])
+    assert list(sumstats_df.columns) == list(expected.columns)
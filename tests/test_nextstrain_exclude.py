@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Nextstrain exclude list parsing, hashed membership and the stored index."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import fetch_cache
+import process_nextstrain_exclude
+from process_nextstrain_exclude import ExcludeIndex, normalize_exclude_entries
+
+EXCLUDE_TEXT = '# comment\nFrance/IDF-1/2021\n\nPeru/LIM-2/2021\nFrance/IDF-1/2021\n  Japan/TK-3/2022  \n'
+
+
+def test_normalize_strips_crlf():
+    entries = ['hCoV-19/France/IDF-1/2021', 'hCoV-19/Peru/LIM-2/2021', 'hCoV-19/Japan/TK-3/2022']
+    assert normalize_exclude_entries(EXCLUDE_TEXT) == entries
+    assert normalize_exclude_entries(EXCLUDE_TEXT.replace('\n', '\r\n')) == entries
+
+
+def test_contains_matches_set_membership():
+    rng = np.random.default_rng(12)
+    names = np.array(['hCoV-19/Country/%d/2021' % i for i in range(5000)], dtype=object)
+    entries = list(rng.choice(names, 300, replace=False)) + ['hCoV-19/Not/in/metadata']
+    index = ExcludeIndex(entries, version='v1')
+    virus_names = pd.Series(rng.choice(names, 20000))
+
+    np.testing.assert_array_equal(index.contains(virus_names), virus_names.isin(set(entries)).to_numpy())
+    report = index.match_report().set_index('entry')['matched']
+    assert report.to_dict() == {entry: entry in set(virus_names) for entry in entries}
+    assert not ExcludeIndex([]).contains(virus_names).any()
+
+
+@pytest.fixture
+def exclude_source(tmp_path, monkeypatch):
+    """fetch_cache.fetch serving the current version of the list as a file named after it, as the cache does."""
+    cache_dir = str(tmp_path / 'fetch_cache')
+    os.makedirs(cache_dir)
+    source = {'version': 'v1', 'text': EXCLUDE_TEXT}
+
+    def fetch(url, cache_dir=None, offline=None):
+        path = os.path.join(cache_dir, source['version'])
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(source['text'])
+        return path
+
+    monkeypatch.setattr(fetch_cache, 'fetch', fetch)
+    monkeypatch.setattr(fetch_cache, 'cache_entry', lambda url, cache_dir=None: {'etag': '"%s"' % source['version']})
+    monkeypatch.setattr(process_nextstrain_exclude, '_loaded_indexes', {})
+    source['cache_dir'] = cache_dir
+    return source
+
+
+def test_index_reloaded_until_version_changes(exclude_source, capsys):
+    cache_dir = exclude_source['cache_dir']
+    index = process_nextstrain_exclude.load_exclude_index(cache_dir)
+    assert 'Indexed 3' in capsys.readouterr().out
+    assert (index.version, index.etag) == ('v1', '"v1"')
+    assert process_nextstrain_exclude.load_exclude_index(cache_dir) is index
+
+    # a new run loads the stored index for the same version
+    process_nextstrain_exclude._loaded_indexes.clear()
+    reloaded = process_nextstrain_exclude.load_exclude_index(cache_dir)
+    assert 'Indexed' not in capsys.readouterr().out
+    np.testing.assert_array_equal(reloaded.hashes, index.hashes)
+    assert list(reloaded.entries) == list(index.entries) and reloaded.etag == '"v1"'
+
+    # and rebuilds it when the list changed
+    exclude_source.update(version='v2', text=EXCLUDE_TEXT + 'Kenya/KE-4/2022\n')
+    process_nextstrain_exclude._loaded_indexes.clear()
+    rebuilt = process_nextstrain_exclude.load_exclude_index(cache_dir)
+    assert 'Indexed 4' in capsys.readouterr().out
+    assert rebuilt.version == 'v2' and rebuilt.contains(['hCoV-19/Kenya/KE-4/2022'])[0]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Grouped OWID vaccination transforms against the per-location loops they replaced."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gisaid_metadata_processing as gmp
+import synthetic_data
+
+
+def loop_new_vaccinated(owid_df):
+    # the loops prepare_owid_df used, on its location/date sorted frame
+    owid_df = owid_df.copy()
+    for loc in owid_df.location.unique():
+        owid_df.loc[owid_df['location']==loc,'new_people_vaccinated'] = owid_df[owid_df['location']==loc]['people_vaccinated'].ffill().fillna(0).diff()
+        owid_df.loc[owid_df['location']==loc,'new_people_fully_vaccinated'] = owid_df[owid_df['location']==loc]['people_fully_vaccinated'].ffill().fillna(0).diff()
+    return owid_df
+
+
+def loop_vax_bottomup(vax_df, loc_col='owid_location'):
+    # the loops calc_vax_bottomup used
+    vax_df = vax_df.copy()
+    for loc in vax_df[loc_col].unique():
+      vax_df.loc[vax_df[loc_col]==loc,'owid_people_vaccinated'] = vax_df[vax_df[loc_col]==loc]['owid_new_people_vaccinated'].cumsum()
+      vax_df.loc[vax_df[loc_col]==loc,'owid_people_fully_vaccinated'] = vax_df[vax_df[loc_col]==loc]['owid_new_people_fully_vaccinated'].cumsum()
+    vax_df['owid_people_vaccinated_per_hundred'] = np.round(vax_df['owid_people_vaccinated'] / (vax_df['owid_population']/100),2)
+    vax_df['owid_people_fully_vaccinated_per_hundred'] = np.round(vax_df['owid_people_fully_vaccinated'] / (vax_df['owid_population']/100),2)
+    return vax_df
+
+
+@pytest.fixture
+def raw_owid_df():
+    # shuffled rows, and a share of rows without a location
+    owid_df = synthetic_data.generate_owid(n_countries=12, seed=3).sample(frac=1, random_state=3).reset_index(drop=True)
+    owid_df.loc[owid_df.sample(frac=0.02, random_state=4).index, 'location'] = np.nan
+    return owid_df
+
+
+def test_prepare_owid_df_matches_loops(raw_owid_df):
+    owid_df = gmp.prepare_owid_df(raw_owid_df.copy())
+    vax_cols = ['owid_new_people_vaccinated', 'owid_new_people_fully_vaccinated']
+    inputs = owid_df.drop(columns=vax_cols).copy()
+    inputs.columns = [c[len('owid_'):] for c in inputs.columns]
+    expected = loop_new_vaccinated(inputs)[['new_people_vaccinated', 'new_people_fully_vaccinated']]
+    assert owid_df['owid_location'].isna().any()
+    np.testing.assert_array_equal(owid_df[vax_cols].to_numpy(), expected.to_numpy())
+
+
+def test_calc_vax_bottomup_matches_loops(raw_owid_df):
+    # frame order matters to the cumulative sums, so the prepared frame is shuffled again
+    vax_df = gmp.prepare_owid_df(raw_owid_df.copy()).sample(frac=1, random_state=5)
+    assert vax_df['owid_location'].isna().any()
+    pd.testing.assert_frame_equal(gmp.calc_vax_bottomup(vax_df.copy()), loop_vax_bottomup(vax_df))
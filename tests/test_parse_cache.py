@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Parsed metadata snapshots against a fresh parse of the export."""
+
+import os
+
+import pandas as pd
+import pytest
+
+import filter_gisaid_metadata
+import parse_cache
+import synthetic_data
+
+
+@pytest.fixture
+def metadata_path(tmp_path):
+    path = str(tmp_path / 'metadata.tsv')
+    synthetic_data.generate_metadata(400, n_countries=15, n_lineages=60, seed=13).to_csv(path, sep='\t', index=False)
+    return path
+
+
+def fresh_parse(metadata_path):
+    return next(filter_gisaid_metadata.read_metadata_chunks(metadata_path))
+
+
+def test_cache_hit_matches_fresh_parse(metadata_path, tmp_path, capsys):
+    cache_dir = str(tmp_path / 'parsed')
+    first = parse_cache.read_cached_metadata(metadata_path, cache_dir)
+    assert 'Parsing' in capsys.readouterr().out
+    hit = parse_cache.read_cached_metadata(metadata_path, cache_dir)
+    assert 'Using parsed snapshot' in capsys.readouterr().out
+    pd.testing.assert_frame_equal(first, fresh_parse(metadata_path))
+    pd.testing.assert_frame_equal(hit, fresh_parse(metadata_path))
+    chunks = list(parse_cache.read_cached_metadata_chunks(metadata_path, cache_dir, chunksize=150))
+    fresh_chunks = list(filter_gisaid_metadata.read_metadata_chunks(metadata_path, chunksize=150))
+    assert len(chunks) == len(fresh_chunks) == 3
+    for chunk, fresh_chunk in zip(chunks, fresh_chunks):
+        pd.testing.assert_frame_equal(chunk, fresh_chunk)
+
+
+def test_changed_export_invalidates_snapshot(metadata_path, tmp_path, capsys):
+    cache_dir = str(tmp_path / 'parsed')
+    parse_cache.read_cached_metadata(metadata_path, cache_dir)
+    first_key = parse_cache.snapshot_key(parse_cache.file_fingerprint(metadata_path))
+
+    # same size and mtime, different lineage on one row
+    stat = os.stat(metadata_path)
+    with open(metadata_path) as f:
+        text = f.read()
+    lines = text.split('\n')
+    row = lines[200].split('\t')
+    lineage_col = lines[0].split('\t').index('Pango lineage')
+    row[lineage_col] = ('X' * len(row[lineage_col]))
+    lines[200] = '\t'.join(row)
+    with open(metadata_path, 'w') as f:
+        f.write('\n'.join(lines))
+    os.utime(metadata_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(metadata_path).st_size == stat.st_size
+    capsys.readouterr()
+
+    changed = parse_cache.read_cached_metadata(metadata_path, cache_dir)
+    assert 'Parsing' in capsys.readouterr().out
+    pd.testing.assert_frame_equal(changed, fresh_parse(metadata_path))
+    assert (changed['Pango lineage'].astype(str).str.startswith('XX')).sum() == 1
+    # the stale snapshot of the same export is dropped
+    manifest = parse_cache._load_manifest(cache_dir)
+    assert first_key not in manifest and len(manifest) == 1
+    assert not os.path.exists(parse_cache._snapshot_path(cache_dir, first_key))
+
+    # touching the file changes the key too
+    os.utime(metadata_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    parse_cache.read_cached_metadata(metadata_path, cache_dir)
+    assert 'Parsing' in capsys.readouterr().out
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Snapshot deltas and the store's manifest commit point."""
+
+import os
+import warnings
+
+import pandas as pd
+import pytest
+
+import snapshot_store
+from snapshot_store import SnapshotBuilder, SnapshotStore, diff_snapshots
+
+
+def snapshot(rows):
+    gisaid_df = pd.DataFrame(rows, columns=snapshot_store.SNAPSHOT_COLS)
+    gisaid_df['collect_date'] = pd.to_datetime(gisaid_df['collect_date'])
+    builder = SnapshotBuilder()
+    builder.add(gisaid_df)
+    return builder.frame()
+
+
+FIRST = snapshot([['EPI_ISL_1', '2022-01-01', 'Denmark', 'BA.1', False, False],
+                  ['EPI_ISL_2', '2022-01-02', 'Denmark', 'BA.2', False, False]])
+SECOND = snapshot([['EPI_ISL_2', '2022-01-02', 'Denmark', 'BA.2.1', False, False],
+                   ['EPI_ISL_3', '2022-01-03', 'France', 'BA.2', False, True]])
+
+
+def test_missing_side_is_not_float():
+    # the side an added or removed accession is missing from has the same dtype as the other changes
+    added_df = snapshot_store._delta_rows('added', FIRST['Accession ID'], None, FIRST)
+    assert not any(pd.api.types.is_float_dtype(t) for t in added_df.filter(regex='^(old|new)_').dtypes)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', FutureWarning)
+        delta_df = diff_snapshots(FIRST, SECOND)
+    assert not any(pd.api.types.is_float_dtype(t) for t in delta_df.filter(regex='^(old|new)_').dtypes)
+    assert sorted(delta_df['change']) == ['added', 'changed', 'removed']
+
+
+def test_record_and_diff(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    assert store.record(FIRST, run_date='2022-05-01') is None
+    changes = store.record(SECOND, run_date='2022-05-02')
+    assert list(changes.relineaged['Accession ID']) == ['EPI_ISL_2']
+    assert list(SnapshotStore(str(tmp_path)).diff(since='2022-05-01').added['Accession ID']) == ['EPI_ISL_3']
+    # only the latest run's snapshot is kept
+    assert [f for f in os.listdir(tmp_path) if f.startswith('snapshot-')] == ['snapshot-2022-05-02-0001.pkl']
+
+
+def test_failed_run_leaves_store_as_it_was(tmp_path, monkeypatch):
+    SnapshotStore(str(tmp_path)).record(FIRST, run_date='2022-05-01')
+
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(snapshot_store.os, 'replace', fail)
+    with pytest.raises(OSError):
+        SnapshotStore(str(tmp_path)).record(SECOND, run_date='2022-05-02')
+    monkeypatch.undo()
+
+    store = SnapshotStore(str(tmp_path))
+    assert [run['run_date'] for run in store.runs] == ['2022-05-01']
+    pd.testing.assert_frame_equal(store.latest(), FIRST)
+    # the next run diffs against the last committed one and clears the failed run's files
+    changes = store.record(SECOND, run_date='2022-05-03')
+    assert sorted(changes.delta_df['change']) == ['added', 'changed', 'removed']
+    assert [f for f in os.listdir(tmp_path) if f.startswith('snapshot-')] == ['snapshot-2022-05-03-0001.pkl']
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Stage keys follow the inputs the processed metadata depends on."""
+
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+import filter_gisaid_metadata
+import gisaid_metadata_processing as gmp
+import stage_cache
+import synthetic_data
+
+
+@pytest.fixture
+def metadata_inputs(local_paths, monkeypatch):
+    metadata_path = local_paths / 'metadata.tsv'
+    metadata_path.write_text('Accession ID\tCollection date\n')
+    corrections_path = local_paths / 'corrections.csv'
+    with open(filter_gisaid_metadata.COUNTRY_NAME_CORRECTIONS_PATH) as f:
+        corrections_path.write_text(f.read())
+    monkeypatch.setattr(filter_gisaid_metadata, 'COUNTRY_NAME_CORRECTIONS_PATH', str(corrections_path))
+
+    def key():
+        pipeline = stage_cache.StagePipeline(stage_cache.StageCache(str(local_paths / 'stages')))
+        exclude_index = SimpleNamespace(version='v1')
+        pipeline.add('process_metadata', lambda: None,
+                     fingerprint=lambda: gmp.process_metadata_inputs(str(metadata_path), exclude_index))
+        return pipeline.key('process_metadata')
+    return key, corrections_path
+
+
+def test_key_is_stable(metadata_inputs):
+    key, _ = metadata_inputs
+    assert key() == key()
+
+
+def test_key_follows_country_name_rules(metadata_inputs):
+    key, corrections_path = metadata_inputs
+    before = key()
+    corrections_path.write_text(corrections_path.read_text() + 'Atlantis,Greece,exact\n')
+    assert key() != before
+
+
+def test_key_follows_earlier_suspect_dates(metadata_inputs):
+    key, _ = metadata_inputs
+    before = key()
+    # accessions flagged today are the run's own output
+    with open(filter_gisaid_metadata.SUSPECT_DATE_PATH, 'w') as f:
+        f.write('accession_id,first_flagged\nEPI_ISL_2,%s\n' % date.today().strftime('%Y-%m-%d'))
+    assert key() == before
+    with open(filter_gisaid_metadata.SUSPECT_DATE_PATH, 'a') as f:
+        f.write('EPI_ISL_1,2022-01-01\n')
+    assert key() != before
+
+
+def test_key_follows_run_date(metadata_inputs, monkeypatch):
+    key, _ = metadata_inputs
+    before = key()
+
+    class LaterDate(date):
+        @classmethod
+        def today(cls):
+            return date(2099, 1, 1)
+    monkeypatch.setattr(gmp, 'date', LaterDate)
+    assert key() != before
+
+
+def test_identical_rerun_is_a_hit(local_paths, exclude_index, monkeypatch):
+    metadata_df = synthetic_data.generate_metadata(300, n_countries=10, n_lineages=40, seed=14)
+    # a future and a partial date, so the run records suspect accessions
+    metadata_df.loc[:1, 'Collection date'] = ['2099-01-01', '2021-06']
+    metadata_path = str(local_paths / 'metadata.tsv')
+    metadata_df.to_csv(metadata_path, sep='\t', index=False)
+    monkeypatch.setattr(gmp, 'CLEAN_METADATA_PATH', str(local_paths / 'clean.csv'))
+    args = gmp.parse_args(['--metadata-path', metadata_path, '--stage-cache'])
+
+    statuses = []
+    for run in range(2):
+        # a new run starts with the suspect date table as the last one saved it
+        monkeypatch.setattr(filter_gisaid_metadata, '_suspect_date_tables', {})
+        pipeline = gmp.build_stage_pipeline(args, stage_cache.StageCache(str(local_paths / 'stages')))
+        pipeline.get('process_metadata')
+        filter_gisaid_metadata.load_suspect_date_table().save()
+        statuses.append(pipeline.summary()['status'].tolist())
+    assert len(filter_gisaid_metadata.SuspectDateTable(filter_gisaid_metadata.SUSPECT_DATE_PATH).table) >= 2
+    assert statuses == [['miss'], ['hit']]
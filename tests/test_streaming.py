@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Streamed metadata processing."""
+
+import os
+
+import pandas as pd
+import pytest
+
+import filter_gisaid_metadata
+import gisaid_metadata_processing as gmp
+import process_nextstrain_exclude
+import stage_cache
+import synthetic_data
+
+
+@pytest.fixture
+def metadata_path(local_paths, exclude_index, monkeypatch):
+    path = str(local_paths / 'metadata.tsv')
+    synthetic_data.generate_metadata(600, n_countries=12, n_lineages=60, seed=16).to_csv(path, sep='\t', index=False)
+    monkeypatch.setattr(gmp, 'CLEAN_METADATA_PATH', str(local_paths / 'clean.csv'))
+    return path
+
+
+@pytest.fixture
+def events(monkeypatch):
+    """Order in which chunks are read and the exclude index is loaded."""
+    events = []
+    load_exclude_index = process_nextstrain_exclude.load_exclude_index
+    read_metadata_chunks = gmp.read_metadata_chunks
+
+    def logged_load(*args, **kwargs):
+        events.append('exclude index')
+        return load_exclude_index(*args, **kwargs)
+
+    def logged_read(*args, **kwargs):
+        for chunk in read_metadata_chunks(*args, **kwargs):
+            events.append('chunk')
+            yield chunk
+    monkeypatch.setattr(process_nextstrain_exclude, 'load_exclude_index', logged_load)
+    monkeypatch.setattr(gmp, 'read_metadata_chunks', logged_read)
+    return events
+
+
+def test_exclude_index_loaded_after_first_chunk(metadata_path, events, local_paths):
+    gmp.stream_process_metadata(metadata_path, str(local_paths / 'clean.csv'), chunksize=200)
+    assert events[:2] == ['chunk', 'exclude index']
+    assert events.count('chunk') == 3
+
+    del events[:]
+    gmp.incremental_process_metadata(metadata_path, str(local_paths / 'clean.csv'), str(local_paths / 'state'),
+                                     chunksize=200)
+    assert events[:2] == ['chunk', 'exclude index']
+
+
+def test_stage_pipeline_loads_exclude_index_on_demand(metadata_path, events, local_paths):
+    args = gmp.parse_args(['--metadata-path', metadata_path, '--stage-cache', '--chunksize', '200'])
+    pipeline = gmp.build_stage_pipeline(args, stage_cache.StageCache(str(local_paths / 'stages')))
+    assert events == []
+    pipeline.get('process_metadata')
+    # the stage key needs the list version, so it is loaded before the read when the key is computed
+    assert events[0] == 'exclude index' and events.count('chunk') == 3
+
+
+def sort_rows(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_out_of_core_matches_in_memory(metadata_path, local_paths, capsys, compact):
+    # a budget of a few KB of export per partition, so the counts spill to many partitions
+    out_of_core = gmp.out_of_core_process_metadata(metadata_path, str(local_paths / 'ooc_clean.csv'), chunksize=150,
+                                                   compact=compact, spill_dir=str(local_paths / 'spill'),
+                                                   memory_budget_mb=0.01)
+    n_partitions = int(capsys.readouterr().out.split('Spilling counts to ')[1].split()[0])
+    assert n_partitions >= 8
+    assert os.listdir(str(local_paths / 'spill')) == []
+
+    gisaid_counts_df, gisaid_cols, max_gisaid_date = gmp.stream_process_metadata(
+        metadata_path, str(local_paths / 'clean.csv'), chunksize=150, compact=compact)
+    country_variants_df = gmp.aggregate_with_lineage_from_counts(gisaid_counts_df)
+    sumstats_df = gmp.calc_lagstats_from_counts(gisaid_counts_df)
+
+    pd.testing.assert_frame_equal(sort_rows(out_of_core[0]), sort_rows(country_variants_df[out_of_core[0].columns]))
+    pd.testing.assert_frame_equal(out_of_core[1], sumstats_df)
+    assert out_of_core[2] == gisaid_cols and out_of_core[3] == max_gisaid_date
+    assert pd.read_csv(str(local_paths / 'ooc_clean.csv')).equals(pd.read_csv(str(local_paths / 'clean.csv')))
+
+
+@pytest.mark.parametrize('flags', [['--out-of-core', '--incremental'], ['--out-of-core', '--stage-cache']])
+def test_out_of_core_rejects_other_modes(flags):
+    with pytest.raises(SystemExit):
+        gmp.parse_args(flags)
+    gmp.parse_args(['--out-of-core', '--chunksize', '1000'])